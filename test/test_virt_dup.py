@@ -2,12 +2,16 @@
 #-*- coding: utf-8 -*-
 'pytest'
 import unittest
+from unittest import mock
 import sys
 import os
 import inspect
 #import traceback
 import contextlib
 import importlib
+import tempfile
+import time
+import json
 from io import StringIO
 
 # https://stackoverflow.com/questions/279237/import-a-module-from-a-relative-path
@@ -125,5 +129,931 @@ class CliTestCase(unittest.TestCase):
         self.assertEqual(cmgr.exception.code, 0)
 
 
+class PoolTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_pool_spares_in_index_order(self):
+        'docstring'
+        domains = ['ci-spare10', 'ci-spare2', 'ci-spare', 'cix-spare1', 'ut-vm']
+        self.assertEqual(VIRTDUP.pool_spares('ci', domains),
+                         ['ci-spare2', 'ci-spare10'])
+
+    def test_pool_missing_spares(self):
+        'docstring'
+        domains = ['ci-spare1', 'ut-vm']
+        self.assertEqual(VIRTDUP.pool_missing_spares('ci', 3, domains),
+                         ['ci-spare0', 'ci-spare2'])
+        self.assertEqual(VIRTDUP.pool_missing_spares('ci', 1, domains), [])
+
+    def test_pool_incomplete_spares_refilled(self):
+        'docstring'
+        domains = ['ci-spare0', 'ci-spare1', 'ut-vm']
+        self.assertEqual(VIRTDUP.pool_missing_spares('ci', 2, domains, ['ci-spare1']),
+                         ['ci-spare0'])
+        self.assertEqual(VIRTDUP.pool_missing_spares('ci', 3, domains, []),
+                         ['ci-spare0', 'ci-spare1', 'ci-spare2'])
+
+    def test_pool_ready_spares(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(VIRTDUP, 'POOL_DIR', tmp):
+            domains = ['ci-spare0', 'ci-spare1']
+            self.assertEqual(VIRTDUP.pool_ready_spares('ci', domains), [])
+            VIRTDUP.mark_spare_ready('ci', 'ci-spare1')
+            self.assertEqual(VIRTDUP.pool_ready_spares('ci', domains), ['ci-spare1'])
+            VIRTDUP.mark_spare_ready('ci', 'ci-spare1', False)
+            self.assertEqual(VIRTDUP.pool_ready_spares('ci', domains), [])
+
+    def test_take_args(self):
+        'docstring'
+        args = VIRTDUP.cli_parser_take().parse_args(['ci', 'VM1'])
+        self.assertEqual((args.pool, args.name), ('ci', 'VM1'))
+        self.assertTrue(args.refill)
+        self.assertFalse(args.reset_mac)
+
+
+    def test_take_failure_tears_down(self):
+        'docstring'
+        args = VIRTDUP.cli_parser_take().parse_args(['ci', 'VM1', '--no-inventory'])
+        with mock.patch.object(VIRTDUP, 'config_logger'), \
+                mock.patch.object(VIRTDUP, 'ensure_cli_env_is_root'), \
+                mock.patch.object(VIRTDUP, 'read_pool_conf', return_value=('VMx', 2)), \
+                mock.patch.object(VIRTDUP, 'run_cmd', return_value=(1, '', '')), \
+                mock.patch.object(VIRTDUP, 'pool_take_spare', return_value='ci-spare1'), \
+                mock.patch.object(VIRTDUP, 'rename_vm_images', side_effect=OSError('EIO')), \
+                mock.patch.object(VIRTDUP, 'pool_discard_taken') as discard, \
+                mock.patch.object(VIRTDUP, 'pool_refill_in_background') as refill:
+            with self.assertRaises(SystemExit) as ctx:
+                VIRTDUP.process_take_args(args)
+        self.assertEqual(ctx.exception.code, -1)
+        discard.assert_called_once_with('ci-spare1', 'VM1')
+        refill.assert_called_once_with('ci')
+
+
+class TeardownTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_match_vm_domains(self):
+        'docstring'
+        domains = ['VMx', 'VM1', 'VM2', 'ut-vm']
+        self.assertEqual(VIRTDUP.match_vm_domains(domains, ['VM?']),
+                         ['VMx', 'VM1', 'VM2'])
+        self.assertEqual(VIRTDUP.match_vm_domains(domains, ['VM[0-9]', 'ut-*']),
+                         ['VM1', 'VM2', 'ut-vm'])
+
+    def test_protected_vm_domains(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            domxmls = {}
+            for name in ('VMx', 'VM1', 'VM2', 'VM3'):
+                img = os.path.join(tmp, name + '.qcow2')
+                open(img, 'w').close()
+                domxmls[name] = "<source file='{}'/>".format(img)
+            try:
+                for name in ('VMx', 'VM1'):
+                    os.setxattr(os.path.join(tmp, name + '.qcow2'),
+                                VIRTDUP.XATTR_SOURCE, b'x')
+            except OSError:
+                self.skipTest('no user xattr support')
+            domxmls['VM3'] = ''
+            protected = VIRTDUP.protected_vm_domains(
+                ['VMx', 'VM1', 'VM2', 'VM3'], domxmls, golden_vms={'VMx'})
+        self.assertEqual(sorted(protected), ['VM2', 'VMx'])
+
+    def test_domain_own_image_files(self):
+        'docstring'
+        domxml = ("<source file='/var/lib/libvirt/images/VM1.qcow2'/>\n"
+                  "<source file='/var/lib/libvirt/images/shared.iso'/>\n")
+        self.assertEqual(VIRTDUP.domain_own_image_files('VM1', domxml),
+                         ['/var/lib/libvirt/images/VM1.qcow2'])
+
+    def test_find_orphan_image_files(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            for base in ['VMx.qcow2', 'VM1.qcow2', 'VM3.qcow2', 'VM4.qcow2',
+                         'cloud.qcow2', 'base.iso']:
+                open(os.path.join(tmp, base), 'w').close()
+            try:
+                for base in ['VM1.qcow2', 'VM3.qcow2']:
+                    os.setxattr(os.path.join(tmp, base), VIRTDUP.XATTR_SOURCE, b'x')
+            except OSError:
+                self.skipTest('no user xattr support')
+            in_use = {os.path.join(tmp, 'VMx.qcow2'),
+                      os.path.join(tmp, 'VM1.qcow2')}
+            orphans = VIRTDUP.find_orphan_image_files(
+                [tmp], in_use, ['VMx', 'VM1'])
+            # VM4.qcow2 and cloud.qcow2 are not made by virt-dup
+            self.assertEqual(orphans, [os.path.join(tmp, 'VM3.qcow2')])
+
+
+class IpamTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_allocate_consecutive(self):
+        'docstring'
+        self.assertEqual(VIRTDUP.ipam_allocate('192.168.151.101/16', 3),
+                         ['192.168.151.101/16', '192.168.151.102/16',
+                          '192.168.151.103/16'])
+        self.assertEqual(VIRTDUP.ipam_allocate('2001:db8:dead:beef::101', 2),
+                         ['2001:db8:dead:beef::101', '2001:db8:dead:beef::102'])
+
+    def test_allocate_skips_used(self):
+        'docstring'
+        ipam = VIRTDUP.IpamIndex()
+        ipam.add('10.0.0.2/24')
+        ipam.add('10.0.0.4')
+        self.assertEqual(VIRTDUP.ipam_allocate('10.0.0.1-10.0.0.5/24', 3, ipam),
+                         ['10.0.0.1/24', '10.0.0.3/24', '10.0.0.5/24'])
+
+    def test_allocate_netmask(self):
+        'docstring'
+        self.assertEqual(
+            VIRTDUP.ipam_allocate('192.168.1.10-192.168.1.20/255.255.255.0', 2),
+            ['192.168.1.10/24', '192.168.1.11/24'])
+        self.assertEqual(VIRTDUP.ipam_allocate('10.1.2.3/255.255.0.0', 1),
+                         ['10.1.2.3/16'])
+        with self.assertRaises(ValueError):
+            VIRTDUP.parse_ip_range('10.0.0.1/255.0.255.0')
+
+    def test_static_ips_of_domains(self):
+        'docstring'
+        ipam = VIRTDUP.IpamIndex()
+        ipam.load_domains({
+            'web': "<interface type='user'>\n  <ip address='10.0.0.2' prefix='24'/>\n"
+                   "</interface>",
+            'VM1': "<interface type='user'><ip address='10.0.0.3'/></interface>"},
+                          exclude=['VM1'])
+        self.assertIn('10.0.0.2', ipam)
+        self.assertNotIn('10.0.0.3', ipam)
+
+    def test_refresh_targets_give_ips_back(self):
+        'docstring'
+        netxml = ("<network><ip address='10.0.0.1' prefix='24'><dhcp>"
+                  "<host mac='52:54:00:00:00:01' name='VM1' ip='10.0.0.101'/>"
+                  "<host mac='52:54:00:00:00:02' name='web' ip='10.0.0.102'/>"
+                  "<host mac='52:54:00:00:00:03' ip='10.0.0.103'/>"
+                  "</dhcp></ip></network>")
+        leases = (" Expiry Time           MAC address         Protocol   IP address     Hostname\n"
+                  " 2026-10-19 10:00:00   52:54:00:00:00:03   ipv4       10.0.0.103/24  VM2\n"
+                  " 2026-10-19 10:00:00   52:54:00:00:00:04   ipv4       10.0.0.104/24  db\n")
+        outputs = {'net-list': 'default\n', 'net-dhcp-leases': leases, 'net-dumpxml': netxml}
+        with mock.patch.object(VIRTDUP, 'run_cmd',
+                               side_effect=lambda cmd, **kw: (0, outputs[cmd[1]], '')):
+            ipam = VIRTDUP.IpamIndex()
+            ipam.load_libvirt_networks(exclude=['VM1', 'VM2'],
+                                       exclude_macs={'52:54:00:00:00:03'})
+        self.assertEqual(sorted(str(ip) for ip in ipam.used), ['10.0.0.102', '10.0.0.104'])
+
+    def test_allocate_overflow(self):
+        'docstring'
+        with self.assertRaises(ValueError):
+            VIRTDUP.ipam_allocate('10.0.0.253/24', 3)
+        with self.assertRaises(ValueError):
+            VIRTDUP.ipam_allocate('10.0.0.1-10.0.1.9/24', 1)
+
+    def test_hosts_file(self):
+        'docstring'
+        with tempfile.NamedTemporaryFile('w+t') as hosts:
+            hosts.write('127.0.0.1 localhost\n# 10.0.0.9 x\n10.0.0.7 vm7\n')
+            hosts.flush()
+            ipam = VIRTDUP.IpamIndex()
+            ipam.load_hosts_file(hosts.name)
+        self.assertIn('10.0.0.7', ipam)
+        self.assertNotIn('10.0.0.9', ipam)
+
+
+class RegisterTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_register_hosts_file(self):
+        'docstring'
+        vm1 = VIRTDUP.CloneResult('VM1')
+        vm1.ip_cidr = '192.168.151.101/24'
+        vm2 = VIRTDUP.CloneResult('VM2')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'hosts')
+            with open(path, 'w') as file:
+                file.write('127.0.0.1 localhost\n192.168.151.9 VM1 VM1.lan\n'
+                           '127.0.1.1 myhost VM1 # the host\n')
+            self.assertEqual(VIRTDUP.register_hosts_file([vm1, vm2], path), 1)
+            with open(path) as file:
+                hosts = file.read()
+            self.assertEqual(os.listdir(tmp), ['hosts'])
+        self.assertEqual(hosts, '127.0.0.1 localhost\n127.0.1.1 myhost # the host\n'
+                                '192.168.151.101\tVM1\n')
+
+    def test_register_hosts_file_in_place(self):
+        'docstring'
+        vm1 = VIRTDUP.CloneResult('VM1')
+        vm1.ip_cidr = '192.168.151.101/24'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'hosts')
+            with open(path, 'w') as file:
+                file.write('127.0.0.1 localhost\n')
+            with mock.patch.object(VIRTDUP.os, 'replace',
+                                   side_effect=OSError(16, 'Device or resource busy')):
+                self.assertEqual(VIRTDUP.register_hosts_file([vm1], path), 1)
+            with open(path) as file:
+                hosts = file.read()
+            self.assertEqual(os.listdir(tmp), ['hosts'])
+        self.assertEqual(hosts, '127.0.0.1 localhost\n192.168.151.101\tVM1\n')
+
+    def test_network_stale_hosts(self):
+        'docstring'
+        netxml = ("<network><name>default</name>"
+                  "<dns><host ip='192.168.122.9'><hostname>VM1</hostname></host>"
+                  "<host ip='192.168.122.5'><hostname>web</hostname></host></dns>"
+                  "<ip address='192.168.122.1'><dhcp>"
+                  "<host mac='52:54:00:00:00:01' name='VM1' ip='192.168.122.9'/>"
+                  "<host mac='52:54:00:00:00:05' name='web' ip='192.168.122.5'/>"
+                  "</dhcp></ip></network>")
+        stale = VIRTDUP.network_stale_hosts(netxml, {'VM1'}, {'52:54:00:00:00:01'},
+                                            {'192.168.122.101'})
+        self.assertEqual([section for section, _x in stale],
+                         ['ip-dhcp-host', 'dns-host'])
+        self.assertIn("name=\"VM1\"", stale[0][1])
+        self.assertIn('<hostname>VM1</hostname>', stale[1][1])
+
+
+class PlacementTestCase(unittest.TestCase):
+    'docstring'
+
+    def setUp(self):
+        'docstring'
+        self.hosts = [VIRTDUP.LibvirtHost('test:///default', domains=['VMx', 'VM9']),
+                      VIRTDUP.LibvirtHost('test:///default', domains=['VM2']),
+                      VIRTDUP.LibvirtHost('test:///default', domains=[])]
+
+    def tearDown(self):
+        'docstring'
+        for host in self.hosts:
+            host.close()
+
+    def test_round_robin(self):
+        'docstring'
+        placed = [VIRTDUP.place_vm(self.hosts, 'VM%d' % i, 'round-robin', i)
+                  for i in (3, 4, 5)]
+        self.assertEqual([self.hosts.index(h) for h in placed], [0, 1, 2])
+
+    def test_least_loaded(self):
+        'docstring'
+        host = VIRTDUP.place_vm(self.hosts, 'VM3', 'least-loaded', 0)
+        self.assertIs(host, self.hosts[2])
+
+    def test_existing_vm_stays(self):
+        'docstring'
+        host = VIRTDUP.place_vm(self.hosts, 'VM2', 'round-robin', 0)
+        self.assertIs(host, self.hosts[1])
+
+    def test_least_loaded_by_allocation(self):
+        'docstring'
+        # the host with fewer but bigger domains is the more loaded one
+        allocations = [[4, 4 << 20], [8, 16 << 20], [0, 0]]
+        for host, allocated in zip(self.hosts, allocations):
+            host.allocated, host.capacity = allocated, [16, 32 << 20]
+        self.hosts[2].allocated = [12, 8 << 20]
+        host = VIRTDUP.place_vm(self.hosts, 'VM3', 'least-loaded', 0)
+        self.assertIs(host, self.hosts[0])
+        domxml = "<domain>\n  <memory unit='GiB'>12</memory>\n  <vcpu>2</vcpu>\n</domain>"
+        self.assertEqual(VIRTDUP.domxml_allocation(domxml), [2, 12 << 20])
+
+    def test_test_driver(self):
+        'docstring'
+        if VIRTDUP.libvirt is None:
+            self.skipTest('the libvirt python binding is not installed')
+        host = VIRTDUP.LibvirtHost('test:///default')
+        try:
+            self.assertIn('test', host.domains)
+            self.assertEqual(host.domstate('test'), 'running')
+            self.assertIsNotNone(host.load())
+            idle = VIRTDUP.LibvirtHost('test:///default', domains=[])
+            self.assertIs(VIRTDUP.place_vm([host, idle], 'VM3', 'least-loaded', 0), idle)
+            idle.close()
+        finally:
+            host.close()
+
+
+class RootfsDiscoveryTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_rank_rootfs_candidates(self):
+        'docstring'
+        parts = [
+            {'NAME': 'nbd0p1', 'FSTYPE': 'vfat',
+             'PARTTYPE': 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b'},
+            {'NAME': 'nbd0p2', 'FSTYPE': 'xfs',
+             'PARTTYPE': '4d21b016-b534-45c2-a9fb-5c16e091fd2d'},
+            {'NAME': 'nbd0p3', 'FSTYPE': 'ext4', 'PARTLABEL': 'data'},
+            {'NAME': 'nbd0p4', 'FSTYPE': 'xfs',
+             'PARTTYPE': '933ac7e1-2eb4-4f13-b844-0e14e2aef915'},
+            {'NAME': 'nbd0p5', 'FSTYPE': 'btrfs', 'LABEL': 'ROOT'},
+            {'NAME': 'nbd0p6', 'FSTYPE': 'xfs',
+             'PARTTYPE': '4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709'},
+        ]
+        ranked = VIRTDUP.rank_rootfs_candidates(parts)
+        self.assertEqual([p['NAME'] for p in ranked],
+                         ['nbd0p6', 'nbd0p5', 'nbd0p3', 'nbd0p2'])
+
+    def test_mount_session_teardown_order(self):
+        'docstring'
+        umounted = []
+
+        class Mnt():
+            'docstring'
+            def __init__(self, name):
+                self.name = name
+            def __enter__(self):
+                return self.name
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                umounted.append(self.name)
+
+        with VIRTDUP.MountSession('ut-vm') as session:
+            session._enter(Mnt('rootfs'))
+            session._enter(Mnt('var'))
+            session._enter(Mnt('overlay'))
+        self.assertEqual(umounted, ['overlay', 'var', 'rootfs'])
+
+    def test_mount_session_upgrade(self):
+        'docstring'
+        mounted = []
+
+        class Mnt():
+            'docstring'
+            def __init__(self, dev, mount_opt, **kwargs):
+                self.name = '/tmp/mnt-' + dev + ('-' + mount_opt if mount_opt else '')
+                self.dev, self.mount_opt = dev, mount_opt
+            def __enter__(self):
+                mounted.append((self.dev, self.mount_opt))
+                return self.name
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                mounted.append(('umount', self.name))
+
+        with mock.patch.object(VIRTDUP, 'DevMntpoint', Mnt), \
+                mock.patch.object(VIRTDUP, 'check_output') as remount:
+            with VIRTDUP.MountSession('ut-vm') as session:
+                # norecovery can't be remounted read-write, mount anew
+                trial = session.mount('nbd0p2', 'xfs', writable=False)
+                mpoint = session.mount('nbd0p2', 'xfs')
+                self.assertNotEqual(trial, mpoint)
+                self.assertEqual(session.mount('nbd0p2', 'xfs', writable=False), mpoint)
+                # a plain 'ro' mount is remounted in place
+                trial = session.mount('nbd0p3', 'ocfs2', writable=False)
+                self.assertEqual(session.mount('nbd0p3', 'ocfs2'), trial)
+                remount.assert_called_once_with(
+                    ['mount', '-o', 'remount,rw', trial])
+        self.assertEqual(mounted, [('nbd0p2', 'ro,norecovery'),
+                                   ('umount', '/tmp/mnt-nbd0p2-ro,norecovery'),
+                                   ('nbd0p2', None), ('nbd0p3', 'ro'),
+                                   ('umount', '/tmp/mnt-nbd0p3-ro'),
+                                   ('umount', '/tmp/mnt-nbd0p2')])
+
+    def test_mount_rw_at_once(self):
+        'docstring'
+        self.assertTrue(VIRTDUP.mount_rw_at_once(
+            {'FSTYPE': 'xfs', 'PARTTYPE': '4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709'}))
+        self.assertTrue(VIRTDUP.mount_rw_at_once({'FSTYPE': 'btrfs', 'LABEL': 'ROOT'}))
+        # the only candidate, unhinted, goes through the trial mount
+        self.assertFalse(VIRTDUP.mount_rw_at_once({'NAME': 'nbd0', 'FSTYPE': 'ext4'}))
+
+    def test_trial_mount_opt(self):
+        'docstring'
+        self.assertEqual(VIRTDUP.trial_mount_opt('xfs'), 'ro,norecovery')
+        self.assertEqual(VIRTDUP.trial_mount_opt('ocfs2'), 'ro')
+
+
+def _mountinfo_len():
+    'docstring'
+    with open('/proc/self/mountinfo') as file:
+        return len(file.readlines())
+
+
+def _raise_error():
+    'docstring'
+    raise ValueError('expected')
+
+
+class MountNamespaceTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_return_value(self):
+        'docstring'
+        self.assertEqual(VIRTDUP.run_in_mount_namespace(max, 1, 2), 2)
+        self.assertEqual(VIRTDUP.run_in_mount_namespace(_mountinfo_len),
+                         _mountinfo_len())
+
+    def test_failure(self):
+        'docstring'
+        with capture_sys_output():
+            with self.assertRaises(ChildProcessError):
+                VIRTDUP.run_in_mount_namespace(_raise_error)
+
+
+class ClonerTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_options(self):
+        'docstring'
+        cloner = VIRTDUP.Cloner({'register_net': 'default'})
+        args = cloner.options('VMx', [], {'set_ip_cidr': '10.0.0.1/24'})
+        self.assertEqual(args.vm_name, ['VMx_dup'])
+        self.assertEqual(args.set_ip_cidr, ['10.0.0.1/24'])
+        self.assertEqual(args.register_net, 'default')
+        self.assertIsNone(args.change_ip)
+
+    def test_invalid_options_raise(self):
+        'docstring'
+        cloner = VIRTDUP.Cloner()
+        with self.assertRaises(VIRTDUP.VirtDupError):
+            cloner.clone('VMx', ['VM 1'])
+        with self.assertRaises(VIRTDUP.VirtDupError):
+            cloner.clone('VMx', ['VM1'], {'set_ip_cidr': '10.0.0.1/24',
+                                          'change_ip': 'no'})
+        with self.assertRaises(VIRTDUP.VirtDupError):
+            cloner.clone('VMx', ['VM1'], {'set_ip_cidr': '10.0.0.300'})
+
+    def test_clone_result(self):
+        'docstring'
+        result = VIRTDUP.CloneResult('VM1', 'VMx')
+        self.assertTrue(result.ok)
+        result.error = 'failed'
+        self.assertFalse(result.ok)
+
+
+class RefreshTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_is_img_current(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            org, new = os.path.join(tmp, 'VMx.qcow2'), os.path.join(tmp, 'VM1.qcow2')
+            with open(org, 'w') as file:
+                file.write('golden v1')
+            self.assertFalse(VIRTDUP.is_img_current(org, new))
+
+            with open(new, 'w') as file:
+                file.write('golden v1')
+            # same size and newer, but only the stamp tells
+            self.assertFalse(VIRTDUP.is_img_current(org, new))
+            VIRTDUP.stamp_source_identity(new, VIRTDUP.source_identity(org))
+            self.assertTrue(VIRTDUP.is_img_current(org, new))
+
+            with open(org, 'w') as file:
+                file.write('golden v2, updated')
+            self.assertFalse(VIRTDUP.is_img_current(org, new))
+
+
+    def test_copy_and_customize_images(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            imgs = []
+            for name in ('', '-data'):
+                org = os.path.join(tmp, 'VMx{}.img'.format(name))
+                with open(org, 'w') as file:
+                    file.write('golden' + name)
+                imgs.append((org, os.path.join(tmp, 'VM1{}.img'.format(name))))
+            args = VIRTDUP.cli_parser().parse_args(['VMx', 'VM1'])
+            result = VIRTDUP.CloneResult('VM1', 'VMx')
+            VIRTDUP.copy_and_customize_images(args, result, imgs)
+            self.assertEqual(result.images, [new for _org, new in imgs])
+            with open(imgs[1][1]) as file:
+                self.assertEqual(file.read(), 'golden-data')
+            if not VIRTDUP.is_img_current(*imgs[0]):
+                self.skipTest('no user xattr support')
+
+            with open(imgs[1][0], 'w') as file:
+                file.write('golden-data v2')
+            result = VIRTDUP.CloneResult('VM1', 'VMx')
+            result.refreshed = []
+            VIRTDUP.copy_and_customize_images(args, result, imgs, refresh=True)
+            self.assertEqual(result.refreshed, [imgs[1][1]])
+            with open(imgs[1][1]) as file:
+                self.assertEqual(file.read(), 'golden-data v2')
+
+
+class NumaTestCase(unittest.TestCase):
+    'docstring'
+
+    DOMXML = ("<domain type='kvm'>\n"
+              "  <name>VMx</name>\n"
+              "  <vcpu placement='static'>2</vcpu>\n"
+              "  <cputune>\n"
+              "    <shares>2048</shares>\n"
+              "    <vcpupin vcpu='0' cpuset='0'/>\n"
+              "  </cputune>\n"
+              "  <os/>\n"
+              "</domain>\n")
+
+    def test_cpulist(self):
+        'docstring'
+        self.assertEqual(VIRTDUP.parse_cpulist('0-3,8,10-11\n'),
+                         [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(VIRTDUP.format_cpulist([11, 0, 1, 2, 3, 8, 10]),
+                         '0-3,8,10-11')
+
+    def test_spread_across_nodes(self):
+        'docstring'
+        existing = ["<vcpupin vcpu='0' cpuset='0-1'/>"]
+        placer = VIRTDUP.NumaPlacer({0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}, existing)
+        domxml = placer.pin_domxml(self.DOMXML)
+        self.assertIn("<vcpupin vcpu='0' cpuset='4'/>", domxml)
+        self.assertIn("<vcpupin vcpu='1' cpuset='5'/>", domxml)
+        self.assertIn("<emulatorpin cpuset='4-7'/>", domxml)
+        self.assertIn("<memory mode='strict' nodeset='1'/>", domxml)
+        self.assertIn("<shares>2048</shares>", domxml)
+        self.assertNotIn("cpuset='0'", domxml)
+        self.assertEqual(placer.place(2), (0, [2, 3]))
+
+
+class StartSchedulerTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_adapt_window(self):
+        'docstring'
+        scheduler = VIRTDUP.StartScheduler(window=4)
+        scheduler.adapt(10.0)
+        scheduler.adapt(12.0)
+        self.assertEqual(scheduler.window, 6)
+        scheduler.adapt(30.0)
+        self.assertEqual(scheduler.window, 3)
+        scheduler.adapt(None)
+        scheduler.adapt(None)
+        scheduler.adapt(None)
+        self.assertEqual(scheduler.window, 1)
+
+    def test_start_args(self):
+        'docstring'
+        cli = VIRTDUP.cli_parser()
+        self.assertIsNone(cli.parse_args(['VMx']).start)
+        self.assertEqual(cli.parse_args(['VMx', 'VM1', '--start']).start, 4)
+        self.assertEqual(cli.parse_args(['VMx', 'VM1', '--start', '8']).start, 8)
+
+
+class InventoryTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_record_rename_forget(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            with VIRTDUP.Inventory(os.path.join(tmp, 'inventory.db')) as inventory:
+                result = VIRTDUP.CloneResult('VM1', 'VMx')
+                result.macs = ['52:54:00:00:00:01']
+                result.ip_cidr = '10.0.0.11/24'
+                result.images = ['/images/VM1.qcow2']
+                inventory.record(result)
+                inventory.record(result)
+                self.assertEqual(inventory.names(), ['VM1'])
+                self.assertEqual(inventory.owner_of_mac('52:54:00:00:00:01'), 'VM1')
+                self.assertEqual(inventory.owner_of_ip('10.0.0.11', exclude=['VM2']), 'VM1')
+                self.assertIsNone(inventory.owner_of_ip('10.0.0.11', exclude=['VM1']))
+                self.assertEqual(VIRTDUP.ipam_allocate(
+                    '10.0.0.11/24', 1, VIRTDUP.IpamIndex(inventory)), ['10.0.0.12/24'])
+
+                macs = VIRTDUP.MacIndex(inventory, exclude=['VM2'])
+                macs.add('52:54:00:00:00:02')
+                self.assertIn('52:54:00:00:00:01', macs)
+                self.assertIn('52:54:00:00:00:02', macs)
+                self.assertNotIn('52:54:00:00:00:01', VIRTDUP.MacIndex(inventory, ['VM1']))
+
+                inventory.rename('VM1', 'web1', ['/images/web1.qcow2'])
+                self.assertEqual(inventory.images(), {'/images/web1.qcow2': 'web1'})
+                self.assertEqual(inventory.owner_of_ip('10.0.0.11'), 'web1')
+
+                inventory.forget('web1')
+                self.assertEqual(inventory.names(), [])
+                self.assertIsNone(inventory.owner_of_mac('52:54:00:00:00:01'))
+
+
+class EventStreamTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_emit_json_lines(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'events.jsonl')
+            VIRTDUP.open_events(path)
+            try:
+                VIRTDUP.emit_event('queued', 'VM1', source='VMx')
+                VIRTDUP.emit_event('copy_done', 'VM1', bytes=1024, duration=0.5,
+                                   error=None)
+            finally:
+                VIRTDUP.close_events()
+            VIRTDUP.emit_event('done', 'VM1')
+            with open(path) as file:
+                events = [json.loads(line) for line in file]
+        self.assertEqual([e['phase'] for e in events], ['queued', 'copy_done'])
+        self.assertEqual(events[1]['bytes'], 1024)
+        self.assertNotIn('error', events[1])
+        self.assertIn('ts', events[0])
+
+
+class HookTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_run_hooks(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            hook = os.path.join(tmp, 'hook.sh')
+            with open(hook, 'w') as file:
+                file.write('#!/bin/sh\necho "$2 $3 $4" > "$1/hooked"\n')
+            os.chmod(hook, 0o755)
+            args = VIRTDUP.cli_parser().parse_args(
+                ['VMx', 'VM1', '--set-ip-cidr', '10.0.0.11/24', '--hook', hook,
+                 '--hook', 'builtins:dict'])
+            VIRTDUP.validate_options(args)
+            self.assertEqual([spec for spec, _h in args.hooks], [hook, 'builtins:dict'])
+            timings = VIRTDUP.run_hooks(args.hooks, tmp, 'VM1', args.set_ip_cidr[0],
+                                        ['52:54:00:00:00:01'])
+            self.assertEqual(sorted(timings), sorted([hook, 'builtins:dict']))
+            with open(os.path.join(tmp, 'hooked')) as file:
+                self.assertEqual(file.read(), 'VM1 10.0.0.11/24 52:54:00:00:00:01\n')
+
+    def test_unknown_hook(self):
+        'docstring'
+        with self.assertRaises(VIRTDUP.VirtDupError):
+            VIRTDUP.resolve_hook('no-such-hook')
+        with self.assertRaises(VIRTDUP.VirtDupError):
+            VIRTDUP.resolve_hook('no_such_module:func')
+
+
+class LiveSourceTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_parse_domblklist(self):
+        'docstring'
+        out = (" Type   Device   Target   Source\n"
+               "------------------------------------------------------\n"
+               " file   disk     vda      /images/VMx.qcow2\n"
+               " file   cdrom    sda      /iso/install.iso\n"
+               " file   disk     vdb      /images/my data.raw\n"
+               " block  disk     vdc      /dev/sdb\n")
+        self.assertEqual(VIRTDUP.parse_domblklist(out),
+                         [('vda', '/images/VMx.qcow2'), ('vdb', '/images/my data.raw')])
+
+    def test_staging_path(self):
+        'docstring'
+        live = VIRTDUP.LiveSource('VMx', ['/images/VMx.qcow2'])
+        staging = live._staging_path('/images/VMx.qcow2')
+        self.assertTrue(staging.startswith('/images/.virt-dup-live-'))
+        self.assertTrue(staging.endswith('-VMx.qcow2'))
+
+
+class HostFactsTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_path_fstype(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            mountinfo = os.path.join(tmp, 'mountinfo')
+            with open(mountinfo, 'w') as file:
+                file.write('22 1 0:21 / / rw shared:1 - ext4 /dev/sda2 rw\n'
+                           '35 22 0:31 / /var/lib/my\\040images rw - btrfs /dev/sdb rw\n')
+            self.assertEqual(VIRTDUP.path_fstype('/var/lib/my images/x', mountinfo),
+                             'btrfs')
+            self.assertEqual(VIRTDUP.path_fstype('/var/lib/my', mountinfo), 'ext4')
+
+    def test_probe_magic(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            img = os.path.join(tmp, 'img')
+            with open(img, 'wb') as file:
+                file.write(b'\0' * 0x10040 + b'_BHRfS_M')
+            self.assertEqual(VIRTDUP.probe_fstype(img), 'btrfs')
+            self.assertFalse(VIRTDUP.is_qcow2(img))
+            with open(img, 'wb') as file:
+                file.write(b'QFI\xfb\0\0\0\x03')
+            self.assertTrue(VIRTDUP.is_qcow2(img))
+            self.assertIsNone(VIRTDUP.probe_fstype(img))
+
+    def test_list_partitions_from_udev(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            sysfs, udev = os.path.join(tmp, 'sys'), os.path.join(tmp, 'udev')
+            os.makedirs(udev)
+            for idx, props in ((1, 'E:ID_PART_ENTRY_NAME=BIOS\\x20boot\n'),
+                               (2, 'E:ID_FS_TYPE=btrfs\nE:ID_FS_LABEL_ENC=ROOT\n'
+                                   'E:ID_PART_ENTRY_TYPE=4f68bce3\n')):
+                os.makedirs('{}/block/nbd0/nbd0p{}'.format(sysfs, idx))
+                os.makedirs('{}/class/block/nbd0p{}'.format(sysfs, idx))
+                with open('{}/class/block/nbd0p{}/dev'.format(sysfs, idx), 'w') as file:
+                    file.write('43:{}\n'.format(idx))
+                with open('{}/b43:{}'.format(udev, idx), 'w') as file:
+                    file.write(props)
+            parts = VIRTDUP.list_partitions('/dev/nbd0', sysfs, udev)
+        self.assertEqual(parts[0], {'NAME': 'nbd0p1', 'FSTYPE': '', 'PARTTYPE': '',
+                                    'PARTLABEL': 'BIOS boot', 'LABEL': ''})
+        self.assertEqual(parts[1]['FSTYPE'], 'btrfs')
+        self.assertEqual(parts[1]['LABEL'], 'ROOT')
+
+    def test_list_partitions_whole_disk(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            sysfs, udev = os.path.join(tmp, 'sys'), os.path.join(tmp, 'udev')
+            os.makedirs(udev)
+            os.makedirs('{}/block/nbd0'.format(sysfs))
+            os.makedirs('{}/class/block/nbd0'.format(sysfs))
+            with open('{}/class/block/nbd0/dev'.format(sysfs), 'w') as file:
+                file.write('43:0\n')
+            with open('{}/b43:0'.format(udev), 'w') as file:
+                file.write('E:ID_FS_TYPE=xfs\n')
+            parts = VIRTDUP.list_partitions('/dev/nbd0', sysfs, udev)
+            self.assertEqual([(p['NAME'], p['FSTYPE']) for p in parts], [('nbd0', 'xfs')])
+
+            # no udev data, lsblk lists the whole disk only
+            lsblk = 'NAME="nbd0" FSTYPE="ext4" PARTTYPE="" PARTLABEL="" LABEL=""\n'
+            with mock.patch.object(VIRTDUP, 'check_output', return_value=lsblk):
+                parts = VIRTDUP.list_partitions('/dev/nbd0', sysfs, tmp)
+            self.assertEqual([(p['NAME'], p['FSTYPE']) for p in parts], [('nbd0', 'ext4')])
+            self.assertEqual(VIRTDUP.rank_rootfs_candidates(parts), parts)
+
+
+class WriteMinimizationTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_write_if_changed(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'hostname')
+            self.assertTrue(VIRTDUP.write_if_changed(path, 'VM1'))
+            mtime = os.stat(path).st_mtime_ns
+            self.assertFalse(VIRTDUP.write_if_changed(path, 'VM1'))
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+            self.assertTrue(VIRTDUP.write_if_changed(path, 'VM2'))
+
+    def test_change_ip_pairs_at_once(self):
+        'docstring'
+        with tempfile.TemporaryDirectory() as etc:
+            with open(etc + '/hosts', 'w') as file:
+                file.write('10.0.0.1 VMx\n')
+            VIRTDUP.change_ip(etc, 'VM1', ['10.0.0.1,10.0.0.2', '10.0.0.2,10.0.0.3'])
+            with open(etc + '/hosts') as file:
+                self.assertEqual(file.read(), '10.0.0.3 VMx\n')
+
+    def test_fiemap_usage(self):
+        'docstring'
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(__file__)) as file:
+            file.write(b'x' * 65536)
+            file.flush()
+            try:
+                shared, exclusive = VIRTDUP.fiemap_usage(file.name)
+            except OSError:
+                self.skipTest('no FIEMAP support')
+            self.assertEqual(shared + exclusive, 65536)
+
+
+class IoThrottleTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_parse_size(self):
+        'docstring'
+        self.assertEqual(VIRTDUP.parse_size('200M'), 200 << 20)
+        self.assertEqual(VIRTDUP.parse_size('1.5G'), 3 << 29)
+        self.assertEqual(VIRTDUP.parse_size('4096'), 4096)
+        with self.assertRaises(ValueError):
+            VIRTDUP.parse_size('fast')
+
+    def test_token_bucket(self):
+        'docstring'
+        throttle = VIRTDUP.IoThrottle(iops=20)
+        start = time.time()
+        for _i in range(30):
+            throttle.acquire(4096)
+        # 20 at once, 10 more at 20 IOPS
+        self.assertGreater(time.time() - start, 0.4)
+
+    def test_throttled_copy_keeps_holes(self):
+        'docstring'
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(__file__)) as tmp:
+            org, new = os.path.join(tmp, 'VMx.img'), os.path.join(tmp, 'VM1.img')
+            with open(org, 'wb') as file:
+                file.write(b'a' * 4096)
+                file.seek(8 << 20)
+                file.write(b'b' * 4096)
+            os.chmod(org, 0o640)
+            method = VIRTDUP.throttled_copy(org, new, VIRTDUP.IoThrottle(bps=1 << 30))
+            with open(org, 'rb') as file1, open(new, 'rb') as file2:
+                self.assertEqual(file1.read(), file2.read())
+            self.assertEqual(os.stat(new).st_mode & 0o7777, 0o640)
+            if method == 'copy':
+                self.assertLess(os.stat(new).st_blocks * 512, 1 << 20)
+
+    def test_ioprio_restored(self):
+        'docstring'
+        calls = []
+
+        def ioprio_syscall(table, *args):
+            calls.append((table is VIRTDUP.SYS_IOPRIO_SET,) + args)
+            return 4 if table is VIRTDUP.SYS_IOPRIO_GET else 0
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(VIRTDUP, 'ioprio_syscall', ioprio_syscall):
+            org, new = os.path.join(tmp, 'VMx.img'), os.path.join(tmp, 'VM1.img')
+            with open(org, 'wb') as file:
+                file.write(b'a' * 4096)
+            VIRTDUP.throttled_copy(org, new, VIRTDUP.IoThrottle(bps=1 << 30), 'idle')
+            with self.assertRaises(OSError):
+                VIRTDUP.throttled_copy(os.path.join(tmp, 'none'), new,
+                                       VIRTDUP.IoThrottle(bps=1 << 30), 'idle')
+        self.assertEqual(calls, [(False,), (True, 3 << 13), (True, 4)] * 2)
+
+
+class PreflightTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_parse_domain_states(self):
+        'docstring'
+        out = (" Id   Name   State\n"
+               "-----------------------\n"
+               " 1    VMx    running\n"
+               " -    VM1    shut off\n\n")
+        self.assertEqual(VIRTDUP.parse_domain_states(out),
+                         {'VMx': 'running', 'VM1': 'shut off'})
+
+    def test_image_name_conflicts(self):
+        'docstring'
+        org_domxml = ("<source file='/images/VMx.qcow2'/>\n"
+                      "<source file='/images/VMx-data.qcow2'/>\n")
+        domxmls = {'VMx': org_domxml,
+                   'VMy': "<source file='/images/VMx-data.qcow2'/>",
+                   'VM2': "<source file='/images/VM2.qcow2'/>",
+                   'old': "<source file='/images/VM1.qcow2'/>"}
+        problems = VIRTDUP.image_name_conflicts('VMx', ['VM1', 'VM2'],
+                                                org_domxml, domxmls)
+        self.assertEqual(len(problems), 2)
+        self.assertIn('shared with VMy', problems[0])
+        self.assertIn("'/images/VM1.qcow2' of 'VM1' is used by old", problems[1])
+
+    def test_preflight_states_and_nbd(self):
+        'docstring'
+        args = VIRTDUP.cli_parser().parse_args(['VMx', 'VM1', 'VM2'])
+        args.vm_name = ['VM1', 'VM2']
+        org_domxml = "<source file='/images/VMx.qcow2'/>\n"
+        with mock.patch.object(VIRTDUP, 'list_domain_states',
+                               return_value={'VMx': 'running', 'VM1': 'shut off'}), \
+                mock.patch.object(VIRTDUP, 'check_space', return_value=[]), \
+                mock.patch.object(VIRTDUP, 'dump_vm_domxmls', return_value={}), \
+                mock.patch.object(VIRTDUP, 'is_qcow2', return_value=True), \
+                mock.patch.object(VIRTDUP, 'ensure_nbd_module', side_effect=AssertionError):
+            with self.assertRaises(VIRTDUP.VirtDupError) as ctx:
+                VIRTDUP.preflight(args, 'VMx', org_domxml)
+            self.assertIn("can't load the nbd module", str(ctx.exception))
+
+            VIRTDUP.ensure_nbd_module.side_effect = None
+            with mock.patch.object(VIRTDUP.glob, 'glob', return_value=[]):
+                with self.assertRaises(VIRTDUP.VirtDupError) as ctx:
+                    VIRTDUP.preflight(args, 'VMx', org_domxml)
+            self.assertIn('0 free NBD devices, 1 required', str(ctx.exception))
+
+            with mock.patch.object(VIRTDUP.glob, 'glob', return_value=['nbd0']), \
+                    mock.patch.object(VIRTDUP, 'nbd_in_use', return_value=False):
+                plan = VIRTDUP.preflight(args, 'VMx', org_domxml)
+        self.assertEqual(plan['source_state'], 'running')
+        self.assertEqual(dict(plan['targets']),
+                         {'VM1': (None, 'shut off'), 'VM2': (None, None)})
+
+    def test_worst_case_bytes(self):
+        'docstring'
+        self.assertEqual(VIRTDUP.worst_case_bytes('reflink', ['a', 'b'], 3),
+                         6 * VIRTDUP.REFLINK_OVERHEAD)
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(b'x' * 8192)
+            file.flush()
+            self.assertGreaterEqual(
+                VIRTDUP.worst_case_bytes('copy', [file.name], 2), 2 * 8192)
+
+
+class DedupeTestCase(unittest.TestCase):
+    'docstring'
+
+    def test_dedupe_clone(self):
+        'docstring'
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(__file__)) as tmp:
+            golden, clone = os.path.join(tmp, 'VMx.img'), os.path.join(tmp, 'VM1.img')
+            blocks = [os.urandom(65536) for _i in range(8)]
+            with open(golden, 'wb') as file:
+                file.write(b''.join(blocks))
+            # the same offsets, a customized block, and a block moved
+            with open(clone, 'wb') as file:
+                file.write(b''.join(blocks[:6]) + os.urandom(65536) + blocks[2])
+            calls = []
+
+            def dedupe_range(src_fd, src_offset, dst_fd, dst_offset, length):
+                calls.append((src_offset, dst_offset, length))
+                same = (os.pread(src_fd, length, src_offset) ==
+                        os.pread(dst_fd, length, dst_offset))
+                return length if same else 0
+
+            deduper = VIRTDUP.Deduper(golden, jobs=2)
+            with mock.patch.object(VIRTDUP, 'dedupe_range', dedupe_range):
+                scanned, deduped, _reclaimed = deduper.dedupe(clone)
+            # one call for the run of 6 blocks at the same offsets
+            self.assertEqual(sorted(calls), [(0, 0, 6 * 65536),
+                                             (2 * 65536, 7 * 65536, 65536)])
+            self.assertEqual(len(deduper.index), 8)
+            self.assertEqual(scanned, 8 * 65536)
+            self.assertEqual(deduped, 7 * 65536)
+            with open(clone, 'rb') as file:
+                self.assertEqual(file.read()[-65536:], blocks[2])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -16,8 +16,42 @@ import logging
 import ipaddress
 import configparser
 import shlex
+import fcntl
+import signal
+import contextlib
+import fnmatch
+import struct
+import ctypes
+import pickle
+import importlib
+import functools
+import concurrent.futures
+import collections
+import socket
+import xml.etree.ElementTree as ET
+import hashlib
+import platform
+import io
+import sqlite3
+import json
+import queue
+import threading
 from subprocess import check_output
 
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+POOL_DIR = '/var/lib/virt-dup/pools'
+INVENTORY_PATH = '/var/lib/virt-dup/inventory.db'
+# the identity of the source image a clone image is copied from
+XATTR_SOURCE = 'user.virt-dup.source'
+
+
+class VirtDupError(Exception):
+    'the invalid options, or the environment is not good enough'
+
 def f_sync(filename):
     with open(filename, 'r+') as f:
         f.flush()
@@ -73,8 +107,112 @@ def run_cmd(cmd, shell=True):
     return cli.returncode, out, err
 
 
-def generate_new_domxml(org_vm_name, org_domxml, new_vm_name):
-    'Manipulate name, uuid, mac, source files'
+class EventStream():
+    '''
+    The machine-readable progress for job runners, one JSON object per line,
+    per state transition of a clone. emit() never blocks the worker threads,
+    the lines are written by a daemon thread. In a forked child, eg. the
+    mount namespace, the writer thread doesn't exist, emit() writes at once.
+
+    Args:
+        target (str): a file descriptor number, or a file to append to
+    '''
+
+    def __init__(self, target):
+        if target.isdigit():
+            self.fd = int(target)
+            self.owned = False
+        else:
+            self.fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.owned = True
+        self.sync = False
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._writer, name='virt-dup-events',
+                                       daemon=True)
+        self.thread.start()
+
+    def _write(self, line):
+        data = line.encode('utf-8')
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def _writer(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                return
+            try:
+                self._write(line)
+            except OSError as err:
+                logging.getLogger().warning('--events: %s, no more events', err)
+                return
+
+    def after_fork_in_child(self):
+        'the writer thread is gone in the child, write synchronously'
+        self.sync = True
+        self.queue = None
+
+    def emit(self, phase, target, **fields):
+        'docstring'
+        event = dict(ts=round(time.time(), 6), target=target, phase=phase)
+        event.update((k, v) for k, v in fields.items() if v is not None)
+        line = json.dumps(event) + '\n'
+        if self.sync:
+            self._write(line)
+        else:
+            self.queue.put(line)
+
+    def close(self):
+        'flush the pending events'
+        if not self.sync:
+            self.queue.put(None)
+            self.thread.join()
+        if self.owned:
+            os.close(self.fd)
+
+
+EVENTS = None
+
+
+def _events_after_fork_in_child():
+    if EVENTS is not None:
+        EVENTS.after_fork_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_events_after_fork_in_child)
+
+
+def open_events(target):
+    'start the module-wide EventStream of --events'
+    global EVENTS
+    if EVENTS is None and target is not None:
+        EVENTS = EventStream(target)
+    return EVENTS
+
+
+def close_events():
+    'docstring'
+    global EVENTS
+    if EVENTS is not None:
+        EVENTS.close()
+        EVENTS = None
+
+
+def emit_event(phase, target, **fields):
+    '''
+    Emit a --events record, eg. emit_event('copy_done', 'VM1', duration=1.2,
+    bytes=n). A no-op without --events.
+    '''
+    if EVENTS is not None:
+        EVENTS.emit(phase, target, **fields)
+
+
+def generate_new_domxml(org_vm_name, org_domxml, new_vm_name, used_macs=None):
+    '''Manipulate name, uuid, mac, source files
+
+    used_macs (set, optional): MACs to avoid, the new ones are added to it
+    '''
 
     logger = logging.getLogger()
 
@@ -96,8 +234,13 @@ def generate_new_domxml(org_vm_name, org_domxml, new_vm_name):
 
     # 3. to change MAC address
     for mac in re_mac.findall(new_domxml):
-        macaddr_random = '52:54:00:'+':'.join(['%02x' % x for x in map(
-            lambda x: random.randint(0, 255), range(3))])
+        while True:
+            macaddr_random = '52:54:00:'+':'.join(['%02x' % x for x in map(
+                lambda x: random.randint(0, 255), range(3))])
+            if used_macs is None or macaddr_random not in used_macs:
+                break
+        if used_macs is not None:
+            used_macs.add(macaddr_random)
         new_domxml = re.sub(mac, "<mac address='%s'/>"%
                             macaddr_random, new_domxml)
 
@@ -115,6 +258,16 @@ def generate_new_domxml(org_vm_name, org_domxml, new_vm_name):
     return new_domxml
 
 
+def add_inventory_arguments(ap1):
+    '--inventory and --no-inventory, shared by the subcommands'
+    ap1.add_argument('--inventory', dest='inventory', metavar='PATH',
+                     default=INVENTORY_PATH,
+                     help="the SQLite inventory of the duplicated VMs. "
+                          "Defaults to " + INVENTORY_PATH)
+    ap1.add_argument('--no-inventory', dest='inventory', action='store_const',
+                     const=None, help="don't read or record the inventory")
+
+
 def cli_parser():
     'docstring'
     
@@ -146,12 +299,55 @@ To create 3 virtual machines, which has its own unique ip from 101 to 103
 virt-dup VMx VM{1..3} --set-ip-cidr 2001:db8:dead:beef::101
 virt-dup VMx VM{1..3} --set-ip-cidr 192.168.151.101/16
 
+To pick the free IPs of a range, the ones used by the host /etc/hosts, ARP
+neighbours, libvirt DHCP leases and static hosts are skipped
+virt-dup VMx VM{1..3} --set-ip-cidr 192.168.151.101-192.168.151.199/24
+
+To resolve the new VMs by name on the host, once for the whole batch
+virt-dup VMx VM{1..3} --set-ip-cidr 192.168.122.101/24 --register-net default
+
+To spread the new VMs across the hosts sharing the image storage
+virt-dup VMx VM{1..6} --connect qemu+ssh://host1/system qemu+ssh://host2/system
+
 Use the following example with care!
 virt-dup VMx VMy --change-ip str1,str2 192.168.150,192.168.151
 
 To rename the virtual machine only
 virt-dup VMx VMy --change-ip no
 
+To keep 4 spare clones of VMx ready, and hand out one of them instantly
+virt-dup pool VMx ci --size 4
+virt-dup take ci VM1 --set-ip-cidr 192.168.151.101/16
+
+To start the new VMs in adaptive waves, and measure their time-to-ready
+virt-dup VMx VM{1..64} --set-ip-cidr 192.168.151.101/16 --start 8
+
+To follow a large batch from a job runner, one JSON object per line
+virt-dup VMx VM{1..500} --events 3 3>&1 >/dev/null | jq -c .
+
+To reset the machine-id and SSH host keys while the rootfs is mounted anyway
+virt-dup VMx VM{1..3} --hook /usr/local/lib/virt-dup/reset-ids.sh
+
+To copy without reflink during business hours, within an I/O budget
+virt-dup VMx VM{1..8} --copy-bw 200M --copy-iops 2000 --ionice idle
+
+To check a large batch, its free space, NBDs, IPs and names, only
+virt-dup VMx VM{1..64} --set-ip-cidr 192.168.151.101-192.168.151.199/24 --dry-run
+
+To duplicate the golden VM while it keeps running
+virt-dup VMx VM{1..3} --live
+
+To bring the existing VMs up to date after VMx is updated, cheaply
+virt-dup VMx VM{1..3} --refresh
+
+To tear down clones with their own images, and to find orphaned images
+virt-dup rm 'VM[0-9]*' --dry-run
+virt-dup rm 'VM[0-9]*'
+virt-dup gc --delete
+
+To share the blocks of clones copied without reflink with VMx again
+virt-dup dedupe /var/lib/libvirt/images/VMx.qcow2 /var/lib/libvirt/images/VM{1..3}.qcow2
+
     """
     
     
@@ -164,10 +360,200 @@ virt-dup VMx VMy --change-ip no
                      action='store_true')
     ap1.add_argument('--set-ip-cidr', dest='set_ip_cidr',
                      metavar='CIDR', nargs=1,
-                     help="add IP_CIDR to the first NIC")
+                     help="add IP_CIDR to the first NIC. FIRST-LAST/PREFIX "
+                          "limits the range")
+    ap1.add_argument('--no-ip-check', dest='ip_check', action='store_false',
+                     help="don't skip the IPs in use for --set-ip-cidr")
     ap1.add_argument('--change-ip', dest='change_ip',
                      metavar='from,to', nargs='+',
                      help="string replace of IP is handy. 'no' means don't touch IP addr")
+    ap1.add_argument('--register-hosts', dest='register_hosts',
+                     action='store_true',
+                     help="add 'IP VM_NAME' of --set-ip-cidr to the host "
+                          "/etc/hosts after all VMs are done")
+    ap1.add_argument('--register-net', dest='register_net', metavar='NETWORK',
+                     help="add the DHCP and DNS host entries of --set-ip-cidr "
+                          "to the libvirt NETWORK after all VMs are done")
+    ap1.add_argument('--refresh', dest='refresh', action='store_true',
+                     help="keep the existing VMs, their UUID and MACs, only "
+                          "copy and customize again the images whose source "
+                          "changed, by the size and mtime stamped on the "
+                          "copy. The refreshed VMs keep their IPs of "
+                          "--set-ip-cidr. The images of a running --live "
+                          "source change all the time, they are copied again "
+                          "on every run")
+    ap1.add_argument('--live', dest='live', action='store_true',
+                     help="duplicate a running VM consistently: freeze its "
+                          "filesystems just to reflink the images, or take a "
+                          "disk-only snapshot merged back afterwards")
+    ap1.add_argument('--copy-bw', dest='copy_bw', metavar='RATE', type=parse_size,
+                     help="limit the real copies, when reflink isn't possible, "
+                          "to RATE bytes/s in total, eg. 200M")
+    ap1.add_argument('--copy-iops', dest='copy_iops', metavar='N', type=int,
+                     help="limit the real copies to N copy chunks per second "
+                          "in total, a chunk is up to 1 MiB read and written")
+    ap1.add_argument('--copy-max-in-flight', dest='copy_max_in_flight',
+                     metavar='N', type=int, default=32,
+                     help="pause the real copies while the queue of the image "
+                          "device is deeper than N")
+    ap1.add_argument('--ionice', dest='ioprio', choices=sorted(IOPRIO_CLASSES),
+                     help="the I/O priority class of the real copies")
+    ap1.add_argument('--numa-spread', dest='numa_spread', action='store_true',
+                     help="pin the vCPUs, emulator and memory of each new VM "
+                          "to the least loaded NUMA node and CPUs of the host")
+    ap1.add_argument('--start', dest='start', metavar='N', type=int,
+                     nargs='?', const=4, default=None,
+                     help="start the new VMs, N booting at once at first, "
+                          "adapted to their time-to-ready. Defaults to 4")
+    ap1.add_argument('--start-timeout', dest='start_timeout', metavar='SECONDS',
+                     type=int, default=300,
+                     help="time for a started VM to get ready")
+    ap1.add_argument('--ready-probe', dest='ready_probe',
+                     choices=['auto', 'tcp', 'agent', 'lease'], default='auto',
+                     help="how to tell a VM is ready: ssh port of the IP, "
+                          "qemu-guest-agent ping, or DHCP lease")
+    ap1.add_argument('--hook', dest='hook', metavar='HOOK', action='append',
+                     help="customize the mounted rootfs further, in the same "
+                          "attach: an executable, run as `HOOK SYSROOT_ETC "
+                          "VM_NAME IP_CIDR MACS`, 'module:function', or a "
+                          "'virt_dup.hooks' entry point. Repeatable")
+    ap1.add_argument('--dry-run', dest='dry_run', action='store_true',
+                     help="only check the batch and print the plan")
+    ap1.add_argument('--no-mount-ns', dest='mount_ns', action='store_false',
+                     help="mount the images in the host mount namespace, "
+                          "rather than a private one per image")
+    ap1.add_argument('-c', '--connect', dest='connect', metavar='URI',
+                     nargs='+',
+                     help="spread the new VMs across the libvirt hosts, which "
+                          "share the image storage, eg. ocfs2")
+    ap1.add_argument('--placement', dest='placement',
+                     choices=['round-robin', 'least-loaded'],
+                     default='round-robin',
+                     help="how to pick the host of --connect for each new VM, "
+                          "least-loaded by the allocated share of vCPUs and memory")
+    ap1.add_argument('--events', dest='events', metavar='FD|FILE',
+                     help="write the state transitions of each clone as JSON "
+                          "Lines to the file descriptor or file")
+    add_inventory_arguments(ap1)
+    return ap1
+
+
+def cli_parser_pool():
+    'virt-dup pool GOLDEN_VM POOL --size N'
+    ap1 = argparse.ArgumentParser(
+        prog='virt-dup pool',
+        description="Fill POOL up to N spare clones of GOLDEN_VM. The spares are "
+                    "copied, customized with their own MACs and the placeholder "
+                    "hostname 'POOL-spareX', defined but not started.")
+    ap1.add_argument('golden_vm', metavar='GOLDEN_VM', type=str,
+                     help='The original VM must exist in `virsh list --all`')
+    ap1.add_argument('pool', metavar='POOL', type=str)
+    ap1.add_argument('--size', dest='size', type=int, default=None,
+                     help="number of spare clones to keep. Defaults to the last "
+                          "size of the pool, or 1")
+    add_inventory_arguments(ap1)
+    ap1.add_argument('-v', '--verbose', '-d', '--debug',
+                     action='store_true')
+    return ap1
+
+
+def cli_parser_take():
+    'virt-dup take POOL VM_NAME'
+    ap1 = argparse.ArgumentParser(
+        prog='virt-dup take',
+        description="Rename a spare clone of POOL to VM_NAME, apply the hostname "
+                    "and IP delta, and refill POOL in the background.")
+    ap1.add_argument('pool', metavar='POOL', type=str)
+    ap1.add_argument('name', metavar='VM_NAME', type=str)
+    ap1.add_argument('--set-ip-cidr', dest='set_ip_cidr',
+                     metavar='CIDR', nargs=1,
+                     help="add IP_CIDR to the first NIC. FIRST-LAST/PREFIX "
+                          "limits the range")
+    ap1.add_argument('--no-ip-check', dest='ip_check', action='store_false',
+                     help="don't skip the IPs in use for --set-ip-cidr")
+    ap1.add_argument('--hook', dest='hook', metavar='HOOK', action='append',
+                     help="customize the mounted rootfs further, in the same "
+                          "attach: an executable, run as `HOOK SYSROOT_ETC "
+                          "VM_NAME IP_CIDR MACS`, 'module:function', or a "
+                          "'virt_dup.hooks' entry point. Repeatable")
+    ap1.add_argument('--no-refill', dest='refill', action='store_false',
+                     help="don't refill the pool in the background")
+    add_inventory_arguments(ap1)
+    ap1.add_argument('-v', '--verbose', '-d', '--debug',
+                     action='store_true')
+    ap1.set_defaults(change_ip=None, reset_mac=False)
+    return ap1
+
+
+def cli_parser_rm():
+    'virt-dup rm PATTERN...'
+    ap1 = argparse.ArgumentParser(
+        prog='virt-dup rm',
+        description="Destroy, undefine VMs matching the name globs in parallel, "
+                    "and delete their own image files. Images used by any "
+                    "other VM are never deleted. The golden VMs, ie. the "
+                    "source of clones or pools, and the VMs whose images "
+                    "aren't stamped by virt-dup are skipped, unless --force.")
+    ap1.add_argument('patterns', metavar='PATTERN', type=str, nargs='+',
+                     help="VM name glob, eg. 'VM*'")
+    ap1.add_argument('-j', '--jobs', dest='jobs', type=int, default=8,
+                     help="number of VMs to tear down in parallel")
+    ap1.add_argument('--keep-images', dest='keep_images', action='store_true',
+                     help="don't delete image files")
+    ap1.add_argument('--force', dest='force', action='store_true',
+                     help="tear down the golden VMs and the VMs not duplicated "
+                          "by virt-dup as well")
+    ap1.add_argument('--dry-run', dest='dry_run', action='store_true',
+                     help="only list the VMs to tear down")
+    add_inventory_arguments(ap1)
+    ap1.add_argument('-v', '--verbose', '-d', '--debug',
+                     action='store_true')
+    return ap1
+
+
+def cli_parser_gc():
+    'virt-dup gc [DIR...]'
+    ap1 = argparse.ArgumentParser(
+        prog='virt-dup gc',
+        description="List the image files of VMs duplicated by virt-dup, which "
+                    "no defined VM uses, in the image directories of all VMs "
+                    "and DIRs. Only the images recorded in the inventory or "
+                    "stamped by virt-dup are considered.")
+    ap1.add_argument('dirs', metavar='DIR', type=str, nargs='*',
+                     help="additional directories to scan")
+    ap1.add_argument('--delete', dest='delete', action='store_true',
+                     help="delete the orphaned image files")
+    add_inventory_arguments(ap1)
+    ap1.add_argument('-v', '--verbose', '-d', '--debug',
+                     action='store_true')
+    return ap1
+
+
+def cli_parser_dedupe():
+    'virt-dup dedupe GOLDEN CLONE...'
+    ap1 = argparse.ArgumentParser(
+        prog='virt-dup dedupe',
+        description="Share the identical blocks of the CLONE images with the "
+                    "GOLDEN image again, by the FIDEDUPERANGE ioctl, eg. for "
+                    "the clones copied without reflink. The kernel compares "
+                    "the blocks before sharing them, the content never changes.")
+    ap1.add_argument('golden', metavar='GOLDEN', type=str,
+                     help="the golden image file")
+    ap1.add_argument('clones', metavar='CLONE', type=str, nargs='+',
+                     help="the image files copied from GOLDEN")
+    ap1.add_argument('--block-size', dest='block_size', metavar='SIZE',
+                     type=parse_size, default=64 << 10,
+                     help="the unit to compare and share, a multiple of the "
+                          "filesystem block size. Defaults to 64K, the qcow2 "
+                          "cluster size")
+    ap1.add_argument('--index-memory', dest='index_memory', metavar='SIZE',
+                     type=parse_size, default=256 << 20,
+                     help="the memory for the hashes of the GOLDEN blocks, to "
+                          "share the blocks at other offsets. Defaults to 256M")
+    ap1.add_argument('-j', '--jobs', dest='jobs', type=int, default=4,
+                     help="number of segments read in parallel")
+    ap1.add_argument('-v', '--verbose', '-d', '--debug',
+                     action='store_true')
     return ap1
 
 
@@ -178,39 +564,593 @@ def ensure_cli_env_is_root():
         sys.exit(-1)
 
 
-def knl_version_cmp(ver1, ver2):
-    'kernel version comparison'
-    def normalize(ver):
-        return [int(x) for x in re.sub(r'(\.0+)*$', '', ver).split('.')]
-    return normalize(ver1) > normalize(ver2)
+# host facts, read from /proc, /sys, the udev database and the devices
+# directly rather than by spawning lsblk, blockdev, file, ps and modprobe
+
+BLKGETSIZE64 = 0x80081272
+QCOW2_MAGIC = b'QFI\xfb'
+
+# (offset, magic, fstype) of the superblocks, as blkid probes them
+FS_MAGICS = [
+    (0x10040, b'_BHRfS_M', 'btrfs'),
+    (0, b'XFSB', 'xfs'),
+    (0x438, b'\x53\xef', 'ext4'),
+]
+
+# never reflink, don't even try `cp --reflink=always`
+NO_REFLINK_FSTYPES = ('ext2', 'ext3', 'ext4', 'tmpfs', 'vfat', 'exfat', 'ntfs3')
+
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_SHARED = 0x2000
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQI12x')
+
+
+def fiemap_usage(path, batch=512):
+    '''
+    The (shared, exclusive) bytes of the extents of path, by the FIEMAP
+    ioctl. Shared extents are reflinked with other files, eg. the source
+    image and the other clones.
+
+    Raises:
+        OSError: if the filesystem doesn't support FIEMAP
+    '''
+    shared = exclusive = 0
+    start, flags = 0, FIEMAP_FLAG_SYNC
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while True:
+            buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size * batch)
+            FIEMAP_HEADER.pack_into(buf, 0, start, 2**64 - 1 - start, flags, 0, batch, 0)
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+            mapped = FIEMAP_HEADER.unpack_from(buf, 0)[3]
+            if mapped == 0:
+                break
+            last = False
+            for idx in range(mapped):
+                logical, _phys, length, _r1, _r2, fe_flags = FIEMAP_EXTENT.unpack_from(
+                    buf, FIEMAP_HEADER.size + FIEMAP_EXTENT.size * idx)
+                if fe_flags & FIEMAP_EXTENT_SHARED:
+                    shared += length
+                else:
+                    exclusive += length
+                start = logical + length
+                last = bool(fe_flags & FIEMAP_EXTENT_LAST)
+            if last:
+                break
+            flags = 0
+    finally:
+        os.close(fd)
+    return shared, exclusive
+
+
+def account_storage(result):
+    '''
+    Sum up the shared and exclusive bytes of the images of the clone, see
+    fiemap_usage(). The exclusive bytes are the real storage cost of it.
+    '''
+    logger = logging.getLogger()
+    try:
+        usage = [fiemap_usage(img) for img in result.images]
+    except OSError as err:
+        logger.debug('no FIEMAP accounting for %s: %s', result.name, err)
+        return
+    result.shared_bytes = sum(shared for shared, _e in usage)
+    result.exclusive_bytes = sum(exclusive for _s, exclusive in usage)
+    logger.info("vm '%s' uses %.1f MiB exclusive, %.1f MiB shared", result.name,
+                result.exclusive_bytes / 2**20, result.shared_bytes / 2**20)
+
+
+def read_mountinfo(path='/proc/self/mountinfo'):
+    'list of (mountpoint, fstype, source) of the mount namespace'
+    mounts = []
+    with open(path) as file:
+        for line in file:
+            pre, _sep, post = line.partition(' - ')
+            fields, post = pre.split(), post.split()
+            if len(fields) < 5 or len(post) < 2:
+                continue
+            mpoint = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                            fields[4])
+            mounts.append((mpoint, post[0], post[1]))
+    return mounts
+
+
+def path_fstype(path, mountinfo='/proc/self/mountinfo'):
+    'the fstype of the filesystem path is on, by the longest mountpoint'
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    for mpoint, mfstype, _source in read_mountinfo(mountinfo):
+        if (path == mpoint or path.startswith(mpoint.rstrip('/') + '/')) and \
+                len(mpoint) >= len(best):
+            best, fstype = mpoint, mfstype
+    return fstype
+
+
+@functools.lru_cache(maxsize=None)
+def dir_fstype(directory):
+    'path_fstype() of an image directory, which is not remounted during a run'
+    return path_fstype(directory)
+
+
+def blockdev_size(dev):
+    'the size in bytes of the block device, by the BLKGETSIZE64 ioctl'
+    fd = os.open(dev, os.O_RDONLY)
+    try:
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, b'\0' * 8)
+    finally:
+        os.close(fd)
+    return struct.unpack('Q', buf)[0]
+
+
+def probe_fstype(dev):
+    'the fstype of dev by its superblock magic, None if unknown'
+    dev = dev if dev.startswith('/') else '/dev/' + dev
+    with open(dev, 'rb') as file:
+        for offset, magic, fstype in FS_MAGICS:
+            file.seek(offset)
+            if file.read(len(magic)) == magic:
+                return fstype
+    return None
+
+
+def is_qcow2(img_file):
+    'docstring'
+    with open(img_file, 'rb') as file:
+        return file.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_nbd_module(sysfs='/sys'):
+    'load nbd once per run, unless it is loaded already'
+    if not os.path.isdir(sysfs + '/module/nbd'):
+        assert check_output('modprobe nbd max_part=8'.split()) == b''
+    return True
+
+
+def nbd_in_use(nbd, sysfs='/sys'):
+    'an NBD device is connected as long as its server pid is there'
+    return os.path.exists('{}/block/{}/pid'.format(sysfs, os.path.basename(nbd)))
+
+
+def free_nbd_device(sysfs='/sys'):
+    'the first NBD device not connected, or None'
+    nbds = [os.path.basename(path) for path in glob.glob(sysfs + '/block/nbd*')]
+    for nbd in sorted(nbds, key=lambda name: int(name[3:])):
+        if not nbd_in_use(nbd, sysfs):
+            return '/dev/' + nbd
+    return None
+
+
+def udev_decode(value):
+    'the udev \\xNN escapes of the database'
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
+
+
+def read_udev_properties(name, sysfs='/sys', udev_data='/run/udev/data'):
+    'the E: properties of the udev database for the block device, {} if none'
+    try:
+        with open('{}/class/block/{}/dev'.format(sysfs, name)) as file:
+            majmin = file.read().strip()
+        with open('{}/b{}'.format(udev_data, majmin)) as file:
+            lines = file.read().splitlines()
+    except OSError:
+        return {}
+    return dict(line[2:].split('=', 1) for line in lines
+                if line.startswith('E:') and '=' in line)
+
+
+FICLONE = 0x40049409
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO_SET = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'ppc64le': 273,
+                  's390x': 282}
+SYS_IOPRIO_GET = {'x86_64': 252, 'i686': 290, 'aarch64': 31, 'ppc64le': 274,
+                  's390x': 283}
+
+
+def parse_size(spec):
+    'eg. 200M, 1.5G, 4096 bytes'
+    ret = re.match(r'^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$', spec, re.I)
+    if ret is None:
+        raise ValueError('invalid size: {}'.format(spec))
+    return int(float(ret.group(1)) * 1024 ** ' KMGT'.index(ret.group(2).upper() or ' '))
+
+
+def ioprio_syscall(table, *args):
+    'ioprio_get/ioprio_set of the calling thread, None if it fails'
+    nr = table.get(platform.machine())
+    if nr is None:
+        logging.getLogger().warning('ioprio syscalls are unknown on %s',
+                                    platform.machine())
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+    ret = libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, *args)
+    if ret < 0:
+        err = ctypes.get_errno()
+        logging.getLogger().warning('ioprio syscall %d: %s', nr, os.strerror(err))
+        return None
+    return ret
+
+
+def set_ioprio(ioprio_class, level=4):
+    '''
+    Set the I/O priority of the calling thread, as `ionice -c`. Linux
+    applies the priority of IOPRIO_WHO_PROCESS 0 to the calling thread only.
+
+    Returns:
+        int: the previous priority for restore_ioprio(), None if unknown
+    '''
+    previous = ioprio_syscall(SYS_IOPRIO_GET)
+    level = 0 if ioprio_class == 'idle' else level
+    if ioprio_syscall(SYS_IOPRIO_SET, (IOPRIO_CLASSES[ioprio_class] << 13) | level) is None:
+        return None
+    return previous
+
+
+def restore_ioprio(previous):
+    'set the I/O priority of the calling thread back, see set_ioprio()'
+    if previous is not None:
+        ioprio_syscall(SYS_IOPRIO_SET, previous)
+
+
+def block_stat_path(path, sysfs='/sys'):
+    'the /sys/dev/block/MAJ:MIN/stat of the device of path, None if virtual'
+    dev = os.stat(path).st_dev
+    stat = '{}/dev/block/{}:{}/stat'.format(sysfs, os.major(dev), os.minor(dev))
+    return stat if os.path.exists(stat) else None
+
+
+def read_in_flight(stat_path):
+    'the I/Os in flight of the device, the 9th field of its stat'
+    with open(stat_path) as file:
+        return int(file.read().split()[8])
 
 
-def cp_reflink_img(org_img_file, new_img_file):
-    'duplicate the image files with --reflink capability'
+class IoThrottle():
+    '''
+    The token buckets of the bytes/s and IOPS budget, shared by all copies
+    of a batch, thread safe. acquire() also backs off while the queue of
+    the destination device is deeper than max_in_flight. An I/O is one
+    acquire(), ie. one copy chunk of throttled_copy(), 1 MiB at most, not
+    the requests the device sees.
+
+    Args:
+        bps (int, optional): bytes per second, None means unlimited
+        iops (int, optional): I/Os per second, None means unlimited
+        stat_path (str, optional): /sys/.../stat of the destination device
+        max_in_flight (int, optional): the queue depth to back off at
+    '''
+
+    def __init__(self, bps=None, iops=None, stat_path=None, max_in_flight=32):
+        self.bps = bps
+        self.iops = iops
+        self.stat_path = stat_path
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        # a second of burst at most
+        self.byte_tokens = float(bps or 0)
+        self.io_tokens = float(iops or 0)
+        self.last = time.monotonic()
+        self.backoff = 0.0
+
+    @classmethod
+    def from_args(cls, args, directory):
+        'the throttle of --copy-bw, --copy-iops, None if neither is given'
+        bps, iops = getattr(args, 'copy_bw', None), getattr(args, 'copy_iops', None)
+        if bps is None and iops is None:
+            return None
+        return cls(bps, iops, block_stat_path(directory),
+                   getattr(args, 'copy_max_in_flight', 32))
+
+    def _refill(self, now):
+        elapsed, self.last = now - self.last, now
+        if self.bps:
+            self.byte_tokens = min(self.bps, self.byte_tokens + elapsed * self.bps)
+        if self.iops:
+            self.io_tokens = min(self.iops, self.io_tokens + elapsed * self.iops)
+
+    def _congested(self):
+        if self.stat_path is None:
+            return False
+        try:
+            return read_in_flight(self.stat_path) > self.max_in_flight
+        except (OSError, IndexError, ValueError):
+            return False
+
+    def acquire(self, nbytes):
+        'block until nbytes in one I/O fit in the budget'
+        while True:
+            if self._congested():
+                self.backoff = min(1.0, max(0.01, self.backoff * 2))
+                time.sleep(self.backoff)
+                continue
+            self.backoff /= 2
+            with self.lock:
+                self._refill(time.monotonic())
+                byte_wait = io_wait = 0.0
+                if self.bps and self.byte_tokens < min(nbytes, self.bps):
+                    byte_wait = (min(nbytes, self.bps) - self.byte_tokens) / self.bps
+                if self.iops and self.io_tokens < 1:
+                    io_wait = (1 - self.io_tokens) / self.iops
+                if byte_wait == 0 and io_wait == 0:
+                    if self.bps:
+                        self.byte_tokens -= nbytes
+                    if self.iops:
+                        self.io_tokens -= 1
+                    return
+            time.sleep(max(byte_wait, io_wait))
+
+
+def data_segments(fd, size):
+    'the (offset, length) of the data of a sparse file, by SEEK_DATA/SEEK_HOLE'
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError:
+            # ENXIO: only a hole up to the end
+            return
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def throttled_copy(org_img_file, new_img_file, throttle, ioprio=None,
+                   target=None, chunk=1 << 20):
+    '''
+    Reflink by the FICLONE ioctl, or copy the data within the budget of the
+    throttle, holes are kept. Return 'reflink' or 'copy'. The I/O priority
+    of the calling thread is ioprio during the copy only.
+    '''
+    previous = set_ioprio(ioprio) if ioprio is not None else None
+    try:
+        return _throttled_copy(org_img_file, new_img_file, throttle, target, chunk)
+    finally:
+        restore_ioprio(previous)
+
+
+def _throttled_copy(org_img_file, new_img_file, throttle, target, chunk):
+    logger = logging.getLogger()
+    src = os.open(org_img_file, os.O_RDONLY)
+    try:
+        dst = os.open(new_img_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            # the mode of the source, as `cp` keeps it
+            os.fchmod(dst, os.fstat(src).st_mode & 0o7777)
+            try:
+                fcntl.ioctl(dst, FICLONE, src)
+                return 'reflink'
+            except OSError:
+                logger.info('no reflink support fs, copying within the I/O budget...')
+            size = os.fstat(src).st_size
+            os.ftruncate(dst, size)
+            copied, reported = 0, time.time()
+            for offset, length in data_segments(src, size):
+                end = offset + length
+                while offset < end:
+                    nbytes = min(chunk, end - offset)
+                    throttle.acquire(nbytes)
+                    data = os.pread(src, nbytes, offset)
+                    if not data:
+                        break
+                    os.pwrite(dst, data, offset)
+                    offset += len(data)
+                    copied += len(data)
+                    if time.time() - reported >= 1:
+                        reported = time.time()
+                        emit_event('copy_progress', target, image=new_img_file,
+                                   bytes=copied)
+            return 'copy'
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+
+def cp_reflink_img(org_img_file, new_img_file, target=None, throttle=None,
+                   ioprio=None):
+    '''duplicate the image files with --reflink capability, fall back to the
+    real copy if the filesystem can't. Return 'reflink' or 'copy'
+
+    target (str, optional): the VM name of the copy_progress events
+    throttle (IoThrottle, optional): the I/O budget of the real copy, see
+                                     throttled_copy()
+    ioprio (str, optional): the I/O priority class of the real copy
+    '''
     logger = logging.getLogger()
     logger.debug("cp_reflink_img(): org = %s", org_img_file)
     logger.debug("cp_reflink_img(): new = %s", new_img_file)
 
-    out = check_output(['dirname', org_img_file]).strip()
-    logger.debug('cp_reflink_img(): dirname = %s', out.decode('utf-8'))
-    out = check_output(['df', '--output=fstype', out],
-                       universal_newlines=True).split('\n')
-    logger.debug(out)
-    assert len(out) == 3
-    logger.debug('cp_reflink_img(): fstype = %s', out[1])
+    if throttle is not None:
+        method = throttled_copy(org_img_file, new_img_file, throttle, ioprio, target)
+        f_sync(new_img_file)
+        return method
 
-    with open('/proc/version', 'r') as fd_proc_version:
-        knl_ver = fd_proc_version.read().split()[2].split('-')[0]
-    logger.debug('cp_reflink_img(): knl_version = %s', knl_ver)
-
-    if (out[1] == 'xfs' and knl_version_cmp(knl_ver, '4.16') < 0 and
-            out[1] not in ['ocfs2', 'btrfs']):
+    if dir_fstype(os.path.dirname(os.path.abspath(new_img_file))) in NO_REFLINK_FSTYPES:
+        ret = 1
+    else:
+        cmd = 'cp --reflink=always -f {} {}'.format(org_img_file, new_img_file)
+        logger.info(cmd)
+        ret, _o, _e = run_cmd(cmd.split(), shell=False)
+    method = 'reflink'
+    if ret:
         logger.info('no reflink support fs, copying might take time...')
-
-    cmd = 'cp --reflink=auto -f {} {}'.format(org_img_file, new_img_file)
-    logger.info(cmd)
-    check_output(cmd.split())
+        cmd = 'cp --reflink=auto -f {} {}'.format(org_img_file, new_img_file)
+        if ioprio is not None:
+            cmd = 'ionice -c {} '.format(IOPRIO_CLASSES[ioprio]) + cmd
+        logger.info(cmd)
+        proc = subprocess.Popen(cmd.split())
+        while True:
+            try:
+                proc.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                if EVENTS is not None and os.path.exists(new_img_file):
+                    emit_event('copy_progress', target, image=new_img_file,
+                               bytes=os.stat(new_img_file).st_blocks * 512)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        method = 'copy'
     f_sync(new_img_file)
+    return method
+
+
+def source_identity(org_img_file):
+    '''path, size and mtime of the source image, eg. /x/VMx.qcow2:1024:1700000000
+    A running source, see --live, is written to all the time, its identity
+    changes from run to run.
+    '''
+    st = os.stat(org_img_file)
+    return '{}:{}:{}'.format(os.path.realpath(org_img_file), st.st_size,
+                             st.st_mtime_ns)
+
+
+def stamp_source_identity(new_img_file, identity):
+    'remember which source the image is copied from, in its xattr'
+    try:
+        os.setxattr(new_img_file, XATTR_SOURCE, identity.encode('utf-8'))
+    except OSError as err:
+        logging.getLogger().debug('no xattr on %s: %s', new_img_file, err)
+
+
+def is_img_current(org_img_file, new_img_file):
+    '''True if new_img_file is copied from the current org_img_file. Only the
+    xattr stamp is authoritative, a clone without it is copied again.
+    '''
+    if not os.path.exists(new_img_file):
+        return False
+    try:
+        stamp = os.getxattr(new_img_file, XATTR_SOURCE).decode('utf-8')
+    except OSError:
+        return False
+    return stamp == source_identity(org_img_file)
+
+
+def parse_domblklist(out):
+    'the (target, source) of the file disks in `virsh domblklist --details`'
+    disks = []
+    for line in out.splitlines():
+        fields = line.split(None, 3)
+        if len(fields) == 4 and fields[0] == 'file' and fields[1] == 'disk':
+            disks.append((fields[2], fields[3]))
+    return disks
+
+
+class LiveSource():
+    '''
+    Stable images of a running source VM for the duration of a batch, see
+    --live. The images to duplicate are in self.images, {image: stable copy}.
+
+    The guest filesystems are frozen by `virsh domfsfreeze`, the images are
+    reflinked to hidden staging files next to them, and the guest is thawed
+    at once. If the guest agent or reflink isn't available, an external
+    disk-only snapshot is taken instead, the images are then stable as its
+    backing files, and on exit the overlays are committed back by
+    `virsh blockcommit --active --pivot`.
+
+    Args:
+        org_vm_name (str): the running source VM
+        images (list): the image files of it to duplicate
+    '''
+
+    def __init__(self, org_vm_name, images):
+        self.logger = logging.getLogger()
+        self.org_vm_name = org_vm_name
+        self.tag = 'virt-dup-live-{}'.format(os.getpid())
+        self.images = {img: img for img in images}
+        self.staging = []
+        self.overlays = []
+        self.freeze = None
+        self.method = None
+
+    def _staging_path(self, img):
+        return os.path.join(os.path.dirname(img),
+                            '.{}-{}'.format(self.tag, os.path.basename(img)))
+
+    def __enter__(self):
+        start = time.time()
+        ret, _o, err = run_cmd(['virsh', 'domfsfreeze', self.org_vm_name], shell=False)
+        if ret == 0:
+            try:
+                for img in self.images:
+                    staging = self._staging_path(img)
+                    self.staging.append(staging)
+                    cmd = ['cp', '--reflink=always', '-f', img, staging]
+                    ret, _o, _e = run_cmd(cmd, shell=False)
+                    if ret:
+                        break
+            finally:
+                run_cmd(['virsh', 'domfsthaw', self.org_vm_name], shell=False)
+            self.freeze = time.time() - start
+            if ret == 0:
+                self.images = dict(zip(self.images, self.staging))
+                self.method = 'freeze'
+                self.logger.info("'%s' was frozen for %.3fs to reflink %d images",
+                                 self.org_vm_name, self.freeze, len(self.staging))
+                return self
+            self.logger.info('no reflink support fs, take a disk-only snapshot')
+            self._remove_staging()
+            quiesce = True
+        else:
+            self.logger.warning("'%s' can't be frozen, the snapshot is only "
+                                "crash-consistent: %s", self.org_vm_name, err.strip())
+            quiesce = False
+
+        self._snapshot(quiesce)
+        return self
+
+    def _snapshot(self, quiesce):
+        out = check_output(['virsh', 'domblklist', self.org_vm_name, '--details'],
+                           universal_newlines=True)
+        cmd = ['virsh', 'snapshot-create-as', self.org_vm_name, self.tag,
+               '--disk-only', '--atomic', '--no-metadata']
+        if quiesce:
+            cmd.append('--quiesce')
+        overlays = []
+        for target, source in parse_domblklist(out):
+            if source in self.images:
+                overlay = self._staging_path(source)
+                cmd += ['--diskspec', '{},file={},driver=qcow2'.format(target, overlay)]
+                overlays.append((target, overlay))
+            else:
+                cmd += ['--diskspec', '{},snapshot=no'.format(target)]
+        start = time.time()
+        ret, _o, err = run_cmd(cmd, shell=False)
+        if ret:
+            raise VirtDupError("failed to snapshot '{}': {}".format(
+                self.org_vm_name, err.strip()))
+        self.freeze = time.time() - start
+        self.overlays = overlays
+        self.method = 'snapshot'
+        self.logger.info("'%s' was paused for %.3fs by the disk-only snapshot",
+                         self.org_vm_name, self.freeze)
+
+    def _remove_staging(self):
+        for staging in self.staging:
+            if os.path.exists(staging):
+                os.remove(staging)
+        self.staging = []
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._remove_staging()
+        for target, overlay in self.overlays:
+            cmd = ['virsh', 'blockcommit', self.org_vm_name, target,
+                   '--active', '--pivot', '--wait']
+            self.logger.info(' '.join(cmd))
+            ret, _o, err = run_cmd(cmd, shell=False)
+            if ret:
+                # never lose the writes of the source since the snapshot
+                self.logger.error("failed to commit '%s' back, keep it: %s",
+                                  overlay, err.strip())
+                continue
+            os.remove(overlay)
 
 
 class DevMntpoint(tempfile.TemporaryDirectory):
@@ -222,25 +1162,39 @@ class DevMntpoint(tempfile.TemporaryDirectory):
         prefix (str, optional): Prefix to use for the temporary directory.      
         suffix (str, optional): Suffix to use for the temporary directory.
         dev (str):              Device name under /dev/ to mount.
+        mount_opt (str, optional): eg. 'ro,norecovery' for a trial mount
+        btrfs_var (bool, optional): mount the btrfs '@/var' subvolume as well.
+                                Defaults to True
+        fstype (str, optional): Skip the fstype detection if known.
     '''
     has_btrfs_var = False
 
-    def __init__(self, suffix=None, prefix=None, dev=None):
+    def __init__(self, suffix=None, prefix=None, dev=None, mount_opt=None,
+                 btrfs_var=True, fstype=None):
         self.logger = logging.getLogger()
         if not os.path.exists('/dev/'+dev):
             self.logger.error("DevMntpoint 'dev=' args must be valid under '/dev'")
         self.dev = dev
+        self.mount_opt = mount_opt
+        self.btrfs_var = btrfs_var
+        self.fstype = fstype
         super().__init__(suffix, prefix)
 
     def __enter__(self):
         super().__enter__()
         cmd = 'mount /dev/' + self.dev + ' ' + self.name
+        if self.mount_opt:
+            cmd += ' -o ' + self.mount_opt
         self.logger.debug(cmd)
         lines = check_output(cmd.split(), universal_newlines=True).splitlines()
         self.logger.debug(cmd)
         self.logger.debug(lines)
             
-        if is_dev_btrfs(self.dev):
+        if self.fstype is not None:
+            is_btrfs = self.fstype == 'btrfs'
+        else:
+            is_btrfs = is_dev_btrfs(self.dev)
+        if self.btrfs_var and is_btrfs:
             self.logger.debug("'btrfs' is detected. Now try to detect and mount '@/var' subvolume as well")
             cmd = f'btrfs subvolume list {self.name}'
             lines = check_output(cmd.split(), universal_newlines=True).splitlines()
@@ -294,6 +1248,83 @@ class OverlayMntpoint(tempfile.TemporaryDirectory):
         super().__exit__(exc_type, exc_val, exc_tb)
 
 
+class MountSession():
+    '''
+    The mounts of one image. Each partition is mounted at most once, and the
+    mount is shared by the rootfs discovery and the editing. A trial mount is
+    upgraded only when the partition turns out to need a read-write mount:
+    remounted in place if it is a plain 'ro' mount, else mounted anew.
+    Upon exit, all mounts are torn down in one pass, in the reverse order.
+
+    Args:
+        suffix (str, optional): Suffix of the temporary mount directories.
+    '''
+
+    def __init__(self, suffix=None):
+        self.logger = logging.getLogger()
+        self.suffix = suffix
+        self.mounts = {}    # dev: (DevMntpoint, writable)
+        self.entered = []   # in the order of mounting
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        error = None
+        while self.entered:
+            mnt = self.entered.pop()
+            try:
+                mnt.__exit__(exc_type, exc_val, exc_tb)
+            except (subprocess.CalledProcessError, OSError) as err:
+                self.logger.error('failed to umount %s: %s', mnt.name, err)
+                error = error or err
+        self.mounts = {}
+        if error is not None and exc_type is None:
+            raise error
+
+    def _enter(self, mnt):
+        mpoint = mnt.__enter__()
+        self.entered.append(mnt)
+        return mpoint
+
+    def _exit(self, mnt):
+        self.entered.remove(mnt)
+        mnt.__exit__(None, None, None)
+
+    def mount(self, dev, fstype=None, writable=True):
+        '''
+        Mount dev, or reuse its mount. writable=False is a trial mount without
+        journal replay, see trial_mount_opt(). Return the mount point.
+        '''
+        if dev in self.mounts:
+            mnt, was_writable = self.mounts[dev]
+            if was_writable or not writable:
+                return mnt.name
+            self.logger.debug('upgrade the trial mount of %s', dev)
+            if mnt.mount_opt == 'ro':
+                cmd = 'mount -o remount,rw ' + mnt.name
+                self.logger.debug(cmd)
+                check_output(cmd.split())
+                self.mounts[dev] = (mnt, True)
+                return mnt.name
+            # norecovery and the like can't be remounted read-write
+            self._exit(mnt)
+
+        mnt = DevMntpoint(prefix="virt_dup_mnt_" if writable else "virt_dup_probe_",
+                          suffix='.'+self.suffix if self.suffix else None,
+                          dev=dev, fstype=fstype,
+                          mount_opt=None if writable else trial_mount_opt(fstype),
+                          btrfs_var=writable)
+        self.mounts[dev] = (mnt, writable)
+        return self._enter(mnt)
+
+    def overlay(self, mount_opt, prefix='virt_dup_etc_'):
+        'mount an overlayfs, it goes before its lower and upper dirs on exit'
+        return self._enter(OverlayMntpoint(
+            prefix=prefix, suffix='.'+self.suffix if self.suffix else None,
+            mount_opt=mount_opt))
+
+
 #def manipulate_rootfs_in_raw_img(img_file):
 #    'docstring'
 #    return
@@ -312,23 +1343,11 @@ class SpareNbdImgfile():
         self.img_file = img_file
 
         # find_unused_nbd_dev_node()
-        assert check_output('modprobe nbd max_part=8'.split()) == b''
-
-        try: 
-            cmd = 'ps -C qemu-nbd -o cmd='
-            self.logger.debug(cmd)
-            lsnbd = check_output(cmd.split()).decode('utf-8')
-        except subprocess.CalledProcessError:
-            lsnbd = ''
-            pass
-        self.logger.debug('lsnbd = %s', lsnbd)
-        lsnbd = re.sub(r'.*--connect=/dev/(nbd\d+) .*', r'\1', lsnbd)
-
-        for i in range(100):
-            if 'nbd{}'.format(i) not in lsnbd:
-                self.spare_nbd = '/dev/nbd'+str(i)
-                self.logger.debug('spare_nbd = %s', self.spare_nbd)
-                break
+        ensure_nbd_module()
+        self.spare_nbd = free_nbd_device()
+        if self.spare_nbd is None:
+            raise VirtDupError('no free NBD device')
+        self.logger.debug('spare_nbd = %s', self.spare_nbd)
 
     def __enter__(self):
         cmd = 'qemu-nbd --connect={} {}'.format(self.spare_nbd, self.img_file)
@@ -339,8 +1358,7 @@ class SpareNbdImgfile():
         count=10
         while (count > 0):
             count -= 1
-            _r, out, _e = run_cmd('blockdev --getsize64 ' + self.spare_nbd)
-            if int(out) >= 512: break
+            if blockdev_size(self.spare_nbd) >= 512: break
             else: time.sleep(1)
             # Tumbleweed kernel 5.16.2, weird, lsblk might not ready to use even after udevadm settle 
             self.logger.debug("wait for nbd server initialization, count = {}".format(count))
@@ -356,16 +1374,43 @@ class SpareNbdImgfile():
 
         # double confirm kernel data get cleaned up indeed
         ret, _o, _e = run_cmd('udevadm settle -t 10')
-        ret, _o, _e = run_cmd('lsblk ' + self.spare_nbd)
+        if nbd_in_use(self.spare_nbd):
+            self.logger.warning('%s is still connected', self.spare_nbd)
 
         f_sync(self.img_file)
 
-        assert ret == 32 or ret == 0
-
     def __repr__(self):
         return self.spare_nbd
 
 
+def write_if_changed(path, content):
+    '''
+    Write content to path, unless it is there already. Every write into a
+    reflinked image un-shares its blocks, an identical rewrite included.
+
+    Returns:
+        bool: True if written
+    '''
+    try:
+        with open(path, 'r') as file:
+            if file.read() == content:
+                logging.getLogger().debug('%s is unchanged, not written', path)
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    with open(path, 'w') as file:
+        file.write(content)
+        file.flush()
+    return True
+
+
+def config_to_str(config):
+    'the text of a ConfigParser, to be written by write_if_changed()'
+    buf = io.StringIO()
+    config.write(buf)
+    return buf.getvalue()
+
+
 def reset_hostname(sysroot_etc, new_vm_name):
     'docstring'
     logger = logging.getLogger()
@@ -378,24 +1423,20 @@ def reset_hostname(sysroot_etc, new_vm_name):
             ret = file.read().strip()
             old_hostname = ret
 
-    with open(sysroot_etc+'/hostname', 'w') as file:
-        file.write(new_vm_name)
-        file.flush()
-        logger.debug('reset '+new_vm_name+':'+file.name)
+    if write_if_changed(sysroot_etc+'/hostname', new_vm_name):
+        logger.debug('reset '+new_vm_name+':'+sysroot_etc+'/hostname')
         logger.info("reset /etc/hostname to '%s' from '%s'", new_vm_name, old_hostname)
 
-    if os.path.exists(sysroot_etc+'/hosts') and len(old_hostname) > 0:
+    if (os.path.exists(sysroot_etc+'/hosts') and old_hostname and
+            old_hostname != new_vm_name):
         with open(sysroot_etc+'/hosts', 'r') as file:
             old_hosts = file.read()
             logger.debug('old_hosts= %s', old_hosts)
 
         if bool(re.search(r'\s{}\s'.format(re.escape(old_hostname)), old_hosts)):
-            with open(sysroot_etc+'/hosts', 'w') as file:
-                new_hosts = old_hosts.replace(old_hostname, new_vm_name)
-                file.write(new_hosts)
-                file.flush()
-
-                logger.debug('reset '+new_vm_name+':'+file.name)
+            new_hosts = old_hosts.replace(old_hostname, new_vm_name)
+            if write_if_changed(sysroot_etc+'/hosts', new_hosts):
+                logger.debug('reset '+new_vm_name+':'+sysroot_etc+'/hosts')
                 for i in new_hosts.splitlines():
                     if new_vm_name in i:
                         logger.info("reset  %s:/etc/hosts", new_vm_name)
@@ -469,9 +1510,7 @@ def lladdr_randomize_in_a_file(file_path, old_mac_address, new_mac_address):
         content = file.read()
         content = re.sub(r'\b' + re.escape(old_mac_address) + r'\b', new_mac_address, content)
 
-        with open(file_path, 'w') as file:
-            file.write(content)
-            file.flush()
+    write_if_changed(file_path, content)
 
 
 def is_service_enabled(sysroot_etc, service_name):
@@ -508,9 +1547,7 @@ def set_ip_cidr(sysroot_etc, new_vm_name, new_ip_cidr):
                             re.sub(r"^" + sysroot_etc, "/etc", i),
                             new_ip_cidr)
             config.set('ipv4', 'method', 'manual')
-            with open(i, 'w') as configfile:  
-                config.write(configfile)
-                configfile.flush()
+            write_if_changed(i, config_to_str(config))
             break
 
     ### ipaddr in ifcfg-*, except ifcfg-lo, .bak, .org, .orig, ...
@@ -542,9 +1579,7 @@ def set_ip_cidr(sysroot_etc, new_vm_name, new_ip_cidr):
                             new_ifcfg)
 
             logger.debug(ifcfg)
-            with open(i, 'w') as file:
-                file.write(ifcfg)
-                file.flush()
+            write_if_changed(i, ifcfg)
             break
 
     ### /etc/hosts
@@ -558,9 +1593,7 @@ def set_ip_cidr(sysroot_etc, new_vm_name, new_ip_cidr):
         new_hosts = re.sub(pattern, r'%s\2'%new_ip, old_hosts)
         logger.debug('new_hosts\n%s', new_hosts)
         logger.info("set   %s:/etc/hosts: %s%s", new_vm_name, new_ip, ret.group(2))
-        with open(sysroot_etc+'/hosts', 'w') as file:
-            file.write(new_hosts)
-            file.flush()
+        write_if_changed(sysroot_etc+'/hosts', new_hosts)
 
 def reset_ip_static_to_dhcp(sysroot_etc, new_vm_name):
     'docstring'
@@ -573,9 +1606,7 @@ def reset_ip_static_to_dhcp(sysroot_etc, new_vm_name):
             config.read(i)
             if config.has_section('ipv4'):
                 config.set('ipv4', 'method', 'auto')
-                with open(i, 'w') as configfile:  
-                    config.write(configfile)
-                    configfile.flush()
+                write_if_changed(i, config_to_str(config))
                 logger.info("reset %s:%s: to 'auto'(aka. dhcp)",
                             new_vm_name,
                             re.sub(sysroot_etc, '/etc', i))
@@ -610,16 +1641,25 @@ def reset_ip_static_to_dhcp(sysroot_etc, new_vm_name):
 
             if ifcfg_changed:
                 logger.debug(ifcfg)
-                with open(i, 'w') as file:
-                    file.write(ifcfg)
-                    file.flush()
+                write_if_changed(i, ifcfg)
 
 def change_ip(sysroot_etc, new_vm_name, arg_change_ip):
     """
-    Change IP addresses in network configuration files for both NetworkManager and Wicked
+    Change IP addresses in network configuration files for both NetworkManager and Wicked.
+    All pairs are applied in memory, each file is written once at most.
     """
     logger = logging.getLogger()
 
+    ### ipaddr in ifcfg-* and /etc/NetworkManager/*.nmconnnection
+    cfgfiles = glob.glob(sysroot_etc + '/sysconfig/network/ifcfg-*') + glob.glob(sysroot_etc + '/NetworkManager/system-connections/*.nmconnection') 
+    if 'ifcfg-lo' in cfgfiles: 
+        cfgfiles.remove('ifcfg-lo')
+
+    contents = {}
+    for i in cfgfiles + [sysroot_etc+'/hosts']:
+        with open(i, 'r') as file:
+            contents[i] = file.read()
+
     for opt_change_ip in arg_change_ip:
         old_ip = opt_change_ip.split(',')[0]
         new_ip = opt_change_ip.split(',')[1]
@@ -627,63 +1667,114 @@ def change_ip(sysroot_etc, new_vm_name, arg_change_ip):
         logger.debug('change_ip( %s, %s, %s,%s )',
                      sysroot_etc, new_vm_name, old_ip, new_ip )
 
-        ### ipaddr in ifcfg-* and /etc/NetworkManager/*.nmconnnection
-        cfgfiles = glob.glob(sysroot_etc + '/sysconfig/network/ifcfg-*') + glob.glob(sysroot_etc + '/NetworkManager/system-connections/*.nmconnection') 
-        if 'ifcfg-lo' in cfgfiles: 
-            cfgfiles.remove('ifcfg-lo')
+        for i, cfg in contents.items():
+            if cfg.find(old_ip) > -1:
+                if i == sysroot_etc+'/hosts':
+                    logger.info("changed %s:/etc/hosts: %s", new_vm_name, new_ip)
+                else:
+                    logger.info("changed %s:%s: %s",
+                                new_vm_name,
+                                re.sub(r'^' + sysroot_etc, '/etc', i),
+                                new_ip)
+                contents[i] = cfg.replace(old_ip, new_ip)
+
+    for i, cfg in contents.items():
+        logger.debug(cfg)
+        write_if_changed(i, cfg)
+
+def resolve_hook(spec):
+    '''
+    The callable of a --hook, one of
+        an executable, run as `HOOK SYSROOT_ETC VM_NAME IP_CIDR MAC,MAC...`
+        'module:function', called with the keyword arguments sysroot_etc,
+                           name, ip_cidr and macs
+        the name of an entry point of the 'virt_dup.hooks' group
+
+    Raises:
+        VirtDupError: if spec is none of them
+    '''
+    if os.path.isfile(spec) and os.access(spec, os.X_OK):
+        path = os.path.abspath(spec)
 
-        for i in cfgfiles:
+        def run_executable(sysroot_etc, name, ip_cidr, macs):
+            ret, _o, err = run_cmd([path, sysroot_etc, name, ip_cidr or '',
+                                    ','.join(macs)], shell=False)
+            if ret:
+                raise VirtDupError("hook '{}' exited {}: {}".format(
+                    spec, ret, err.strip()))
+        return run_executable
 
-            with open(i, 'r') as file:
-                cfg = file.read()
+    if ':' in spec:
+        module_name, _, func_name = spec.partition(':')
+        try:
+            return getattr(importlib.import_module(module_name), func_name)
+        except (ImportError, AttributeError) as err:
+            raise VirtDupError("hook '{}': {}".format(spec, err)) from None
+
+    try:
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group='virt_dup.hooks', name=spec)
+        else:
+            eps = [ep for ep in eps.get('virt_dup.hooks', ()) if ep.name == spec]
+        for ep in eps:
+            return ep.load()
+    except ImportError:
+        pass
+    raise VirtDupError("hook '{}' is neither an executable, 'module:function' "
+                       "nor a 'virt_dup.hooks' entry point".format(spec))
 
-            ret1 = cfg.find(old_ip)
-            ret2 = cfg.replace(old_ip, new_ip)
-            if ret1 > -1:
-                logger.info("changed %s:%s: %s",
-                            new_vm_name,
-                            re.sub(r'^' + sysroot_etc, '/etc', i),
-                            new_ip)
 
-                logger.debug(ret2)
-                with open(i, 'w') as file:
-                    file.write(ret2)
-                    file.flush()
+def run_hooks(hooks, sysroot_etc, new_vm_name, ip_cidr=None, macs=()):
+    '''
+    Run the hooks in order, while the rootfs of new_vm_name is mounted. A
+    failing hook fails the clone.
+
+    hooks (list): (spec, callable) of each --hook, see resolve_hook()
 
-        ### /etc/hosts
-        with open(sysroot_etc+'/hosts', 'r') as file:
-            old_hosts = file.read()
+    Returns:
+        dict: the seconds each hook took
+    '''
+    logger = logging.getLogger()
+    timings = {}
+    for spec, hook in hooks:
+        start = time.time()
+        hook(sysroot_etc=sysroot_etc, name=new_vm_name, ip_cidr=ip_cidr,
+             macs=list(macs))
+        timings[spec] = time.time() - start
+        logger.info("hook '%s' of '%s' took %.2fs", spec, new_vm_name, timings[spec])
+    return timings
+
+
+def manipulate_etc(args, sysroot_etc, new_vm_name, macs=()):
+    """eg. reset hostname, hosts, ipaddr, etc. Then run the --hook, macs are
+    the MAC addresses of new_vm_name for them.
 
-        ret1 = old_hosts.find(old_ip)
-        ret2 = old_hosts.replace(old_ip, new_ip)
-        logger.debug(ret2)
-        if ret1 > -1:
-            logger.info("changed %s:/etc/hosts: %s", new_vm_name, new_ip)
-            with open(sysroot_etc+'/hosts', 'w') as file:
-                file.write(ret2)
-                file.flush()
-
-def manipulate_etc(args, sysroot_etc, new_vm_name):
-    """eg. reset hostname, hosts, ipaddr, etc.
+    Returns:
+        dict: the seconds each hook took
     """
     logger = logging.getLogger()
     logger.debug('manipulate_etc( %s )', sysroot_etc)
     if sysroot_etc is None:
         logger.error('sysroot_etc must not None')
-        return
+        return None
 
     reset_hostname(sysroot_etc, new_vm_name)
-    reset_mac_LLADDR(sysroot_etc, new_vm_name)
+    if getattr(args, 'reset_mac', True):
+        reset_mac_LLADDR(sysroot_etc, new_vm_name)
 
     if args.change_ip is None and args.set_ip_cidr is None:
         reset_ip_static_to_dhcp(sysroot_etc, new_vm_name)
     elif args.change_ip is not None and args.change_ip[0] != 'no':
         change_ip(sysroot_etc, new_vm_name, args.change_ip)
-        return
-
-    if args.set_ip_cidr is not None:
+    elif args.set_ip_cidr is not None:
         set_ip_cidr(sysroot_etc, new_vm_name, args.set_ip_cidr[0])
 
+    ip_cidr = args.set_ip_cidr[0] if args.set_ip_cidr is not None else None
+    return run_hooks(getattr(args, 'hooks', ()), sysroot_etc, new_vm_name,
+                     ip_cidr, macs)
+
 
 def is_dev_btrfs(dev):
     """Check if a device uses the btrfs filesystem.
@@ -694,12 +1785,7 @@ def is_dev_btrfs(dev):
     Returns:
         bool: True if device uses btrfs, False otherwise.
     """
-    dev = re.sub(r'^/dev/', '', dev)
-    cmd = f'lsblk -lno FSTYPE /dev/{dev}'
-    lines = check_output(cmd.split(), universal_newlines=True).splitlines()
-    logging.debug(cmd)
-    logging.debug(lines)
-    return 'btrfs' in lines
+    return probe_fstype(dev) == 'btrfs'
 
 def is_path_rootfs(path_sysroot):
     return (os.path.exists(f'{path_sysroot}/boot') and
@@ -746,96 +1832,304 @@ def read_fstab_etc_overlay_option(path_fstab):
         return '{},{},{}'.format(l_dir, u_dir, w_dir)
 
 
-def manipulate_rootfs_in_qcow2(args, img_file, new_vm_name):
-    'docstring'
+# Discoverable Partitions Specification, the partition type GUIDs
+DPS_ROOT_GUIDS = [
+    '44479540-f297-41b2-9af7-d131d5f0458a',     # x86
+    '4f68bce3-e8cd-4db1-96e7-fbcaf984b709',     # x86-64
+    '69dad710-2ce4-4e3c-b16c-21a1d49abed3',     # arm
+    'b921b045-1df0-41c3-af44-4c6f280d3fae',     # arm64
+    'c31c45e6-3f39-412e-80fb-4809c4980599',     # ppc64le
+    '5eead9a9-fe09-4a1e-a1d7-520d00531306',     # s390x
+    '72ec70a6-cf74-40e6-bd49-4bc8c4bb4d0b',     # riscv64
+]
+DPS_VAR_GUID = '4d21b016-b534-45c2-a9fb-5c16e091fd2d'
+DPS_NON_ROOT_GUIDS = [
+    'c12a7328-f81f-11d2-ba4b-00a0c93ec93b',     # ESP
+    'bc13c2ff-59e6-4262-a352-b275fd6f7172',     # XBOOTLDR
+    '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f',     # swap
+    '933ac7e1-2eb4-4f13-b844-0e14e2aef915',     # /home
+    '3b8f8425-20e0-4f3b-907f-1a25a76f98e8',     # /srv
+    '7ec6f557-3bc5-4aca-b293-16ef5df639d1',     # /var/tmp
+    '21686148-6449-6e6f-744e-656564454649',     # BIOS boot
+]
+# eg. kiwi names the partitions p.lxroot, p.lxreadonly
+RE_ROOT_LABEL = re.compile(r'^(root|rootfs|sysroot|p\.lxroot|p\.lxreadonly)$', re.I)
+ROOTFS_FSTYPES = ['xfs', 'btrfs', 'ocfs2', 'ext4']
+
+
+def list_partitions(dev, sysfs='/sys', udev_data='/run/udev/data'):
+    '''
+    The partitions of dev with NAME, FSTYPE, PARTTYPE, PARTLABEL, LABEL from
+    the udev/blkid metadata, read from the udev database, or by one lsblk
+    call if it is incomplete. A filesystem on the whole dev, without a
+    partition table, is the only partition. Nothing is mounted.
+    '''
     logger = logging.getLogger()
 
-    with SpareNbdImgfile(img_file) as spare_nbd:
+    def udev_part(part_name, props):
+        return {
+            'NAME': part_name,
+            'FSTYPE': props.get('ID_FS_TYPE', ''),
+            'PARTTYPE': props.get('ID_PART_ENTRY_TYPE', ''),
+            'PARTLABEL': udev_decode(props.get('ID_PART_ENTRY_NAME', '')),
+            'LABEL': udev_decode(props.get('ID_FS_LABEL_ENC', '')),
+        }
+
+    name = os.path.basename(dev)
+    parts = []
+    paths = glob.glob('{}/block/{}/{}*'.format(sysfs, name, name))
+    for path in sorted(paths, key=lambda p: int(re.search(r'(\d+)$', p).group(1))):
+        props = read_udev_properties(os.path.basename(path), sysfs, udev_data)
+        if not props:
+            parts = None
+            break
+        parts.append(udev_part(os.path.basename(path), props))
+    if not paths:
+        props = read_udev_properties(name, sysfs, udev_data)
+        if props.get('ID_FS_TYPE'):
+            parts = [udev_part(name, props)]
+    if parts:
+        logger.debug(parts)
+        return parts
+
+    cmd = 'lsblk -lnP -o NAME,FSTYPE,PARTTYPE,PARTLABEL,LABEL ' + dev
+    lines = check_output(cmd.split(), universal_newlines=True).splitlines()
+    logger.debug(cmd)
+    logger.debug(lines)
+
+    parts, whole = [], None
+    for line in lines:
+        part = dict(token.split('=', 1) for token in shlex.split(line))
+        if part.get('NAME') == name:
+            whole = part
+        elif part.get('NAME'):
+            parts.append(part)
+    if not parts and whole is not None and whole.get('FSTYPE'):
+        parts = [whole]
+    return parts
+
+
+def rootfs_hint(part):
+    '''How likely the partition is the rootfs by its metadata only
+        2   by the root partition type GUID
+        1   by the partition or filesystem label
+        0   unknown, eg. MBR, Linux filesystem data GUID
+        -1  not a rootfs, eg. ESP, swap, /home, or not supported fstype
+    '''
+    parttype = (part.get('PARTTYPE') or '').lower()
+    if part.get('FSTYPE') not in ROOTFS_FSTYPES or parttype in DPS_NON_ROOT_GUIDS:
+        return -1
+    if parttype in DPS_ROOT_GUIDS:
+        return 2
+    if (RE_ROOT_LABEL.match(part.get('PARTLABEL') or '') or
+            RE_ROOT_LABEL.match(part.get('LABEL') or '')):
+        return 1
+    return 0
+
+
+def rank_rootfs_candidates(parts):
+    'drop the non-rootfs partitions, the most likely rootfs comes first'
+    candidates = [p for p in parts if rootfs_hint(p) >= 0]
+    # /var goes after the rootfs, see the SLE MicroOS var partition
+    return sorted(candidates, key=lambda p: (
+        -rootfs_hint(p), (p.get('PARTTYPE') or '').lower() == DPS_VAR_GUID))
+
+
+def mount_rw_at_once(part):
+    '''
+    True if the metadata tells the partition is the rootfs or the var
+    partition, no trial mount is needed. A journal replay must never write
+    to an arbitrary partition, eg. /boot or data.
+    '''
+    return (rootfs_hint(part) >= 1 or
+            (part.get('PARTTYPE') or '').lower() == DPS_VAR_GUID)
 
-        microos_rootfs_dev = None
 
-        cmd = 'lsblk -lno NAME,FSTYPE ' + spare_nbd
-        lines = check_output(cmd.split(), universal_newlines=True).splitlines()
-        logger.debug(cmd)
-        logger.debug(lines)
+def trial_mount_opt(fstype):
+    'read-only mount option without journal replay'
+    return {'xfs': 'ro,norecovery',
+            'ext4': 'ro,noload',
+            'btrfs': 'ro,nologreplay'}.get(fstype, 'ro')
 
-        # partition_and_fstype
-        for line in lines:
-            if not (len(line.split()) > 1 and
-                    line.split()[1] in ['xfs', 'btrfs', 'ocfs2', 'ext4']):
-                continue
 
-            with DevMntpoint(prefix="virt_dup_mnt_", 
-                             suffix='.'+new_vm_name,
-                             dev=line.split()[0]) as mpoint:
+CLONE_NEWNS = 0x00020000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
 
-                logger.debug('mpoint = %s', mpoint)
 
-                # rootfs - xfs, ext4
-                if not line.split()[1] == 'btrfs':
-                    if is_rootfs(mpoint):
-                        manipulate_etc(args, mpoint+'/etc', new_vm_name)
-                        return
-                    continue
+def unshare_mount_namespace():
+    '''Move the calling process into a new private mount namespace. Its mounts
+    neither show up in the host mount table nor fire the host systemd/udisks
+    events, and the kernel drops them all when the last process exits.
+    '''
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.unshare(CLONE_NEWNS) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'unshare(CLONE_NEWNS): ' + os.strerror(errno))
+    # systemd makes '/' shared, stop the propagation back to the host
+    if libc.mount(b'none', b'/', None, MS_REC | MS_PRIVATE, None) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'mount --make-rprivate /: ' + os.strerror(errno))
 
-                cmd = f'btrfs property get -ts {mpoint}'
-                ret = check_output(cmd.split()).strip().decode('utf-8')
-                logger.debug(cmd)
-                logger.debug(ret)
 
-                # rootfs - btrfs normal, non-microos_rootfs, eg. Tumbleweed
-                if (ret == 'ro=false' and is_rootfs(mpoint) and
-                        microos_rootfs_dev is None):
-                    manipulate_etc(args, mpoint+'/etc', new_vm_name)
-                    return
+def run_in_mount_namespace(func, *args):
+    '''
+    Run func(*args) in a forked child within a private mount namespace, see
+    unshare_mount_namespace(). If unshare is not permitted, the child runs in
+    the host mount namespace as before.
 
-                # rootfs - ALP Micro
-                if (ret == 'ro=true' and is_rootfs(mpoint) and
-                        get_config('NAME', f'{mpoint}/etc/os-release') == 'ALP Micro'): 
-
-                    if not os.path.exists(f'{mpoint}/etc/fstab'):
-                        logger.error('rootfs must have /etc/fstab')
-                        return 
-                    ret = read_fstab_etc_overlay_option(f'{mpoint}/etc/fstab')
-                    ret = ret.replace('/sysroot', mpoint)
-
-                    # construct /etc overlayfs 
-                    with OverlayMntpoint(prefix='virt_dup_alp_micro_etc_',
-                                         suffix='.'+new_vm_name,
-                                         mount_opt=ret) as mpoint_overlay:
-                        manipulate_etc(args, mpoint_overlay, new_vm_name)
-                        return
+    Returns:
+        the return value of func, passed back by pickle
+    Raises:
+        ChildProcessError: if func raised, or the child crashed
+    '''
+    logger = logging.getLogger()
 
-                # SLE MicroOS
-                ## SLE microos_rootfs partition
-                if ret == 'ro=true' and is_rootfs(mpoint):
-                    microos_rootfs_dev = line.split()[0]
-                    continue    # continue to unmount rootfs, remount later together with /var
+    # don't duplicate the buffered output in the child
+    sys.stdout.flush()
+    sys.stderr.flush()
 
-                ## SLE microos_var partition:lib/overlay/x/etc/...
-                if not os.path.exists(f'{mpoint}/lib/overlay'):
-                    continue
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        code = 1
+        try:
+            try:
+                unshare_mount_namespace()
+            except OSError as err:
+                logger.warning('%s, mount in the host namespace', err)
+            ret = func(*args)
+            with os.fdopen(wfd, 'wb') as file:
+                pickle.dump(ret, file)
+            code = 0
+        except BaseException:
+            logger.exception('%s() failed in the mount namespace', func.__name__)
+        finally:
+            for handler in logger.handlers:
+                handler.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as file:
+        data = file.read()
+    _pid, status = os.waitpid(pid, 0)
+    if status != 0 or not data:
+        raise ChildProcessError('{}() failed in the mount namespace, '
+                                'wait status {}'.format(func.__name__, status))
+    return pickle.loads(data)
+
+
+def manipulate_rootfs_in_qcow2(args, img_file, new_vm_name, macs=()):
+    '''
+    Attach the image to a spare NBD, and customize its rootfs, macs are the
+    MAC addresses of new_vm_name for the --hook. The mounts go
+    into a private mount namespace per image, unless --no-mount-ns. The NBD
+    is attached in the caller, so it is disconnected even if the child dies.
+    '''
+    with SpareNbdImgfile(img_file) as spare_nbd:
+        emit_event('nbd_attached', new_vm_name, image=img_file, device=spare_nbd)
+        start = time.time()
+        if getattr(args, 'mount_ns', True):
+            ret = run_in_mount_namespace(manipulate_rootfs_on_dev,
+                                         args, spare_nbd, new_vm_name, macs)
+        else:
+            ret = manipulate_rootfs_on_dev(args, spare_nbd, new_vm_name, macs)
+        emit_event('customized', new_vm_name, image=img_file,
+                   duration=time.time() - start)
+    emit_event('cleaned_up', new_vm_name, image=img_file, device=spare_nbd)
+    return ret
 
-                with DevMntpoint(prefix="virt_dup_mnt_", 
-                                 suffix='.'+new_vm_name,
-                                 dev=microos_rootfs_dev) as microos_rootfs:
 
-                    logger.debug('microos_rootfs = %s', microos_rootfs)
-                    logger.debug('microos_var = %s', mpoint)
+def manipulate_rootfs_on_dev(args, spare_nbd, new_vm_name, macs=()):
+    '''
+    Find the rootfs by the partition metadata first. The partitions with
+    metadata hints are mounted read-write at once, see mount_rw_at_once().
+    The others, the top-ranked one included, are trial mounted without
+    journal replay, and mounted read-write only if needed, see MountSession.
 
-                    if not os.path.exists(microos_rootfs+'/etc/fstab'):
-                        logger.error('microos_rootfs must have /etc/fstab')
-                        return
+    Returns:
+        dict: the seconds each --hook took, None if no rootfs is found
+    '''
+    logger = logging.getLogger()
 
-                    # construct the overlayfs instance for microos_var_etc
-                    ret = read_fstab_etc_overlay_option(microos_rootfs+'/etc/fstab')
-                    ret = ret.replace('/sysroot/etc', microos_rootfs+'/etc') 
-                    ret = ret.replace('/sysroot/var', mpoint)
-                    with OverlayMntpoint(prefix='virt_dup_microos_etc_',
-                                         suffix='.'+new_vm_name,
-                                         mount_opt=ret) as mpoint_overlay:
-                        manipulate_etc(args, mpoint_overlay, new_vm_name)
-                        return
+    with MountSession(new_vm_name) as session:
+
+        microos_rootfs = None
+
+        parts = rank_rootfs_candidates(list_partitions(spare_nbd))
+        logger.debug(parts)
+
+        for part in parts:
+            dev, fstype = part['NAME'], part['FSTYPE']
+
+            emit_event('mounting', new_vm_name, device=dev, fstype=fstype)
+            mpoint = session.mount(dev, fstype, writable=mount_rw_at_once(part))
+
+            logger.debug('mpoint = %s', mpoint)
+
+            # rootfs - xfs, ext4
+            if not fstype == 'btrfs':
+                if is_rootfs(mpoint):
+                    mpoint = session.mount(dev, fstype)
+                    return manipulate_etc(args, mpoint+'/etc', new_vm_name, macs)
+                continue
+
+            cmd = f'btrfs property get -ts {mpoint}'
+            ret = check_output(cmd.split()).strip().decode('utf-8')
+            logger.debug(cmd)
+            logger.debug(ret)
+
+            # rootfs - btrfs normal, non-microos_rootfs, eg. Tumbleweed
+            if (ret == 'ro=false' and is_rootfs(mpoint) and
+                    microos_rootfs is None):
+                mpoint = session.mount(dev, fstype)
+                return manipulate_etc(args, mpoint+'/etc', new_vm_name, macs)
+
+            # rootfs - ALP Micro
+            if (ret == 'ro=true' and is_rootfs(mpoint) and
+                    get_config('NAME', f'{mpoint}/etc/os-release') == 'ALP Micro'): 
+
+                # read-write, with '@/var' for the overlay upperdir
+                mpoint = session.mount(dev, fstype)
+                if not os.path.exists(f'{mpoint}/etc/fstab'):
+                    logger.error('rootfs must have /etc/fstab')
+                    return 
+                ret = read_fstab_etc_overlay_option(f'{mpoint}/etc/fstab')
+                ret = ret.replace('/sysroot', mpoint)
+
+                # construct /etc overlayfs 
+                mpoint_overlay = session.overlay(ret, 'virt_dup_alp_micro_etc_')
+                return manipulate_etc(args, mpoint_overlay, new_vm_name, macs)
+
+            # SLE MicroOS
+            ## SLE microos_rootfs partition, the overlay lowerdir, read only is
+            ## enough. Keep it mounted for the microos_var partition
+            if ret == 'ro=true' and is_rootfs(mpoint):
+                microos_rootfs = mpoint
+                continue
+
+            ## SLE microos_var partition:lib/overlay/x/etc/...
+            if microos_rootfs is None or not os.path.exists(f'{mpoint}/lib/overlay'):
+                continue
+
+            mpoint = session.mount(dev, fstype)
+
+            logger.debug('microos_rootfs = %s', microos_rootfs)
+            logger.debug('microos_var = %s', mpoint)
+
+            if not os.path.exists(microos_rootfs+'/etc/fstab'):
+                logger.error('microos_rootfs must have /etc/fstab')
+                return
+
+            # construct the overlayfs instance for microos_var_etc
+            ret = read_fstab_etc_overlay_option(microos_rootfs+'/etc/fstab')
+            ret = ret.replace('/sysroot/etc', microos_rootfs+'/etc') 
+            ret = ret.replace('/sysroot/var', mpoint)
+            mpoint_overlay = session.overlay(ret, 'virt_dup_microos_etc_')
+            return manipulate_etc(args, mpoint_overlay, new_vm_name, macs)
 
 
 def config_logger(args):
@@ -879,155 +2173,2530 @@ def config_logger(args):
     if "flag" in locals() :
         logger.info("Create '{}'".format(var_log_dir))
 
-def libvirt_define_new_vm_domains(org_vm_name, org_domxml, new_vm_name):
-    'docstring'
+class LibvirtHost():
+    '''
+    A libvirt host to define VMs on. With the libvirt python binding, one
+    connection is opened per URI and reused for the whole batch, which works
+    with the test:/// driver as well. Otherwise, each call is `virsh -c URI`.
+    The local libvirtd (uri=None) is always driven by `virsh`.
+
+    Args:
+        uri (str, optional):    eg. qemu+ssh://host2/system, test:///default
+        domains (iterable, optional): the known domain names, queried if None
+    '''
+
+    def __init__(self, uri=None, domains=None):
+        self.logger = logging.getLogger()
+        self.uri = uri
+        self.conn = None
+        self.allocated = None
+        self.capacity = None
+        if uri is not None and libvirt is not None:
+            self.conn = libvirt.open(uri)
+        if domains is None:
+            domains = self.list_domains()
+        self.domains = set(domains)
+
+    def __repr__(self):
+        return self.uri or 'localhost'
+
+    def virsh(self, *args):
+        'run virsh against this host, return (rc, stdout, stderr)'
+        cmd = ['virsh'] + (['-c', self.uri] if self.uri else []) + list(args)
+        return run_cmd(cmd, shell=False)
+
+    def list_domains(self):
+        'docstring'
+        if self.conn is not None:
+            return [dom.name() for dom in self.conn.listAllDomains()]
+        ret, out, _e = self.virsh('list', '--all', '--name')
+        return [name.strip() for name in out.splitlines() if name.strip()]
+
+    def domstate(self, name):
+        "'shut off', 'running', etc., or None if the domain doesn't exist"
+        if self.conn is not None:
+            try:
+                dom = self.conn.lookupByName(name)
+            except libvirt.libvirtError:
+                return None
+            return 'running' if dom.isActive() else 'shut off'
+        ret, out, _e = self.virsh('domstate', name)
+        return out.strip() if ret == 0 else None
+
+    def dumpxml(self, name):
+        'the domxml, or raise'
+        if self.conn is not None:
+            return self.conn.lookupByName(name).XMLDesc()
+        cmd = ['virsh'] + (['-c', self.uri] if self.uri else []) + ['dumpxml', name]
+        return check_output(cmd, universal_newlines=True).strip()
+
+    def allocation(self):
+        '[vCPUs, memory KiB] allocated to the known domains, None if unknown'
+        allocated = [0, 0]
+        if self.conn is not None:
+            for dom in self.conn.listAllDomains():
+                if dom.name() in self.domains:
+                    info = dom.info()
+                    allocated[0] += info[3]
+                    allocated[1] += info[1]
+            return allocated
+        ret, out, _e = self.virsh('domstats', '--raw', '--vcpu', '--balloon')
+        if ret:
+            return None
+        for name, stats in re.findall(r"^Domain: '([^']+)'\n((?:[ \t]+\S.*\n?)*)",
+                                      out, re.M):
+            if name not in self.domains:
+                continue
+            stats = dict(re.findall(r'^\s*([\w.]+)=(\d+)', stats, re.M))
+            allocated[0] += int(stats.get('vcpu.current', stats.get('vcpu.maximum', 0)))
+            allocated[1] += int(stats.get('balloon.maximum', stats.get('balloon.current', 0)))
+        return allocated
+
+    def node_capacity(self):
+        '[CPUs, memory KiB] of the host, None if unknown'
+        if self.conn is not None:
+            info = self.conn.getInfo()
+            return [info[2], info[1] * 1024]
+        ret, out, _e = self.virsh('nodeinfo')
+        cpus = re.search(r'^CPU\(s\):\s*(\d+)', out, re.M)
+        memory = re.search(r'^Memory size:\s*(\d+) KiB', out, re.M)
+        if ret or not cpus or not memory:
+            return None
+        return [int(cpus.group(1)), int(memory.group(1))]
+
+    def load(self):
+        '''
+        The share of the host allocated to its domains, the larger of the vCPU
+        and the memory share, or None if the host doesn't tell.
+        '''
+        if self.allocated is None:
+            try:
+                self.allocated = self.allocation()
+                self.capacity = self.node_capacity()
+            except OSError as err:
+                self.logger.debug("no allocation of %s: %s", self, err)
+                return None
+        if not self.allocated or not self.capacity or not all(self.capacity):
+            return None
+        return max(a / c for a, c in zip(self.allocated, self.capacity))
+
+    def numa_topology(self):
+        '{node: [cpu, ...]}, from the local sysfs, or the libvirt capabilities'
+        if self.uri is None:
+            return read_numa_topology()
+        if self.conn is not None:
+            caps = self.conn.getCapabilities()
+        else:
+            ret, caps, _e = self.virsh('capabilities')
+        topology = {}
+        for cell_id, cell in re.findall(r"<cell id='(\d+)'>(.*?)</cell>", caps, re.S):
+            topology[int(cell_id)] = [int(c) for c in re.findall(r"<cpu id='(\d+)'", cell)]
+        return topology
+
+    def start(self, name):
+        'return True on success'
+        if self.conn is not None:
+            try:
+                self.conn.lookupByName(name).create()
+            except libvirt.libvirtError:
+                return False
+            return True
+        ret, _o, _e = self.virsh('start', name)
+        return ret == 0
+
+    def destroy(self, name):
+        'return True on success'
+        if self.conn is not None:
+            try:
+                self.conn.lookupByName(name).destroy()
+            except libvirt.libvirtError:
+                return False
+            return True
+        ret, _o, _e = self.virsh('destroy', name)
+        return ret == 0
+
+    def undefine(self, name):
+        'return True on success'
+        if self.conn is not None:
+            try:
+                self.conn.lookupByName(name).undefine()
+            except libvirt.libvirtError:
+                return False
+        else:
+            ret, _o, _e = self.virsh('undefine', name)
+            if ret:
+                return False
+        self.domains.discard(name)
+        return True
+
+    def define_xml(self, domxml, name):
+        'define the domain, or raise'
+        if self.conn is not None:
+            self.conn.defineXML(domxml)
+            self.logger.info("virsh -c %s define %s", self.uri, name)
+        else:
+            # the temporary file under /tmp is deleted as soon as it is closed
+            with tempfile.NamedTemporaryFile(prefix="virt_dup_domxml_",
+                                             suffix='.' + name + '.xml',
+                                             mode='w+t') as new_xml:
+                new_xml.write(domxml)
+                new_xml.flush()
+                cmd = ['virsh'] + (['-c', self.uri] if self.uri else []) + \
+                      ['define', new_xml.name]
+                self.logger.info(' '.join(cmd))
+                ret = check_output(cmd).decode('utf-8').strip()
+                self.logger.debug(ret)
+                assert 'defined' in ret
+        self.domains.add(name)
+        if self.allocated:
+            self.allocated = [a + b for a, b in zip(self.allocated, domxml_allocation(domxml))]
+
+    def close(self):
+        'docstring'
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def parse_cpulist(cpulist):
+    "eg. '0-3,8' to [0, 1, 2, 3, 8]"
+    cpus = []
+    for item in cpulist.strip().split(','):
+        if not item or item.startswith('^'):
+            continue
+        first, _sep, last = item.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    "eg. [0, 1, 2, 3, 8] to '0-3,8'"
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def read_numa_topology(sysfs='/sys/devices/system/node'):
+    '{node: [cpu, ...]} of the NUMA nodes with CPUs'
+    topology = {}
+    for path in glob.glob(sysfs + '/node[0-9]*/cpulist'):
+        node = int(re.search(r'node(\d+)/cpulist$', path).group(1))
+        with open(path) as file:
+            cpus = parse_cpulist(file.read())
+        if cpus:
+            topology[node] = cpus
+    return topology
+
+
+class NumaPlacer():
+    '''
+    Spread the VMs across the NUMA nodes and the CPUs. The load of a CPU is
+    the number of vCPUs pinned to it, counting the pinning of the existing
+    domains. Each VM goes to the least loaded node, its vCPUs to the least
+    loaded CPUs of that node, and its memory strictly to that node.
+
+    Args:
+        topology (dict): {node: [cpu, ...]}, see read_numa_topology()
+        domxmls (iterable): domxml of the existing domains
+    '''
+
+    def __init__(self, topology, domxmls=()):
+        self.logger = logging.getLogger()
+        self.topology = topology
+        self.cpu_load = collections.Counter()
+        for domxml in domxmls:
+            for cpuset in re.findall(r"<vcpupin [^>]*cpuset='([^']+)'", domxml):
+                self.cpu_load.update(parse_cpulist(cpuset))
+
+    @classmethod
+    def for_host(cls, host, exclude=()):
+        'the placer of a LibvirtHost, exclude the domains to be redefined'
+        domains = [d for d in host.list_domains() if d not in exclude]
+        if host.uri is None:
+            domxmls = dump_vm_domxmls(domains).values()
+        else:
+            domxmls = [host.dumpxml(d) for d in domains]
+        return cls(host.numa_topology(), domxmls)
+
+    def node_load(self, node):
+        'docstring'
+        cpus = self.topology[node]
+        return sum(self.cpu_load[cpu] for cpu in cpus) / len(cpus)
+
+    def place(self, vcpus):
+        'return (node, [cpu of vcpu 0, cpu of vcpu 1, ...])'
+        node = min(sorted(self.topology), key=self.node_load)
+        cpus = sorted(self.topology[node], key=lambda c: (self.cpu_load[c], c))
+        pinning = [cpus[i % len(cpus)] for i in range(vcpus)]
+        self.cpu_load.update(pinning)
+        return node, pinning
+
+    def pin_domxml(self, domxml):
+        '''write vcpupin/emulatorpin/numatune of the next placement into domxml.
+        The other cputune settings, eg. shares, are kept
+        '''
+        ret = re.search(r'^(\s*)<vcpu[^>]*>(\d+)</vcpu>', domxml, re.M)
+        if ret is None or not self.topology:
+            return domxml
+        indent, vcpus = ret.group(1).lstrip('\n'), int(ret.group(2))
+        node, pinning = self.place(vcpus)
+        node_cpus = format_cpulist(self.topology[node])
+
+        pins = ''.join("{0}  <vcpupin vcpu='{1}' cpuset='{2}'/>\n".format(indent, i, cpu)
+                       for i, cpu in enumerate(pinning))
+        pins += "{}  <emulatorpin cpuset='{}'/>\n".format(indent, node_cpus)
+        numatune = ("{0}<numatune>\n{0}  <memory mode='strict' nodeset='{1}'/>\n"
+                    "{0}</numatune>\n").format(indent, node)
+
+        # the placement is per vCPU now, drop the <vcpu cpuset=''/> and old pins
+        domxml = re.sub(r"(<vcpu[^>]*?)\s+cpuset='[^']*'", r'\1', domxml)
+        domxml = re.sub(r'^\s*<(vcpupin|emulatorpin) [^>]*/>\n', '', domxml, flags=re.M)
+        domxml = re.sub(r'^\s*<numatune>.*?</numatune>\n', '', domxml, flags=re.M | re.S)
+        domxml = re.sub(r'^\s*<cputune>\s*</cputune>\n', '', domxml, flags=re.M)
+
+        if re.search(r'^\s*<cputune>\n', domxml, re.M):
+            domxml = re.sub(r'^(\s*<cputune>\n)', lambda m: m.group(1) + pins,
+                            domxml, count=1, flags=re.M)
+            domxml = re.sub(r'^(\s*</cputune>\n)', lambda m: m.group(1) + numatune,
+                            domxml, count=1, flags=re.M)
+        else:
+            cputune = '{0}<cputune>\n{1}{0}</cputune>\n'.format(indent, pins)
+            domxml = re.sub(r'^(\s*<vcpu[^>]*>\d+</vcpu>\n)',
+                            lambda m: m.group(1) + cputune + numatune,
+                            domxml, count=1, flags=re.M)
+
+        self.logger.info('numa node %d, cpus %s', node, format_cpulist(pinning))
+        return domxml
+
+
+def domxml_allocation(domxml):
+    '[vCPUs, memory KiB] of the domxml'
+    units = {'b': 1.0 / 1024, 'bytes': 1.0 / 1024, 'k': 1, 'kib': 1, 'kb': 1000.0 / 1024,
+             'm': 1024, 'mib': 1024, 'mb': 1000000.0 / 1024,
+             'g': 1024 ** 2, 'gib': 1024 ** 2, 'gb': 1000000000.0 / 1024}
+    vcpus = re.search(r'<vcpu[^>]*>(\d+)</vcpu>', domxml)
+    memory = re.search(r"<memory(?: unit='(\w+)')?>(\d+)</memory>", domxml)
+    kib = 0
+    if memory:
+        kib = int(int(memory.group(2)) * units.get((memory.group(1) or 'KiB').lower(), 1))
+    return [int(vcpus.group(1)) if vcpus else 1, kib]
+
+
+def place_vm(hosts, new_vm_name, placement, seq):
+    '''
+    Pick the host for new_vm_name. An existing VM stays on its host, otherwise
+    'round-robin' takes the seq-th host, 'least-loaded' the host with the
+    smallest share of its vCPUs or memory allocated, or with the fewest
+    domains if a host doesn't report its allocation.
+    '''
+    for host in hosts:
+        if new_vm_name in host.domains:
+            return host
+    if placement == 'least-loaded':
+        loads = [host.load() for host in hosts]
+        if None in loads:
+            loads = [len(host.domains) for host in hosts]
+        return hosts[loads.index(min(loads))]
+    return hosts[seq % len(hosts)]
+
+
+def libvirt_define_new_vm_domains(org_vm_name, org_domxml, new_vm_name,
+                                  used_macs=None, host=None, numa=None,
+                                  state=None):
+    '''define the new VM on host, return the new domxml or None if failed
+
+    numa (NumaPlacer, optional): pin the vCPUs and memory of the new VM
+    state (str, optional): the state of new_vm_name on host, None if it
+                           doesn't exist
+    '''
     logger = logging.getLogger()
 
-    ret, stdout, _e = run_cmd('virsh domstate ' + new_vm_name)
-    if ret == 0:
+    if host is None:
+        host = LibvirtHost(domains=())
+
+    if state is not None:
 
         # bring dom to 'shut off' state, if not
-        if 'shut off' not in stdout:
+        if 'shut off' not in state:
             logger.info("vm '%s' is active. Call virsh to destroy it",
                         new_vm_name)
-            ret, _o, _e = run_cmd('virsh destroy ' + new_vm_name)
-            if ret:
+            if not host.destroy(new_vm_name):
                 logger.critical("failed to destroy '%s'", new_vm_name)
-                return False
+                return None
 
         # now is safe to 'undefine' the dom
         logger.info("vm '%s' already exists. Call virsh to undefine it",
                     new_vm_name)
-        ret, _o, _e = run_cmd('virsh undefine ' + new_vm_name)
-        if ret:
+        if not host.undefine(new_vm_name):
             logger.critical("failed to undefine '%s'", new_vm_name)
-            return False
+            return None
 
-    new_domxml = generate_new_domxml(org_vm_name, org_domxml, new_vm_name)
+    new_domxml = generate_new_domxml(org_vm_name, org_domxml, new_vm_name,
+                                     used_macs)
+    if numa is not None:
+        new_domxml = numa.pin_domxml(new_domxml)
 
-    # the temporary file under /tmp is deleted as soon as it is closed
-    with tempfile.NamedTemporaryFile(prefix="virt_dup_domxml_",
-                                     suffix='.' + new_vm_name + '.xml',
-                                     mode='w+t') as new_xml:
-        new_xml.write(new_domxml)
-        new_xml.flush()
-        cmd = 'virsh define '+new_xml.name
-        logger.info(cmd)
-        ret = check_output(cmd.split()).decode('utf-8').strip()
-        logger.debug(ret)
-        assert 'defined' in ret
+    host.define_xml(new_domxml, new_vm_name)
 
-    return True
+    return new_domxml
 
 
-def processing_vm_and_img(args, org_vm_name, org_domxml):
-    'docstring'
+class IpamIndex():
+    '''
+    Index of the IP addresses in use. The sources are the host /etc/hosts,
+    the ARP neighbours, the DHCP leases and static hosts of libvirt networks.
+    The lookup is a set membership, fine for thousands of VMs per subnet.
+    The IPs of the VMs in the inventory are looked up by its index.
+
+    Args:
+        inventory (Inventory, optional):
+        exclude (iterable, optional): VM names to give their IPs back
+    '''
+
+    def __init__(self, inventory=None, exclude=()):
+        self.logger = logging.getLogger()
+        self.used = set()
+        self.inventory = inventory
+        self.exclude = tuple(exclude)
+
+    def add(self, ip):
+        'ip (str): eg. 192.168.1.2, 192.168.1.2/24, fe80::1%eth0'
+        try:
+            self.used.add(ipaddress.ip_address(ip.split('/')[0].split('%')[0]))
+        except ValueError:
+            pass
+
+    def __contains__(self, ip):
+        ip = ipaddress.ip_address(ip)
+        if ip in self.used:
+            return True
+        return (self.inventory is not None and
+                self.inventory.owner_of_ip(str(ip), self.exclude) is not None)
+
+    def __len__(self):
+        return len(self.used)
+
+    def load_hosts_file(self, path='/etc/hosts'):
+        'docstring'
+        if not os.path.exists(path):
+            return
+        with open(path) as file:
+            for line in file:
+                fields = re.sub(r'#.*$', '', line).split()
+                if fields:
+                    self.add(fields[0])
+
+    def load_arp_neighbours(self, path='/proc/net/arp', exclude_macs=()):
+        'the neighbours, but those of exclude_macs'
+        if not os.path.exists(path):
+            return
+        with open(path) as file:
+            for line in file.readlines()[1:]:
+                fields = line.split()
+                # 0x0 flags means incomplete entry
+                if (len(fields) > 3 and fields[2] != '0x0' and
+                        fields[3].lower() not in exclude_macs):
+                    self.add(fields[0])
+
+    def load_libvirt_networks(self, uri=None, exclude=(), exclude_macs=()):
+        '''
+        the DHCP leases and static hosts of the networks of a libvirt host,
+        but those of the exclude names or the exclude_macs
+        '''
+        virsh = ['virsh'] + (['-c', uri] if uri else [])
+        ret, out, _e = run_cmd(virsh + ['net-list', '--name'], shell=False)
+        if ret:
+            return
+        for net in [n.strip() for n in out.splitlines() if n.strip()]:
+            ret, out, _e = run_cmd(virsh + ['net-dhcp-leases', net], shell=False)
+            if ret == 0:
+                for line in out.splitlines():
+                    fields = line.split()
+                    if set(fields) & set(exclude) or set(fields) & set(exclude_macs):
+                        continue
+                    for ip_cidr in re.findall(r'\s([0-9a-fA-F.:]+/\d+)(?:\s|$)', line):
+                        self.add(ip_cidr)
+            ret, out, _e = run_cmd(virsh + ['net-dumpxml', net], shell=False)
+            if ret == 0:
+                for host in ET.fromstring(out).iter('host'):
+                    if (host.get('ip') and host.get('name') not in exclude and
+                            (host.get('mac') or '').lower() not in exclude_macs):
+                        self.add(host.get('ip'))
+
+    def load_domains(self, domxmls, exclude=()):
+        'the static <ip address=.../> of the interfaces of the domains'
+        for name, domxml in domxmls.items():
+            if name in exclude:
+                continue
+            for iface in re.findall(r'<interface .*?</interface>', domxml, re.S):
+                for ip in re.findall(r"<ip address='([^']+)'", iface):
+                    self.add(ip)
+
+    @classmethod
+    def from_host(cls, uris=(None,), exclude=(), exclude_macs=()):
+        '''
+        the index of all sources on this host, and the networks of uris. The
+        VMs of the exclude names or the exclude_macs give their IPs back.
+        '''
+        ipam = cls()
+        ipam.load_hosts_file()
+        ipam.load_arp_neighbours(exclude_macs=exclude_macs)
+        for uri in uris:
+            ipam.load_libvirt_networks(uri, exclude, exclude_macs)
+        ipam.logger.debug('IpamIndex: %d IPs in use', len(ipam))
+        return ipam
+
+
+def parse_ip_range(spec):
+    '''
+    Parse FIRST[-LAST][/PREFIX], eg. 192.168.151.101-192.168.151.199/24.
+    PREFIX is a prefix length or an IPv4 netmask, eg. /255.255.255.0
+
+    Returns:
+        tuple: (first, last, prefix)
+            first (IPv4Interface|IPv6Interface)
+            last (IPv4Address|IPv6Address): None means the end of the subnet
+            prefix (str): the prefix length, eg. '/24', or '' if not specified
+    Raises:
+        ValueError: if spec is invalid
+    '''
+    ret = re.match(r'^([^-/]+)(?:-([^-/]+))?(/[\d.]+)?$', spec.strip())
+    if ret is None:
+        raise ValueError('ip address range is invalid: %s' % spec)
+    first = ipaddress.ip_interface(ret.group(1) + (ret.group(3) or ''))
+    # a netmask is written as the prefix length
+    prefix = '/%d' % first.network.prefixlen if ret.group(3) else ''
+    last = None
+    if ret.group(2) is not None:
+        last = ipaddress.ip_address(ret.group(2))
+        if last.version != first.version or last < first.ip:
+            raise ValueError('ip address range is invalid: %s' % spec)
+        if prefix and last not in first.network:
+            raise ValueError('%s overflows the subnet %s' % (last, first.network))
+    return first, last, prefix
+
+
+def ipam_allocate(spec, count, used=()):
+    '''
+    Allocate count IP_CIDRs from the range spec, skip the ones in used, the
+    network and broadcast address.
+
+    Raises:
+        ValueError: if the range or subnet has not enough free IPs
+    '''
+    first, last, prefix = parse_ip_range(spec)
+    network = first.network
+    if prefix and network.num_addresses > 2:
+        reserved = (network.network_address, network.broadcast_address)
+    else:
+        reserved = ()
+    if last is None and prefix:
+        last = network.broadcast_address
+    elif last is None:
+        last = ipaddress.ip_address(2 ** first.max_prefixlen - 1)
+
+    ip_cidrs = []
+    ip = first.ip
+    while len(ip_cidrs) < count:
+        if ip not in used and ip not in reserved:
+            ip_cidrs.append(str(ip) + prefix)
+        if ip >= last:
+            break
+        ip += 1
+    if len(ip_cidrs) < count:
+        raise ValueError('%s has %d free IPs only, %d required' %
+                         (spec, len(ip_cidrs), count))
+    return ip_cidrs
+
+
+class CloneResult():
+    '''
+    The outcome of duplicating one VM
+                self.name
+                self.source       the original VM
+                self.macs         MAC addresses in the order of the NICs
+                self.ip_cidr      IP_CIDR of the first NIC, None means dhcp
+                self.uri          the libvirt host, None means local
+                self.uuid         the domain UUID
+                self.images       the new image files
+                self.copy_method  'reflink', 'copy' if any image is copied,
+                                  or None without image
+                self.shared_bytes     bytes reflinked with other files, and
+                self.exclusive_bytes  bytes of its own, by FIEMAP
+                self.timings      seconds of 'define', 'copy', 'customize',
+                                  and 'total'
+                self.refreshed    --refresh: the images copied again, [] means
+                                  the VM is current, None means not refreshed
+                self.error        why it failed, None means success
+    '''
+
+    def __init__(self, name, source=None):
+        self.name = name
+        self.source = source
+        self.macs = []
+        self.ip_cidr = None
+        self.uri = None
+        self.uuid = None
+        self.images = []
+        self.copy_method = None
+        self.shared_bytes = None
+        self.exclusive_bytes = None
+        self.timings = {}
+        self.refreshed = None
+        self.error = None
+
+    @property
+    def ok(self):
+        'docstring'
+        return self.error is None
+
+    def __repr__(self):
+        return 'CloneResult({}, {})'.format(
+            self.name, 'ok' if self.ok else 'error={!r}'.format(self.error))
+
+
+class Inventory():
+    '''
+    The local SQLite inventory of the VMs duplicated by virt-dup: the source,
+    UUID, host, images, copy method, MACs, IPs and timings. It is indexed by
+    the name, MAC and IP, so the MAC and IP conflict checks are lookups. rm
+    and gc still read the domxml of every domain, the VMs not duplicated by
+    virt-dup might share the images as well.
+
+    Args:
+        path (str, optional): the database file
+    '''
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS clones (
+            name TEXT PRIMARY KEY, source TEXT, uuid TEXT, uri TEXT,
+            copy_method TEXT, created REAL, timings TEXT);
+        CREATE TABLE IF NOT EXISTS images (name TEXT, path TEXT);
+        CREATE TABLE IF NOT EXISTS macs (name TEXT, mac TEXT);
+        CREATE TABLE IF NOT EXISTS ips (name TEXT, ip TEXT);
+        CREATE INDEX IF NOT EXISTS images_name ON images (name);
+        DROP INDEX IF EXISTS images_path;
+        CREATE INDEX IF NOT EXISTS macs_name ON macs (name);
+        CREATE INDEX IF NOT EXISTS macs_mac ON macs (mac);
+        CREATE INDEX IF NOT EXISTS ips_name ON ips (name);
+        CREATE INDEX IF NOT EXISTS ips_ip ON ips (ip);
+    """
+
+    def __init__(self, path=INVENTORY_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        'docstring'
+        self.conn.close()
+
+    def _delete(self, name):
+        for table in ('clones', 'images', 'macs', 'ips'):
+            self.conn.execute('DELETE FROM {} WHERE name = ?'.format(table), (name,))
+
+    def record(self, result):
+        'replace the record of result.name by the CloneResult, in one transaction'
+        with self.conn:
+            self._delete(result.name)
+            self.conn.execute(
+                'INSERT INTO clones VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (result.name, result.source, result.uuid, result.uri,
+                 result.copy_method, time.time(), json.dumps(result.timings)))
+            self.conn.executemany('INSERT INTO images VALUES (?, ?)',
+                                  [(result.name, path) for path in result.images])
+            self.conn.executemany('INSERT INTO macs VALUES (?, ?)',
+                                  [(result.name, mac) for mac in result.macs])
+            if result.ip_cidr is not None:
+                self.conn.execute(
+                    'INSERT INTO ips VALUES (?, ?)',
+                    (result.name, str(ipaddress.ip_interface(result.ip_cidr).ip)))
+
+    def forget(self, name):
+        'docstring'
+        with self.conn:
+            self._delete(name)
+
+    def rename(self, old_name, new_name, new_images):
+        'the spare of a pool is taken as new_name'
+        with self.conn:
+            for table in ('clones', 'images', 'macs', 'ips'):
+                self.conn.execute('UPDATE {} SET name = ? WHERE name = ?'.format(table),
+                                  (new_name, old_name))
+            self.conn.execute('DELETE FROM images WHERE name = ?', (new_name,))
+            self.conn.executemany('INSERT INTO images VALUES (?, ?)',
+                                  [(new_name, path) for path in new_images])
+
+    def _owner(self, table, column, value, exclude):
+        sql = 'SELECT name FROM {} WHERE {} = ?'.format(table, column)
+        if exclude:
+            sql += ' AND name NOT IN ({})'.format(', '.join('?' * len(exclude)))
+        row = self.conn.execute(sql, (value,) + tuple(exclude)).fetchone()
+        return row[0] if row else None
+
+    def owner_of_mac(self, mac, exclude=()):
+        'the VM of the MAC, except the names in exclude, or None'
+        return self._owner('macs', 'mac', mac, exclude)
+
+    def owner_of_ip(self, ip, exclude=()):
+        'the VM of the IP, except the names in exclude, or None'
+        return self._owner('ips', 'ip', ip, exclude)
+
+    def images(self):
+        '{path: name} of all images'
+        return dict(self.conn.execute('SELECT path, name FROM images'))
+
+    def names(self):
+        'docstring'
+        return [row[0] for row in self.conn.execute('SELECT name FROM clones ORDER BY name')]
+
+    def sources(self):
+        'the VMs duplicated from'
+        return set(row[0] for row in self.conn.execute('SELECT DISTINCT source FROM clones'))
+
+
+def open_inventory(args):
+    'the Inventory of --inventory, or None if disabled or not accessible'
+    path = getattr(args, 'inventory', INVENTORY_PATH)
+    if path is None:
+        return None
+    try:
+        return Inventory(path)
+    except (sqlite3.Error, OSError) as err:
+        logging.getLogger().warning("inventory '%s' is not accessible: %s", path, err)
+        return None
+
+
+class MacIndex():
+    '''
+    The MACs in use: the ones handed out during the batch, and the ones of the
+    VMs in the inventory, looked up by its index. The VMs of exclude, to be
+    duplicated again, give their MACs back.
+
+    Args:
+        inventory (Inventory, optional):
+        exclude (iterable, optional): VM names
+    '''
+
+    def __init__(self, inventory=None, exclude=()):
+        self.used = set()
+        self.inventory = inventory
+        self.exclude = tuple(exclude)
+
+    def add(self, mac):
+        'docstring'
+        self.used.add(mac)
+
+    def update(self, macs):
+        'docstring'
+        self.used.update(macs)
+
+    def __contains__(self, mac):
+        if mac in self.used:
+            return True
+        return (self.inventory is not None and
+                self.inventory.owner_of_mac(mac, self.exclude) is not None)
+
+
+def processing_vm_and_img(args, org_vm_name, org_domxml, used_macs=None,
+                          ip_cidrs=None, states=None):
+    '''
+    ip_cidrs (list, optional): the IP_CIDR for each VM of args.vm_name,
+                               allocated by ipam_allocate() up front
+    states (dict, optional): {name: state} of the VMs of args.vm_name, None
+                             if it doesn't exist, see preflight(). The VMs
+                             not in it are queried on their host
+    Returns:
+        list: CloneResult of each VM of args.vm_name. A failure is recorded
+              in CloneResult.error, and the batch goes on.
+    '''
+    logger = logging.getLogger()
+
+    # MACs are unique within the batch, and among the VMs in the inventory
+    inventory = open_inventory(args)
+    known_macs = used_macs or ()
+    used_macs = MacIndex(inventory, args.vm_name)
+    used_macs.update(known_macs)
+
+    results = []
+
+    # the image files are on the storage shared among all hosts, only the
+    # domains are spread. One connection per host for the whole batch
+    if getattr(args, 'connect', None):
+        hosts = [LibvirtHost(uri) for uri in args.connect]
+    else:
+        hosts = [LibvirtHost(domains=())]
+    numa_placers = {}
+
+    # one I/O budget for all copies of the batch, on the image directory
+    img = re.search(r"<source file='(\S*/)%s" % re.escape(org_vm_name), org_domxml)
+    throttle = IoThrottle.from_args(args, img.group(1)) if img else None
+
+    for new_vm_name in args.vm_name:
+        emit_event('queued', new_vm_name, source=org_vm_name)
+
+    for idx, new_vm_name in enumerate(args.vm_name):
+
+        if ip_cidrs is not None:
+            args.set_ip_cidr = [ip_cidrs[idx]]
+
+        result = CloneResult(new_vm_name, org_vm_name)
+        results.append(result)
+        start = time.time()
+        try:
+            host = place_vm(hosts, new_vm_name,
+                            getattr(args, 'placement', 'round-robin'), idx)
+            if states is not None and new_vm_name in states:
+                state = states[new_vm_name]
+            else:
+                state = host.domstate(new_vm_name)
+            if getattr(args, 'refresh', False) and state is not None:
+                refresh_vm(args, org_vm_name, org_domxml, result, host, used_macs,
+                           state, throttle)
+            else:
+                numa = None
+                if getattr(args, 'numa_spread', False):
+                    if host not in numa_placers:
+                        numa_placers[host] = NumaPlacer.for_host(host, args.vm_name)
+                    numa = numa_placers[host]
+                duplicate_vm(args, org_vm_name, org_domxml, result, host,
+                             used_macs, numa, throttle, state)
+        except Exception as err:
+            result.error = str(err) or type(err).__name__
+            logger.error("vm '%s' failed: %s", new_vm_name, result.error)
+            logger.debug('', exc_info=True)
+        result.timings['total'] = time.time() - start
+        if result.ok:
+            emit_event('done', new_vm_name, duration=result.timings['total'],
+                       shared_bytes=result.shared_bytes,
+                       exclusive_bytes=result.exclusive_bytes)
+        else:
+            emit_event('failed', new_vm_name, duration=result.timings['total'],
+                       error=result.error)
+
+        if inventory is not None and result.ok:
+            try:
+                inventory.record(result)
+            except sqlite3.Error as err:
+                logger.warning("failed to record '%s' in the inventory: %s",
+                               new_vm_name, err)
+
+    for host in hosts:
+        host.close()
+    if inventory is not None:
+        inventory.close()
+
+    return results
+
+
+def add_hook_timings(result, hook_timings):
+    'sum up the seconds of each --hook over the images of the clone'
+    hooks = result.timings.setdefault('hooks', {})
+    for spec, seconds in (hook_timings or {}).items():
+        hooks[spec] = hooks.get(spec, 0.0) + seconds
+
+
+def duplicate_vm(args, org_vm_name, org_domxml, result, host, used_macs,
+                 numa=None, throttle=None, state=None):
+    '''
+    define result.name on host, duplicate and customize the images
+
+    throttle (IoThrottle, optional): the I/O budget of the batch
+    state (str, optional): the state of result.name, None if it doesn't exist
+    '''
     logger = logging.getLogger()
+    new_vm_name = result.name
+
+    start = time.time()
+    new_domxml = libvirt_define_new_vm_domains(org_vm_name, org_domxml,
+                                               new_vm_name, used_macs, host,
+                                               numa, state)
+    result.timings['define'] = time.time() - start
+    if new_domxml is None:
+        raise VirtDupError("failed to define '{}'".format(new_vm_name))
+    emit_event('defined', new_vm_name, uri=host.uri,
+               duration=result.timings['define'])
+
+    result.uri = host.uri
+    result.uuid = re.search(r'<uuid>(.*)</uuid>', new_domxml).group(1)
+    result.macs = re.findall(r"<mac address='(\S+)'/>", new_domxml)
+    if args.set_ip_cidr is not None:
+        result.ip_cidr = args.set_ip_cidr[0]
 
     # search all image files with org_vm_name as the prefix
     re_org_img = re.compile(r"(.*<source file=')(\S*/)(%s)(\S+)('.*/>)$"%
                             org_vm_name, re.M)
-    for new_vm_name in args.vm_name:
+    all_imgs = [(path+prefix+name, path+new_vm_name+name)
+                for _h, path, prefix, name, _m in re_org_img.findall(org_domxml)]
+    copy_and_customize_images(args, result, all_imgs, throttle)
+    account_storage(result)
+    if len(all_imgs) == 0:
+        logger.warning("No '%s*.qcow2' image file used, which means you don't take advantage of this tool.", org_vm_name)
+
+
+def copy_and_customize_images(args, result, imgs, throttle=None, refresh=False):
+    '''
+    Copy each (source, new) image path of imgs for result.name, stamp the
+    source identity, and customize the rootfs in it. The stable copy of a
+    --live source is copied, while the identity is the one of the source.
 
-        if not libvirt_define_new_vm_domains(org_vm_name, org_domxml, new_vm_name):
+    throttle (IoThrottle, optional): the I/O budget of the batch
+    refresh (bool, optional): skip the current images, see is_img_current(),
+                              and list the copied ones in result.refreshed
+    '''
+    logger = logging.getLogger()
+    new_vm_name = result.name
+
+    result.timings['copy'] = result.timings['customize'] = 0.0
+    for org_img_path, new_img_path in imgs:
+        result.images.append(new_img_path)
+        if refresh and is_img_current(org_img_path, new_img_path):
+            logger.info("'%s' is current", new_img_path)
             continue
 
-        all_imgs = re_org_img.findall(org_domxml)
-        for head, path, prefix, name, misc in all_imgs:
-            xml_tag_src_img = head+path+prefix+name+misc
-            new_img_path = path+new_vm_name+name
-            logger.debug("'%s' to be duplicated", new_img_path)
-            cp_reflink_img(path+prefix+name, new_img_path)
-
-            ret = check_output(['file', '-b', new_img_path]).decode('utf-8')
-            logger.debug('file type {}'.format(ret).strip())
-            if 'QCOW' in ret:
-                manipulate_rootfs_in_qcow2(args, new_img_path, new_vm_name)
-            #else:
-            #    manipulate_rootfs_in_raw_img(args, new_img_path)
-        if len(all_imgs) == 0:
-            logger.warning("No '%s*.qcow2' image file used, which means you don't take advantage of this tool.", org_vm_name)
+        logger.debug("'%s' to be duplicated", new_img_path)
+        start = time.time()
+        identity = source_identity(org_img_path)
+        # the stable copy of a running source, see --live
+        src_img_path = getattr(args, 'source_images', {}).get(org_img_path,
+                                                              org_img_path)
+        size = os.path.getsize(src_img_path)
+        emit_event('copy_started', new_vm_name, image=new_img_path, bytes=size)
+        method = cp_reflink_img(src_img_path, new_img_path, new_vm_name,
+                                throttle, getattr(args, 'ioprio', None))
+        stamp_source_identity(new_img_path, identity)
+        result.timings['copy'] += time.time() - start
+        emit_event('copy_done', new_vm_name, image=new_img_path, method=method,
+                   bytes=size, duration=time.time() - start)
+        if refresh:
+            result.refreshed.append(new_img_path)
+        if result.copy_method != 'copy':
+            result.copy_method = method
+
+        start = time.time()
+        if is_qcow2(new_img_path):
+            add_hook_timings(result, manipulate_rootfs_in_qcow2(
+                args, new_img_path, new_vm_name, result.macs))
+        #else:
+        #    manipulate_rootfs_in_raw_img(args, new_img_path)
+        result.timings['customize'] += time.time() - start
+
+
+def refresh_vm(args, org_vm_name, org_domxml, result, host, used_macs,
+               state, throttle=None):
+    '''
+    Bring the existing VM up to date with the source. Only the images whose
+    source changed are copied and customized again. The domain, its UUID and
+    MACs are kept, there is no redefine. If the source has got a new image,
+    the VM is duplicated from scratch. state is the current one of the VM,
+    throttle is the I/O budget of the batch.
+    '''
+    logger = logging.getLogger()
+    new_vm_name = result.name
 
-        if args.set_ip_cidr is not None:
-            ip_if_b = int(ipaddress.ip_interface(args.set_ip_cidr[0])) + 1
-            new_ip_cidr = str(ipaddress.ip_address(ip_if_b))
+    if 'shut off' not in state:
+        raise VirtDupError("vm '{}' is {}, shut it off to refresh".format(
+            new_vm_name, state))
 
-            ret = re.search(r'/\d+', args.set_ip_cidr[0])
-            if ret is not None:
-                args.set_ip_cidr[0] = new_ip_cidr + ret.group(0)
-            else:
-                args.set_ip_cidr[0] = new_ip_cidr
+    domxml = host.dumpxml(new_vm_name)
+    re_org_img = re.compile(r"(.*<source file=')(\S*/)(%s)(\S+)('.*/>)$"%
+                            org_vm_name, re.M)
+    all_imgs = [(path+prefix+name, path+new_vm_name+name)
+                for _h, path, prefix, name, _m in re_org_img.findall(org_domxml)]
+    if not set(new for _org, new in all_imgs) <= set(domain_image_files(domxml)):
+        logger.info("vm '%s' doesn't use all images of '%s', duplicate it again",
+                    new_vm_name, org_vm_name)
+        duplicate_vm(args, org_vm_name, org_domxml, result, host, used_macs,
+                     throttle=throttle, state=state)
+        return
 
+    result.uri = host.uri
+    ret = re.search(r'<uuid>(.*)</uuid>', domxml)
+    result.uuid = ret.group(1) if ret else None
+    result.macs = re.findall(r"<mac address='(\S+)'/>", domxml)
+    if args.set_ip_cidr is not None:
+        result.ip_cidr = args.set_ip_cidr[0]
+    result.refreshed = []
+    copy_and_customize_images(args, result, all_imgs, throttle, refresh=True)
 
-def process_args(args):
-    'docstring'
+    logger.info("vm '%s' is refreshed, %d of %d images copied again",
+                new_vm_name, len(result.refreshed), len(all_imgs))
+    account_storage(result)
 
-    config_logger(args)
-    logger = logging.getLogger()
 
-    ensure_cli_env_is_root()
+def probe_tcp(ip, port=22, timeout=1.0):
+    'True if ip:port accepts a TCP connection'
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
 
-    # check VM names
-    for name in args.vm_name:
-        if ' ' in name:
-            logger.critical(' the space char is prohibited, "%s"', name)
-            sys.exit(-1)
 
-    # --set-ip-cidr and --change-ip can't co-exist
-    if args.set_ip_cidr is not None and args.change_ip is not None:
-        logger.critical("--set-ip-cidr and --change-ip can't co-exist")
-        sys.exit(-1)
+class StartScheduler():
+    '''
+    Start the VMs in waves to avoid the boot storm on the shared storage. At
+    most `window` VMs are booting at once. The window grows by one while the
+    VMs get ready within 1.5x the best time-to-ready seen, and halves when
+    they don't, or time out.
 
-    # --set-ip-cidr validation
-    if args.set_ip_cidr is not None:
-        try:
-            ipaddress.ip_interface(args.set_ip_cidr[0])
-        except ValueError:
-            logger.critical('ip address/netmask is invalid: %s',
-                            args.set_ip_cidr[0])
-            sys.exit(-1)
+    The readiness probes:
+        tcp     the port of the IP of --set-ip-cidr accepts connections
+        agent   qemu-guest-agent answers guest-ping
+        lease   the DHCP lease of the VM shows up
+        auto    any of above, tcp only if the IP is known
 
-    if args.change_ip is not None:
-        str1 = args.change_ip[0].lower()
-        args.change_ip[0]=str1
-        if str1 != 'no' and ',' not in str1:
-            logger.critical("'--change-ip %s' misses ','.", str1)
-            sys.exit(-1)
+    Args:
+        window (int): the initial number of VMs booting at once
+        timeout (float): seconds to get ready, otherwise it is reported
+        probe (str): 'auto', 'tcp', 'agent' or 'lease'
+        port (int): the port of the tcp probe
+    '''
 
-    # get org_domxml
-    org_vm_name = args.vm_name[0]
-    del args.vm_name[0]
-    if not args.vm_name:
-        args.vm_name = ['%s_dup'%org_vm_name]
+    def __init__(self, window=4, timeout=300, probe='auto', port=22,
+                 interval=1.0):
+        self.logger = logging.getLogger()
+        self.window = max(1, window)
+        self.max_window = max(self.window * 4, 16)
+        self.timeout = timeout
+        self.probe = probe
+        self.port = port
+        self.interval = interval
+        self.best = None
+        self.hosts = {}
+
+    def host(self, uri):
+        'one LibvirtHost per uri'
+        if uri not in self.hosts:
+            self.hosts[uri] = LibvirtHost(uri, domains=())
+        return self.hosts[uri]
+
+    def is_ready(self, result):
+        'docstring'
+        host = self.host(result.uri)
+        if self.probe in ('auto', 'tcp') and result.ip_cidr is not None:
+            if probe_tcp(str(ipaddress.ip_interface(result.ip_cidr).ip), self.port):
+                return True
+        if self.probe in ('auto', 'agent'):
+            ret, _o, _e = host.virsh('qemu-agent-command', result.name,
+                                     '{"execute":"guest-ping"}')
+            if ret == 0:
+                return True
+        if self.probe in ('auto', 'lease'):
+            ret, out, _e = host.virsh('domifaddr', result.name, '--source', 'lease')
+            if ret == 0 and re.search(r'\s[0-9a-fA-F.:]+/\d+', out):
+                return True
+        return False
+
+    def adapt(self, time_to_ready):
+        'AIMD of the window by the time-to-ready, None means timeout'
+        if time_to_ready is not None and (self.best is None or time_to_ready < self.best):
+            self.best = time_to_ready
+        if time_to_ready is not None and time_to_ready <= self.best * 1.5:
+            self.window = min(self.window + 1, self.max_window)
+        else:
+            self.window = max(1, self.window // 2)
+        self.logger.debug('start window = %d', self.window)
+
+    def run(self, results):
+        '''start the VMs of results and wait for them to get ready. The
+        time-to-ready goes to CloneResult.timings['ready'], None if timeout
+        '''
+        pending = [r for r in results if r.ok]
+        booting = {}    # name: (result, start time)
+        while pending or booting:
+            while pending and len(booting) < self.window:
+                result = pending.pop(0)
+                if not self.host(result.uri).start(result.name):
+                    result.error = "failed to start '{}'".format(result.name)
+                    self.logger.error('%s', result.error)
+                    continue
+                self.logger.info("vm '%s' is started", result.name)
+                booting[result.name] = (result, time.time())
+
+            time.sleep(self.interval)
+
+            for name, (result, start) in list(booting.items()):
+                elapsed = time.time() - start
+                if self.is_ready(result):
+                    result.timings['ready'] = elapsed
+                    self.logger.info("vm '%s' is ready in %.1fs", name, elapsed)
+                    del booting[name]
+                    self.adapt(elapsed)
+                elif elapsed > self.timeout:
+                    result.timings['ready'] = None
+                    self.logger.warning("vm '%s' is not ready in %ds", name, self.timeout)
+                    del booting[name]
+                    self.adapt(None)
+
+        for host in self.hosts.values():
+            host.close()
+        return results
+
+
+def register_hosts_file(results, path='/etc/hosts'):
+    '''Register 'IP NAME' of all VMs with a static IP to the host /etc/hosts
+    in one atomic rewrite. The old entries of the same names, or their FQDN,
+    are dropped, the other names of their lines are kept. If /etc/hosts
+    can't be replaced, eg. a bind mount in a container, it is rewritten in
+    place. Return the number of VMs registered.
+    '''
+    logger = logging.getLogger()
 
-    ret, _o, _e = run_cmd("virsh domstate %s"%(org_vm_name))
-    if ret:
-        logger.critical("the virtual machine '%s' doesn't exist", org_vm_name)
-        sys.exit(-1)
+    entries = [(str(ipaddress.ip_interface(r.ip_cidr).ip), r.name)
+               for r in results if r.ok and r.ip_cidr is not None]
+    if not entries:
+        return 0
+    names = set(name for _ip, name in entries)
 
-    org_domxml = check_output(('virsh dumpxml ' + org_vm_name).split(),
-                              universal_newlines=True).strip()
+    with open(path, 'r') as file:
+        old_lines = file.read().splitlines()
 
-    # info user all image files shared among VM
-    for _s, path, image_name, _e in re.findall(
-            r"(.*<source file=')(\S*/)(\S+)('.*/>)$", org_domxml, re.M):
-        if re.match(org_vm_name, image_name):
+    def stale(host):
+        return host in names or host.split('.')[0] in names
+
+    new_lines = []
+    for line in old_lines:
+        fields = re.sub(r'#.*$', '', line).split()
+        if len(fields) < 2 or not any(stale(host) for host in fields[1:]):
+            new_lines.append(line)
             continue
-        logger.info("'%s' is shared among VMs", path+image_name)
+        kept = [host for host in fields[1:] if not stale(host)]
+        logger.debug("drop '%s' from %s", line, path)
+        if kept:
+            comment = line[line.index('#'):] if '#' in line else ''
+            new_lines.append(' '.join([fields[0]] + kept + ([comment] if comment else [])))
+    new_lines += ['{}\t{}'.format(ip, name) for ip, name in entries]
+    content = '\n'.join(new_lines) + '\n'
+
+    # write aside, then rename, readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(prefix='.virt_dup_hosts_',
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        os.unlink(tmp_path)
+        # EBUSY of a bind mount, or the owner or the SELinux label to keep
+        logger.debug("can't replace %s: %s, rewrite it in place", path, err)
+        with open(path, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-    processing_vm_and_img(args, org_vm_name, org_domxml)
+    logger.info("registered %d VMs in %s", len(entries), path)
+    return len(entries)
 
 
-    ret = ''
-    for name in args.vm_name:
-        ret = ret + "\n                               virsh start " + name
-    logger.info("now have fun:%s", ret)
+def reload_libvirt_dnsmasq():
+    'SIGHUP the dnsmasq of libvirt networks to reread /etc/hosts, no restart'
+    logger = logging.getLogger()
 
-    sys.exit(0)
+    for pid in [p for p in os.listdir('/proc') if p.isdigit()]:
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as file:
+                cmdline = file.read().split(b'\0')
+        except OSError:
+            continue
+        if (os.path.basename(cmdline[0]) == b'dnsmasq' and
+                any(b'/libvirt/' in arg for arg in cmdline)):
+            os.kill(int(pid), signal.SIGHUP)
+            logger.debug('SIGHUP dnsmasq pid=%s', pid)
+
+
+def network_stale_hosts(netxml, names, macs, ips):
+    '''
+    The DHCP host and DNS host entries of the network XML, which belong to
+    the names, MACs or IPs, eg. of a VM duplicated again.
+
+    Returns:
+        list: (section, xml) to `virsh net-update delete`, verbatim
+    '''
+    stale = []
+    root = ET.fromstring(netxml)
+    for host in root.findall('./ip/dhcp/host'):
+        if (host.get('mac') in macs or host.get('name') in names or
+                host.get('ip') in ips):
+            stale.append(('ip-dhcp-host', ET.tostring(host, encoding='unicode').strip()))
+    for host in root.findall('./dns/host'):
+        hostnames = set(h.text for h in host.findall('hostname'))
+        if host.get('ip') in ips or hostnames & set(names):
+            stale.append(('dns-host', ET.tostring(host, encoding='unicode').strip()))
+    return stale
+
+
+def register_libvirt_network(results, network):
+    '''Register the DHCP host and DNS host entries of all VMs with a static
+    IP to the libvirt network, live and persistent. The existing entries of
+    the same names, MACs or IPs are deleted first, libvirt can't modify a DNS
+    host. Per libvirt host, it is one `virsh net-dumpxml`, one virsh run of
+    all deletions and one of all additions. Return the number of VMs
+    registered.
+    '''
+    logger = logging.getLogger()
+
+    by_uri = collections.OrderedDict()
+    for r in results:
+        if not r.ok or r.ip_cidr is None or not r.macs:
+            continue
+        by_uri.setdefault(r.uri, []).append(r)
+
+    count = 0
+    for uri, vms in by_uri.items():
+        virsh = ['virsh'] + (['-c', uri] if uri else [])
+        entries = []
+        for r in vms:
+            ip = str(ipaddress.ip_interface(r.ip_cidr).ip)
+            entries.append(('ip-dhcp-host', "<host mac='{}' name='{}' ip='{}'/>".format(
+                r.macs[0], r.name, ip)))
+            entries.append(('dns-host', "<host ip='{}'><hostname>{}</hostname></host>".format(
+                ip, r.name)))
+
+        ret, netxml, err = run_cmd(virsh + ['net-dumpxml', network], shell=False)
+        if ret:
+            logger.warning("failed to read network '%s': %s", network, err.strip())
+            continue
+        stale = network_stale_hosts(
+            netxml, set(r.name for r in vms), set(r.macs[0] for r in vms),
+            set(str(ipaddress.ip_interface(r.ip_cidr).ip) for r in vms))
+
+        def net_update(command, items):
+            # virsh runs a single argument as commands separated by ';'
+            cmds = ' ; '.join(' '.join(shlex.quote(arg) for arg in (
+                'net-update', network, command, section, xml, '--live', '--config'))
+                              for section, xml in items)
+            return run_cmd(virsh + [cmds], shell=False)
+
+        if stale:
+            ret, _o, err = net_update('delete', stale)
+            if ret:
+                logger.warning("failed to delete the old entries of network "
+                               "'%s': %s", network, err.strip())
+        ret, _o, err = net_update('add-last', entries)
+        if ret == 0:
+            count += len(vms)
+            continue
+
+        # the batch might be applied in part, add the missing entries one by one
+        logger.debug("net-update of network '%s' failed: %s", network, err.strip())
+        ret, netxml, _e = run_cmd(virsh + ['net-dumpxml', network], shell=False)
+        for r, dhcp_host, dns_host in zip(vms, entries[0::2], entries[1::2]):
+            ip = str(ipaddress.ip_interface(r.ip_cidr).ip)
+            present = set(section for section, _x in network_stale_hosts(
+                netxml, {r.name}, {r.macs[0]}, {ip})) if ret == 0 else set()
+            missing = [e for e in (dhcp_host, dns_host) if e[0] not in present]
+            if missing and net_update('add-last', missing)[0]:
+                logger.warning("failed to register '%s' to network '%s'",
+                               r.name, network)
+                continue
+            count += 1
+
+    logger.info("registered %d VMs to libvirt network '%s'", count, network)
+    return count
+
+
+def register_clones(args, results):
+    'the batch stage after all VMs are done, see --register-hosts/--register-net'
+    logger = logging.getLogger()
+
+    if not (getattr(args, 'register_hosts', False) or
+            getattr(args, 'register_net', None)):
+        return
+
+    # the refreshed VMs keep their domain, and the registration
+    results = [r for r in results if r.refreshed is None]
+
+    for r in results:
+        if r.ok and r.ip_cidr is None:
+            logger.info("vm '%s' uses dhcp, not registered", r.name)
+
+    if args.register_hosts and register_hosts_file(results):
+        reload_libvirt_dnsmasq()
+    if args.register_net:
+        register_libvirt_network(results, args.register_net)
+
+
+def validate_options(args):
+    '''check and normalize the options of a batch, raise VirtDupError'''
+
+    # check VM names
+    for name in args.vm_name:
+        if ' ' in name:
+            raise VirtDupError(' the space char is prohibited, "%s"' % name)
+
+    # --set-ip-cidr and --change-ip can't co-exist
+    if args.set_ip_cidr is not None and args.change_ip is not None:
+        raise VirtDupError("--set-ip-cidr and --change-ip can't co-exist")
+
+    # --set-ip-cidr validation
+    if args.set_ip_cidr is not None:
+        try:
+            parse_ip_range(args.set_ip_cidr[0])
+        except ValueError:
+            raise VirtDupError('ip address/netmask is invalid: %s' %
+                               args.set_ip_cidr[0]) from None
+
+    if args.change_ip is not None:
+        str1 = args.change_ip[0].lower()
+        args.change_ip[0]=str1
+        if str1 != 'no' and ',' not in str1:
+            raise VirtDupError("'--change-ip %s' misses ','." % str1)
+
+    if isinstance(getattr(args, 'copy_bw', None), str):
+        try:
+            args.copy_bw = parse_size(args.copy_bw)
+        except ValueError as err:
+            raise VirtDupError(str(err)) from None
+
+    # fail before any VM is defined, each hook is resolved once per batch
+    args.hooks = [(spec, resolve_hook(spec))
+                  for spec in getattr(args, 'hook', None) or ()]
+
+
+# the qcow2 metadata and /etc edits un-share little of a reflinked image
+REFLINK_OVERHEAD = 256 << 20
+
+
+def parse_domain_states(out):
+    '{name: state} of the table of `virsh list --all`'
+    states = {}
+    for line in out.splitlines()[2:]:
+        fields = line.split(None, 2)
+        if len(fields) == 3:
+            states[fields[1]] = fields[2].strip()
+    return states
+
+
+def list_domain_states(uri=None):
+    '{name: state} of all domains of the host, by one virsh call'
+    cmd = ['virsh'] + (['-c', uri] if uri else []) + ['list', '--all']
+    return parse_domain_states(check_output(cmd, universal_newlines=True))
+
+
+def probe_reflink(directory):
+    'True if the filesystem of directory reflinks, by FICLONE of a tiny file'
+    if dir_fstype(directory) in NO_REFLINK_FSTYPES:
+        return False
+    try:
+        with tempfile.TemporaryFile(dir=directory) as src, \
+                tempfile.TemporaryFile(dir=directory) as dst:
+            src.write(b'\0' * 4096)
+            src.flush()
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def worst_case_bytes(method, img_files, count):
+    '''
+    The space count clones of img_files take at worst, the allocated size of
+    each image for a real copy, REFLINK_OVERHEAD per image for reflink
+    '''
+    if method == 'reflink':
+        return REFLINK_OVERHEAD * len(img_files) * count
+    return sum(os.stat(img).st_blocks * 512 for img in img_files) * count
+
+
+def check_space(org_img_files, count):
+    '''
+    Compare the free space with the worst case of the clones, per filesystem
+
+    Returns:
+        list: (directory, copy method, needed bytes, free bytes)
+    '''
+    by_dev = collections.OrderedDict()
+    for img in org_img_files:
+        directory = os.path.dirname(img)
+        by_dev.setdefault(os.stat(directory).st_dev, (directory, []))[1].append(img)
+
+    space = []
+    for directory, imgs in by_dev.values():
+        method = 'reflink' if probe_reflink(directory) else 'copy'
+        vfs = os.statvfs(directory)
+        space.append((directory, method, worst_case_bytes(method, imgs, count),
+                      vfs.f_bavail * vfs.f_frsize))
+    return space
+
+
+def image_name_conflicts(org_vm_name, targets, org_domxml, domxmls):
+    '''
+    The problems of the image names, see the Tips of --help. domxmls is
+    {name: domxml} of all existing domains.
+    '''
+    problems = []
+    owner = {}
+    for name, domxml in domxmls.items():
+        for img in domain_image_files(domxml):
+            owner.setdefault(img, set()).add(name)
+
+    # an image named after the source, but shared with other VMs, would be
+    # duplicated per clone instead
+    for img in domain_own_image_files(org_vm_name, org_domxml):
+        others = owner.get(img, set()) - {org_vm_name}
+        if others:
+            problems.append("'{}' is named after '{}' but shared with {}, "
+                            "rename the image".format(img, org_vm_name,
+                                                      ', '.join(sorted(others))))
+
+    new_imgs = {}
+    for target in targets:
+        for img in domain_own_image_files(org_vm_name, org_domxml):
+            new_img = os.path.join(os.path.dirname(img), target +
+                                   os.path.basename(img)[len(org_vm_name):])
+            if new_img in new_imgs:
+                problems.append("'{}' is the image of both '{}' and '{}'".format(
+                    new_img, new_imgs[new_img], target))
+            new_imgs[new_img] = target
+            others = owner.get(new_img, set()) - {target}
+            if others:
+                problems.append("'{}' of '{}' is used by {}".format(
+                    new_img, target, ', '.join(sorted(others))))
+    return problems
+
+
+def preflight(args, org_vm_name, org_domxml):
+    '''
+    Check the whole batch once, before any destructive step. The checks run
+    in parallel: the state of all domains of the hosts, the free space for
+    the worst case of the copy method, the free NBD devices, the IPs of
+    --set-ip-cidr and the image names.
+
+    Returns:
+        dict: the plan, see format_plan()
+    Raises:
+        VirtDupError: with all problems found
+    '''
+    problems = []
+    targets = args.vm_name
+    org_imgs = domain_own_image_files(org_vm_name, org_domxml)
+    uris = getattr(args, 'connect', None) or [None]
+
+    if len(set(targets)) != len(targets):
+        problems.append('the VM names are not unique')
+    if org_vm_name in targets:
+        problems.append("'{}' can't be duplicated to itself".format(org_vm_name))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        states_f = {uri: executor.submit(list_domain_states, uri) for uri in uris}
+        # the source VM is on the local host
+        local_f = states_f.get(None) or executor.submit(list_domain_states)
+        space_f = executor.submit(check_space, org_imgs, len(targets))
+
+        def local_domxmls():
+            try:
+                states = local_f.result()
+            except (OSError, subprocess.CalledProcessError):
+                return {}
+            return dump_vm_domxmls(states.keys())
+        domxmls_f = executor.submit(local_domxmls)
+
+        ip_f = None
+        if args.set_ip_cidr is not None:
+            ip_f = executor.submit(lambda: ipam_allocate_batch(
+                args, len(targets), domxmls_f.result()))
+
+        def nbd_free():
+            if not any(is_qcow2(img) for img in org_imgs):
+                return None
+            ensure_nbd_module()
+            return sum(1 for nbd in glob.glob('/sys/block/nbd*')
+                       if not nbd_in_use(nbd))
+        nbd_f = executor.submit(nbd_free)
+
+    plan = {'targets': collections.OrderedDict(), 'ip_cidrs': None,
+            'source_state': None}
+    try:
+        plan['source_state'] = local_f.result().get(org_vm_name)
+    except (OSError, subprocess.CalledProcessError) as err:
+        if None not in states_f:
+            problems.append("can't list the domains of localhost: {}".format(err))
+    for uri, future in states_f.items():
+        try:
+            states = future.result()
+        except (OSError, subprocess.CalledProcessError) as err:
+            problems.append("can't list the domains of {}: {}".format(
+                uri or 'localhost', err))
+            continue
+        for target in targets:
+            if target in states:
+                plan['targets'][target] = (uri, states[target])
+                if getattr(args, 'refresh', False) and states[target] != 'shut off':
+                    problems.append("'{}' is {}, shut it off to refresh".format(
+                        target, states[target]))
+    for target in targets:
+        plan['targets'].setdefault(target, (None, None))
+
+    try:
+        plan['space'] = space_f.result()
+    except OSError as err:
+        plan['space'] = []
+        problems.append(str(err))
+    for directory, method, need, free in plan['space']:
+        if need > free:
+            problems.append("{} needs {:.1f} GiB for {} clones by {}, {:.1f} GiB "
+                            "free".format(directory, need / 2**30, len(targets),
+                                          method, free / 2**30))
+
+    try:
+        plan['nbd_free'] = nbd_f.result()
+    except (AssertionError, OSError, subprocess.CalledProcessError) as err:
+        plan['nbd_free'] = None
+        problems.append("can't load the nbd module: {}".format(
+            str(err) or type(err).__name__))
+    # each job of the batch holds one NBD device at a time
+    jobs = min(len(targets), getattr(args, 'jobs', None) or 1)
+    if plan['nbd_free'] is not None and plan['nbd_free'] < jobs:
+        problems.append('{} free NBD devices, {} required'.format(
+            plan['nbd_free'], jobs))
+
+    if ip_f is not None:
+        try:
+            plan['ip_cidrs'] = ip_f.result()
+        except VirtDupError as err:
+            problems.append(str(err))
+
+    problems += image_name_conflicts(org_vm_name, targets, org_domxml,
+                                     domxmls_f.result())
+
+    logging.getLogger().info('%s', format_plan(plan, org_vm_name))
+    if problems:
+        raise VirtDupError('preflight failed:\n  - ' + '\n  - '.join(problems))
+    return plan
+
+
+def format_plan(plan, org_vm_name):
+    'the plan of preflight() for humans'
+    lines = ['plan to duplicate {}:'.format(org_vm_name)]
+    ip_cidrs = plan['ip_cidrs'] or [None] * len(plan['targets'])
+    for (target, (uri, state)), ip_cidr in zip(plan['targets'].items(), ip_cidrs):
+        if state is None:
+            action = 'define'
+        elif state == 'shut off':
+            action = 'redefine'
+        else:
+            action = 'destroy ({}), redefine'.format(state)
+        lines.append('  {:<20} {:<24} {}{}'.format(
+            target, action, ip_cidr or 'dhcp',
+            ' on ' + uri if uri else ''))
+    for directory, method, need, free in plan['space']:
+        lines.append('  {}: {}, needs {:.1f} GiB at worst, {:.1f} GiB free'.format(
+            directory, method, need / 2**30, free / 2**30))
+    if plan.get('nbd_free') is not None:
+        lines.append('  {} free NBD devices'.format(plan['nbd_free']))
+    return '\n'.join(lines)
+
+
+class Cloner():
+    '''
+    The library API to duplicate VMs in-process, eg.
+
+        cloner = virt_dup.Cloner()
+        for r in cloner.clone('VMx', ['VM1', 'VM2'],
+                              {'set_ip_cidr': '192.168.151.101/24'}):
+            print(r.name, r.ok, r.copy_method, r.macs, r.ip_cidr, r.timings)
+
+    It never exits, nor configures logging. It logs to the root logger as
+    the CLI does. Invalid options raise VirtDupError, the failure of a VM
+    is recorded in its CloneResult.error.
+
+    Args:
+        defaults (dict, optional): the options of every clone() call
+    '''
+
+    def __init__(self, defaults=None):
+        self.defaults = dict(defaults or {})
+
+    def options(self, source, targets, options=None):
+        '''
+        The argparse.Namespace of the CLI for the batch. options is a dict
+        or a Namespace with the dest names of the CLI options, eg.
+        set_ip_cidr, change_ip, connect, register_net.
+        '''
+        args = cli_parser().parse_args(['--', source])
+        if isinstance(options, argparse.Namespace):
+            options = vars(options)
+        for key, value in dict(self.defaults, **(options or {})).items():
+            # the CLI nargs options are lists
+            if key in ('set_ip_cidr', 'change_ip', 'connect') and isinstance(value, str):
+                value = [value]
+            setattr(args, key, list(value) if isinstance(value, (list, tuple)) else value)
+        args.vm_name = list(targets) if targets else ['%s_dup' % source]
+        return args
+
+    def clone(self, source, targets=None, options=None):
+        '''
+        Duplicate the source VM to targets, the default is 'SOURCE_dup'.
+
+        Returns:
+            list: CloneResult of each target, [] for dry_run
+        Raises:
+            VirtDupError: if the options are invalid, not root, the source
+                          VM doesn't exist, or the preflight fails
+        '''
+        args = self.options(source, targets, options)
+        validate_options(args)
+
+        if os.getuid() != 0:
+            raise VirtDupError('please run as root')
+
+        org_domxml = get_org_domxml(source)
+
+        # all IPs of the batch are allocated up front
+        plan = preflight(args, source, org_domxml)
+        if getattr(args, 'dry_run', False):
+            return []
+
+        events = getattr(args, 'events', None)
+        if events is not None and EVENTS is None:
+            open_events(events)
+            try:
+                return self._clone(args, source, org_domxml, plan)
+            finally:
+                close_events()
+        return self._clone(args, source, org_domxml, plan)
+
+    def _clone(self, args, source, org_domxml, plan):
+
+        state, ip_cidrs = plan['source_state'] or '', plan['ip_cidrs']
+        # the states of the targets are known by the preflight already
+        states = {name: target_state
+                  for name, (_uri, target_state) in plan['targets'].items()}
+        if state in ('running', 'paused') and getattr(args, 'live', False):
+            re_org_img = re.compile(r"<source file='(\S*/%s\S+)'.*/>$" % source, re.M)
+            with LiveSource(source, re_org_img.findall(org_domxml)) as live:
+                emit_event('frozen', source, method=live.method,
+                           duration=live.freeze)
+                args.source_images = live.images
+                try:
+                    results = processing_vm_and_img(args, source, org_domxml,
+                                                    ip_cidrs=ip_cidrs,
+                                                    states=states)
+                finally:
+                    args.source_images = {}
+            for r in results:
+                r.timings['freeze'] = live.freeze
+        else:
+            if state == 'running':
+                logging.getLogger().warning(
+                    "'%s' is running, the copies are crash-inconsistent "
+                    "without --live", source)
+            results = processing_vm_and_img(args, source, org_domxml,
+                                            ip_cidrs=ip_cidrs, states=states)
+
+        register_clones(args, results)
+
+        if getattr(args, 'start', None):
+            start = time.time()
+            StartScheduler(args.start, args.start_timeout,
+                           args.ready_probe).run(results)
+            ready = [r for r in results if r.timings.get('ready') is not None]
+            logging.getLogger().info('%d of %d VMs ready in %.1fs',
+                                     len(ready), len(results), time.time() - start)
+        return results
+
+
+def process_args(args):
+    'docstring'
+
+    config_logger(args)
+    logger = logging.getLogger()
+
+    ensure_cli_env_is_root()
+
+    org_vm_name = args.vm_name[0]
+    try:
+        results = Cloner().clone(org_vm_name, args.vm_name[1:], args)
+    except VirtDupError as err:
+        logger.critical('%s', err)
+        sys.exit(-1)
+
+    if args.dry_run:
+        sys.exit(0)
+
+    ret = ''
+    for r in results:
+        if not r.ok or 'ready' in r.timings:
+            continue
+        ret = ret + "\n                               virsh {}start {}".format(
+            '-c {} '.format(r.uri) if r.uri else '', r.name)
+    logger.info("now have fun:%s", ret)
+
+    sys.exit(0 if all(r.ok for r in results) else -1)
+
+
+def ipam_allocate_batch(args, count, domxmls=None):
+    '''allocate count IP_CIDRs for --set-ip-cidr, raise VirtDupError if not possible
+
+    domxmls (dict, optional): {name: domxml} of the existing domains, their
+                              static IPs are in use
+    '''
+    logger = logging.getLogger()
+
+    if getattr(args, 'ip_check', True):
+        # the existing VMs to be duplicated again, or refreshed, give their
+        # IPs back, the IPs of all other VMs stay in use
+        macs = set()
+        for name in args.vm_name:
+            macs.update(mac.lower() for mac in re.findall(
+                r"<mac address='([^']+)'", (domxmls or {}).get(name, '')))
+        used = IpamIndex.from_host(getattr(args, 'connect', None) or (None,),
+                                   exclude=args.vm_name, exclude_macs=macs)
+        if domxmls:
+            used.load_domains(domxmls, exclude=args.vm_name)
+        used.inventory, used.exclude = open_inventory(args), tuple(args.vm_name)
+    else:
+        used = ()
+    try:
+        ip_cidrs = ipam_allocate(args.set_ip_cidr[0], count, used)
+    except ValueError as err:
+        raise VirtDupError(str(err)) from None
+    finally:
+        if getattr(used, 'inventory', None) is not None:
+            used.inventory.close()
+    logger.debug('allocated IPs: %s', ' '.join(ip_cidrs))
+    return ip_cidrs
+
+
+def get_org_domxml(org_vm_name):
+    'return the domxml of the original VM, raise VirtDupError if not exist'
+    logger = logging.getLogger()
+
+    ret, _o, _e = run_cmd("virsh domstate %s"%(org_vm_name))
+    if ret:
+        raise VirtDupError("the virtual machine '%s' doesn't exist" % org_vm_name)
+
+    org_domxml = check_output(('virsh dumpxml ' + org_vm_name).split(),
+                              universal_newlines=True).strip()
+
+    # info user all image files shared among VM
+    for _s, path, image_name, _e in re.findall(
+            r"(.*<source file=')(\S*/)(\S+)('.*/>)$", org_domxml, re.M):
+        if re.match(org_vm_name, image_name):
+            continue
+        logger.info("'%s' is shared among VMs", path+image_name)
+
+    return org_domxml
+
+
+def list_vm_domains():
+    'names of all domains in `virsh list --all`'
+    out = check_output('virsh list --all --name'.split(),
+                       universal_newlines=True)
+    return [name.strip() for name in out.splitlines() if name.strip()]
+
+
+def dump_vm_domxmls(domains, jobs=8):
+    'return {name: domxml}, `virsh dumpxml` run in parallel'
+    def dumpxml(name):
+        ret, out, _e = run_cmd(['virsh', 'dumpxml', name], shell=False)
+        # the domain might be gone meanwhile
+        return name, out if ret == 0 else ''
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(dumpxml, domains))
+
+
+def domain_image_files(domxml):
+    'all image files in <source file=.../> of the domxml'
+    return re.findall(r"<source file='(\S+)'", domxml)
+
+
+def domain_own_image_files(vm_name, domxml):
+    'the image files with vm_name as the prefix, aka. created by virt-dup'
+    return [img for img in domain_image_files(domxml)
+            if os.path.basename(img).startswith(vm_name)]
+
+
+def qcow2_backing_file(img_file):
+    'the backing file name in the qcow2 header, or None'
+    try:
+        with open(img_file, 'rb') as file:
+            header = file.read(20)
+            if len(header) < 20 or header[:4] != b'QFI\xfb':
+                return None
+            offset, size = struct.unpack('>QI', header[8:20])
+            if offset == 0 or size == 0:
+                return None
+            file.seek(offset)
+            backing = file.read(size).decode('utf-8', 'replace')
+    except OSError:
+        return None
+    if not os.path.isabs(backing):
+        backing = os.path.join(os.path.dirname(img_file), backing)
+    return os.path.normpath(backing)
+
+
+def match_vm_domains(domains, patterns):
+    'domains matching any of the name globs, in the order of domains'
+    return [name for name in domains
+            if any(fnmatch.fnmatchcase(name, pat) for pat in patterns)]
+
+
+def protected_vm_domains(targets, domxmls, golden_vms=()):
+    '''
+    The targets rm must not tear down without --force, {name: reason}: the
+    golden VMs, and the VMs with own images not stamped by virt-dup.
+
+    golden_vms (iterable, optional): the sources of clones and pools
+    '''
+    protected = {}
+    for name in targets:
+        if name in golden_vms:
+            protected[name] = 'a source of clones'
+            continue
+        unstamped = [img for img in domain_own_image_files(name, domxmls[name])
+                     if os.path.exists(img) and not is_virt_dup_image(img)]
+        if unstamped:
+            protected[name] = "'{}' is not duplicated by virt-dup".format(unstamped[0])
+    return protected
+
+
+def pool_golden_vms():
+    'the golden VMs of all pools'
+    pools = glob.glob(os.path.join(POOL_DIR, '*.conf'))
+    return set(read_pool_conf(os.path.basename(path)[:-5])[0] for path in pools)
+
+
+def teardown_vm(vm_name, domxml, shared_imgs, keep_images=False):
+    'destroy, undefine the VM, then delete its own images not in shared_imgs'
+    logger = logging.getLogger()
+
+    ret, stdout, _e = run_cmd(['virsh', 'domstate', vm_name], shell=False)
+    if ret:
+        logger.warning("vm '%s' is gone already", vm_name)
+        return False
+
+    if 'shut off' not in stdout:
+        ret, _o, _e = run_cmd(['virsh', 'destroy', vm_name], shell=False)
+        if ret:
+            logger.critical("failed to destroy '%s'", vm_name)
+            return False
+
+    ret, _o, _e = run_cmd(['virsh', 'undefine', vm_name], shell=False)
+    if ret:
+        logger.critical("failed to undefine '%s'", vm_name)
+        return False
+    logger.info("vm '%s' is undefined", vm_name)
+
+    if keep_images:
+        return True
+
+    for img in domain_own_image_files(vm_name, domxml):
+        if img in shared_imgs:
+            logger.info("'%s' is shared among VMs, keep it", img)
+            continue
+        try:
+            os.unlink(img)
+            logger.info("'%s' is deleted", img)
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def in_use_image_files(domxmls):
+    'image files used by the domains, including the qcow2 backing chains'
+    in_use = set()
+    for domxml in domxmls:
+        for img in domain_image_files(domxml):
+            while img is not None and img not in in_use:
+                in_use.add(img)
+                img = qcow2_backing_file(img)
+    return in_use
+
+
+def is_virt_dup_image(img_file):
+    'True if the image is stamped by virt-dup, see stamp_source_identity()'
+    try:
+        os.getxattr(img_file, XATTR_SOURCE)
+        return True
+    except OSError:
+        return False
+
+
+def find_orphan_image_files(dirs, in_use, domains):
+    '''Image files in dirs stamped by virt-dup as clones, while no domain uses
+    them, nor are they named after a defined domain. Other files, eg.
+    templates, cloud images and backups, are never orphans.
+    '''
+    orphans = []
+    for directory in sorted(dirs):
+        if not os.path.isdir(directory):
+            continue
+        for base in sorted(os.listdir(directory)):
+            img = os.path.join(directory, base)
+            if img in in_use or not os.path.isfile(img):
+                continue
+            if any(base.startswith(name) for name in domains):
+                continue
+            if is_virt_dup_image(img):
+                orphans.append(img)
+    return orphans
+
+
+def pool_spare_name(pool, idx):
+    'the spare clone name, which is its placeholder hostname as well'
+    return '{}-spare{}'.format(pool, idx)
+
+
+def pool_spares(pool, domains):
+    'the spare clones of the pool among domains, in the order of the index'
+    re_spare = re.compile(r'^%s-spare(\d+)$' % re.escape(pool))
+    spares = [(int(m.group(1)), name) for name in domains
+              for m in [re_spare.match(name)] if m]
+    return [name for _i, name in sorted(spares)]
+
+
+def pool_missing_spares(pool, size, domains, ready=None):
+    '''the spare names to create, to fill the pool up to size
+
+    ready (iterable, optional): the complete spares, see pool_ready_spares().
+        The other spares are left over by an interrupted fill, and are
+        created again. None means all spares are complete.
+    '''
+    existing = set(pool_spares(pool, domains))
+    ready = existing if ready is None else existing & set(ready)
+    missing = []
+    idx = 0
+    while len(ready) + len(missing) < size:
+        name = pool_spare_name(pool, idx)
+        if name not in ready and (name in existing or name not in domains):
+            missing.append(name)
+        idx += 1
+    return missing
+
+
+def pool_ready_dir(pool):
+    'a spare is complete, and can be taken, once its marker file is here'
+    return os.path.join(POOL_DIR, pool + '.ready')
+
+
+def pool_ready_spares(pool, domains):
+    'the complete spares of the pool among domains, in the order of the index'
+    try:
+        ready = set(os.listdir(pool_ready_dir(pool)))
+    except FileNotFoundError:
+        ready = set()
+    return [name for name in pool_spares(pool, domains) if name in ready]
+
+
+def mark_spare_ready(pool, spare, ready=True):
+    'docstring'
+    path = os.path.join(pool_ready_dir(pool), spare)
+    if ready:
+        os.makedirs(pool_ready_dir(pool), exist_ok=True)
+        with open(path, 'w'):
+            pass
+    elif os.path.exists(path):
+        os.unlink(path)
+
+
+def pool_conf_path(pool):
+    'docstring'
+    return os.path.join(POOL_DIR, pool + '.conf')
+
+
+def read_pool_conf(pool):
+    'return (golden_vm, size), or (None, None) if the pool is unknown'
+    config = configparser.ConfigParser()
+    if not config.read(pool_conf_path(pool)):
+        return None, None
+    return config['pool']['golden_vm'], config['pool'].getint('size')
+
+
+def write_pool_conf(pool, golden_vm, size):
+    'docstring'
+    os.makedirs(POOL_DIR, exist_ok=True)
+    config = configparser.ConfigParser()
+    config['pool'] = {'golden_vm': golden_vm, 'size': str(size)}
+    with open(pool_conf_path(pool), 'w') as configfile:
+        config.write(configfile)
+        configfile.flush()
+
+
+@contextlib.contextmanager
+def pool_lock(pool, purpose='fill'):
+    '''
+    purpose='fill' serializes the pool filling, eg. among background refills.
+    purpose='spares' serializes taking a spare and marking one complete, it is
+    held shortly, so take doesn't wait for a refill.
+    '''
+    os.makedirs(POOL_DIR, exist_ok=True)
+    lockname = pool + ('.lock' if purpose == 'fill' else '.' + purpose + '.lock')
+    with open(os.path.join(POOL_DIR, lockname), 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def process_pool_args(args):
+    """Fill the pool with spare clones of the golden VM.
+
+    The spares get their own MACs, reset to dhcp, and the spare name as the
+    placeholder hostname. `virt-dup take` applies the rest later.
+    """
+    config_logger(args)
+    logger = logging.getLogger()
+
+    ensure_cli_env_is_root()
+
+    for name in (args.golden_vm, args.pool):
+        if ' ' in name or '/' in name:
+            logger.critical(' the space and / chars are prohibited, "%s"', name)
+            sys.exit(-1)
+
+    with pool_lock(args.pool):
+        _golden_vm, size = read_pool_conf(args.pool)
+        if args.size is not None:
+            size = args.size
+        if size is None:
+            size = 1
+        if size < 0:
+            logger.critical('--size must not be negative')
+            sys.exit(-1)
+        write_pool_conf(args.pool, args.golden_vm, size)
+
+        try:
+            org_domxml = get_org_domxml(args.golden_vm)
+        except VirtDupError as err:
+            logger.critical('%s', err)
+            sys.exit(-1)
+
+        # refill until the pool is full, spares might be taken meanwhile. A
+        # spare is exposed to take only once it is complete
+        while True:
+            domains = list_vm_domains()
+            missing = pool_missing_spares(args.pool, size, domains,
+                                          pool_ready_spares(args.pool, domains))
+            if not missing:
+                break
+            logger.info("pool '%s': filling %s", args.pool, ' '.join(missing))
+
+            used_macs = set()
+            for spare in pool_spares(args.pool, domains):
+                if spare in missing:
+                    continue
+                out = check_output(('virsh dumpxml ' + spare).split(),
+                                   universal_newlines=True)
+                used_macs.update(re.findall(r"<mac address='(\S+)'/>", out))
+
+            args.vm_name = missing
+            args.change_ip = None
+            args.set_ip_cidr = None
+            results = processing_vm_and_img(args, args.golden_vm, org_domxml,
+                                            used_macs)
+            with pool_lock(args.pool, 'spares'):
+                for r in results:
+                    if r.ok:
+                        mark_spare_ready(args.pool, r.name)
+            if not any(r.ok for r in results):
+                logger.critical("pool '%s': failed to fill", args.pool)
+                sys.exit(-1)
+
+    logger.info("pool '%s' has %d spare clones of '%s'",
+                args.pool, size, args.golden_vm)
+    sys.exit(0)
+
+
+def pool_take_spare(pool, new_vm_name):
+    '''rename a complete spare to new_vm_name, return the spare name or None
+    if empty. The spares being filled are never taken, see pool_ready_spares()
+    '''
+    logger = logging.getLogger()
+
+    with pool_lock(pool, 'spares'):
+        for spare in pool_ready_spares(pool, list_vm_domains()):
+            ret, _o, _e = run_cmd('virsh domrename {} {}'.format(spare, new_vm_name))
+            if ret == 0:
+                mark_spare_ready(pool, spare, False)
+                logger.info("vm '%s' is taken from pool '%s' as '%s'",
+                            spare, pool, new_vm_name)
+                return spare
+    return None
+
+
+def rename_vm_images(org_vm_name, new_vm_name):
+    """Rename the image files with org_vm_name as the prefix to new_vm_name,
+    and redefine the domain with the new paths. Return the new image paths.
+    """
+    logger = logging.getLogger()
+
+    domxml = check_output(('virsh dumpxml ' + new_vm_name).split(),
+                          universal_newlines=True).strip()
+    re_org_img = re.compile(r"(.*<source file=')(\S*/)(%s)(\S+)('.*/>)$"%
+                            re.escape(org_vm_name), re.M)
+
+    new_img_paths = []
+    for _head, path, prefix, name, _misc in re_org_img.findall(domxml):
+        os.rename(path+prefix+name, path+new_vm_name+name)
+        logger.debug("rename '%s' to '%s'", path+prefix+name, path+new_vm_name+name)
+        new_img_paths.append(path+new_vm_name+name)
+
+    if new_img_paths:
+        domxml = re_org_img.sub(r'\1\g<2>%s\4\5'%new_vm_name, domxml)
+        with tempfile.NamedTemporaryFile(prefix="virt_dup_domxml_",
+                                         suffix='.' + new_vm_name + '.xml',
+                                         mode='w+t') as new_xml:
+            new_xml.write(domxml)
+            new_xml.flush()
+            ret = check_output(('virsh define ' + new_xml.name).split())
+            logger.debug(ret.decode('utf-8').strip())
+    return new_img_paths
+
+
+def pool_discard_taken(spare, new_vm_name):
+    '''
+    Tear down the spare taken as new_vm_name, whose rename or customization
+    failed half way. Its images are deleted, the ones not renamed yet too.
+    Return True on success.
+    '''
+    ret, domxml, _e = run_cmd(['virsh', 'dumpxml', new_vm_name], shell=False)
+    if ret:
+        logging.getLogger().critical("vm '%s' is gone, can't tear it down", new_vm_name)
+        return False
+    not_renamed = domain_own_image_files(spare, domxml)
+    if not teardown_vm(new_vm_name, domxml, set()):
+        return False
+    for img in not_renamed:
+        try:
+            os.unlink(img)
+            logging.getLogger().info("'%s' is deleted", img)
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def pool_refill_in_background(pool):
+    'spawn `virt-dup pool` detached, it outlives this process'
+    golden_vm, size = read_pool_conf(pool)
+    cmd = [sys.executable, os.path.abspath(__file__),
+           'pool', golden_vm, pool, '--size', str(size)]
+    logging.getLogger().info("refill pool '%s' in the background", pool)
+    subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def process_take_args(args):
+    """Hand out a spare clone from the pool as VM_NAME.
+
+    Only the delta is applied, ie. the hostname and --set-ip-cidr. The MACs
+    are unique already.
+    """
+    config_logger(args)
+    logger = logging.getLogger()
+
+    ensure_cli_env_is_root()
+    start = time.time()
+
+    if ' ' in args.name:
+        logger.critical(' the space char is prohibited, "%s"', args.name)
+        sys.exit(-1)
+
+    if args.set_ip_cidr is not None:
+        try:
+            parse_ip_range(args.set_ip_cidr[0])
+        except ValueError:
+            logger.critical('ip address/netmask is invalid: %s',
+                            args.set_ip_cidr[0])
+            sys.exit(-1)
+        try:
+            args.set_ip_cidr = ipam_allocate_batch(args, 1)
+        except VirtDupError as err:
+            logger.critical('%s', err)
+            sys.exit(-1)
+    else:
+        args.change_ip = ['no']
+
+    try:
+        args.hooks = [(spec, resolve_hook(spec)) for spec in args.hook or ()]
+    except VirtDupError as err:
+        logger.critical('%s', err)
+        sys.exit(-1)
+
+    golden_vm, _size = read_pool_conf(args.pool)
+    if golden_vm is None:
+        logger.critical("pool '%s' doesn't exist, refer to `virt-dup pool -h`",
+                        args.pool)
+        sys.exit(-1)
+
+    ret, _o, _e = run_cmd('virsh domstate ' + args.name)
+    if ret == 0:
+        logger.critical("the virtual machine '%s' exists already", args.name)
+        sys.exit(-1)
+
+    spare = pool_take_spare(args.pool, args.name)
+    if spare is None:
+        logger.critical("pool '%s' is empty", args.pool)
+        if args.refill:
+            pool_refill_in_background(args.pool)
+        sys.exit(-1)
+
+    # the spare is consumed now, a half renamed or customized one is torn down
+    try:
+        new_img_paths = rename_vm_images(spare, args.name)
+        macs = ()
+        if args.hooks:
+            macs = re.findall(r"<mac address='(\S+)'/>", check_output(
+                ['virsh', 'dumpxml', args.name]).decode('utf-8'))
+        for new_img_path in new_img_paths:
+            if is_qcow2(new_img_path):
+                manipulate_rootfs_in_qcow2(args, new_img_path, args.name, macs)
+    except Exception as err:
+        logger.critical("vm '%s' taken from pool '%s' failed: %s, tear it down",
+                        args.name, args.pool, str(err) or type(err).__name__)
+        logger.debug('', exc_info=True)
+        pool_discard_taken(spare, args.name)
+        inventory = open_inventory(args)
+        if inventory is not None:
+            with inventory:
+                inventory.forget(spare)
+        if args.refill:
+            pool_refill_in_background(args.pool)
+        sys.exit(-1)
+
+    inventory = open_inventory(args)
+    if inventory is not None:
+        with inventory:
+            inventory.rename(spare, args.name, new_img_paths)
+
+    if args.refill:
+        pool_refill_in_background(args.pool)
+
+    logger.info("now have fun in %.3fs:\n                               virsh start %s",
+                time.time() - start, args.name)
+    sys.exit(0)
+
+
+def process_rm_args(args):
+    'tear down all VMs matching the name globs in parallel'
+    config_logger(args)
+    logger = logging.getLogger()
+
+    ensure_cli_env_is_root()
+    start = time.time()
+
+    domains = list_vm_domains()
+    targets = match_vm_domains(domains, args.patterns)
+    if not targets:
+        logger.warning("no VM matches %s", ' '.join(args.patterns))
+        sys.exit(0)
+
+    domxmls = dump_vm_domxmls(domains, args.jobs)
+
+    # never the golden VMs by a loose glob, eg. 'VM*' matches VMx
+    if not args.force:
+        golden_vms = pool_golden_vms()
+        inventory = open_inventory(args)
+        if inventory is not None:
+            with inventory:
+                golden_vms.update(inventory.sources())
+        protected = protected_vm_domains(targets, domxmls, golden_vms)
+        for name, reason in protected.items():
+            logger.warning("vm '%s' is skipped, %s. Use --force to remove it",
+                           name, reason)
+        targets = [name for name in targets if name not in protected]
+
+    logger.info("to remove %d VMs: %s", len(targets), ' '.join(targets))
+    if args.dry_run or not targets:
+        sys.exit(0)
+
+    shared_imgs = in_use_image_files(
+        [domxmls[name] for name in domains if name not in targets])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        done = list(executor.map(
+            lambda name: teardown_vm(name, domxmls[name], shared_imgs,
+                                     args.keep_images), targets))
+
+    inventory = open_inventory(args)
+    if inventory is not None:
+        with inventory:
+            for name, ok in zip(targets, done):
+                if ok:
+                    inventory.forget(name)
+
+    logger.info("removed %d of %d VMs in %.1fs",
+                done.count(True), len(targets), time.time() - start)
+    sys.exit(0 if all(done) else -1)
+
+
+def process_gc_args(args):
+    'find, and optionally delete, orphaned image files'
+    config_logger(args)
+    logger = logging.getLogger()
+
+    ensure_cli_env_is_root()
+
+    domains = list_vm_domains()
+    domxmls = dump_vm_domxmls(domains)
+    in_use = in_use_image_files(domxmls.values())
+
+    dirs = set(os.path.dirname(img) for img in in_use)
+    dirs.update(os.path.abspath(d) for d in args.dirs)
+
+    orphans = set(find_orphan_image_files(dirs, in_use, domains))
+
+    # the images recorded in the inventory, whose VM is gone
+    inventory = open_inventory(args)
+    if inventory is not None:
+        with inventory:
+            for img, name in inventory.images().items():
+                if name not in domains and img not in in_use and os.path.isfile(img):
+                    orphans.add(img)
+                    if args.delete:
+                        inventory.forget(name)
+
+    total = 0
+    for img in sorted(orphans):
+        try:
+            size = os.stat(img).st_blocks * 512
+            if args.delete:
+                os.unlink(img)
+        except OSError as err:
+            logger.warning("'%s' is skipped: %s", img, err)
+            continue
+        total += size
+        if args.delete:
+            logger.info("'%s' is deleted, %d MiB", img, size >> 20)
+        else:
+            logger.info("'%s' is orphaned, %d MiB", img, size >> 20)
+
+    logger.info("%s %d MiB in total%s", 'deleted' if args.delete else 'orphaned',
+                total >> 20, '' if args.delete else ", use --delete to clean up")
+    sys.exit(0)
+
+
+FIDEDUPERANGE = 0xC0189436
+FILE_DEDUPE_RANGE_SAME = 0
+DEDUPE_RANGE_HEADER = struct.Struct('=QQHHI')
+DEDUPE_RANGE_INFO = struct.Struct('=qQQiI')
+# the kernel dedupes 16 MiB per call at most
+DEDUPE_MAX_BYTES = 16 << 20
+
+
+def dedupe_range(src_fd, src_offset, dst_fd, dst_offset, length):
+    '''
+    Share length bytes of dst at dst_offset with src at src_offset, if they
+    are identical. Return the bytes deduped, 0 if they differ.
+
+    Raises:
+        OSError: if the filesystem can't dedupe
+    '''
+    buf = bytearray(DEDUPE_RANGE_HEADER.size + DEDUPE_RANGE_INFO.size)
+    DEDUPE_RANGE_HEADER.pack_into(buf, 0, src_offset, length, 1, 0, 0)
+    DEDUPE_RANGE_INFO.pack_into(buf, DEDUPE_RANGE_HEADER.size, dst_fd, dst_offset, 0, 0, 0)
+    fcntl.ioctl(src_fd, FIDEDUPERANGE, buf)
+    _fd, _offset, deduped, status, _r = DEDUPE_RANGE_INFO.unpack_from(
+        buf, DEDUPE_RANGE_HEADER.size)
+    if status < 0:
+        raise OSError(-status, os.strerror(-status))
+    return deduped if status == FILE_DEDUPE_RANGE_SAME else 0
+
+
+def block_digest(data):
+    'docstring'
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class Deduper():
+    '''
+    Share the identical blocks of clones with the golden image again. The
+    blocks at the same offset are compared first, they are the most of an
+    image copied without reflink. The other blocks are looked up by their
+    hash in an index of the golden blocks, bounded by index_memory. The
+    ranges are read by jobs threads in parallel. All-zero blocks are skipped.
+
+    Args:
+        golden (str): the golden image file
+        block_size (int, optional): the unit to compare and share
+        index_memory (int, optional): the memory of the hash index, bytes
+        jobs (int, optional): threads to read in parallel
+    '''
+
+    # a 16-byte digest and an offset in a dict, roughly
+    INDEX_ENTRY_BYTES = 128
+
+    def __init__(self, golden, block_size=64 << 10, index_memory=256 << 20,
+                 jobs=4, segment=64 << 20):
+        self.logger = logging.getLogger()
+        self.golden = golden
+        self.block_size = block_size
+        self.max_entries = index_memory // self.INDEX_ENTRY_BYTES
+        self.jobs = jobs
+        self.segment = segment - segment % block_size or block_size
+        self.index = {}
+
+    def _segments(self, fd):
+        'the data of fd in segments of self.segment at most, block aligned'
+        size = os.fstat(fd).st_size
+        for offset, length in data_segments(fd, size):
+            start = offset - offset % self.block_size
+            end = offset + length
+            while start < end:
+                yield start, min(end, start + self.segment)
+                start += self.segment
+
+    def build_index(self, golden_fd):
+        'index the first distinct golden blocks, up to max_entries'
+        def digests(segment):
+            start, end = segment
+            ret = []
+            for offset in range(start, end, self.block_size):
+                data = os.pread(golden_fd, self.block_size, offset)
+                if data.strip(b'\0'):
+                    ret.append((block_digest(data), offset))
+            return ret
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for ret in executor.map(digests, self._segments(golden_fd)):
+                for digest, offset in ret:
+                    if len(self.index) >= self.max_entries:
+                        self.logger.info('the hash index is full, %d blocks',
+                                         len(self.index))
+                        return
+                    self.index.setdefault(digest, offset)
+
+    def _dedupe_segment(self, golden_fd, clone_fd, segment):
+        'return (scanned, deduped) bytes of the segment of the clone'
+        start, end = segment
+        scanned = deduped = 0
+        run_start = run_end = None
+
+        def flush():
+            done = 0
+            offset = run_start
+            while run_start is not None and offset < run_end:
+                length = min(DEDUPE_MAX_BYTES, run_end - offset)
+                done += dedupe_range(golden_fd, offset, clone_fd, offset, length)
+                offset += length
+            return done
+
+        for offset in range(start, end, self.block_size):
+            data = os.pread(clone_fd, self.block_size, offset)
+            scanned += len(data)
+            if not data.strip(b'\0'):
+                deduped += flush()
+                run_start = None
+                continue
+            if os.pread(golden_fd, len(data), offset) == data:
+                if run_start is None:
+                    run_start = offset
+                run_end = offset + len(data)
+                continue
+            deduped += flush()
+            run_start = None
+            src = self.index.get(block_digest(data))
+            if src is not None:
+                deduped += dedupe_range(golden_fd, src, clone_fd, offset, len(data))
+        deduped += flush()
+        return scanned, deduped
+
+    def dedupe(self, clone):
+        '''
+        Returns:
+            tuple: (scanned, deduped, reclaimed) bytes of the clone. reclaimed
+                   is by FIEMAP, the deduped bytes if not supported
+        '''
+        try:
+            exclusive = fiemap_usage(clone)[1]
+        except OSError:
+            exclusive = None
+
+        golden_fd = os.open(self.golden, os.O_RDONLY)
+        try:
+            # FIDEDUPERANGE needs the destination open for writing
+            clone_fd = os.open(clone, os.O_RDWR)
+            try:
+                if not self.index:
+                    self.build_index(golden_fd)
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.jobs) as executor:
+                    rets = list(executor.map(
+                        lambda seg: self._dedupe_segment(golden_fd, clone_fd, seg),
+                        self._segments(clone_fd)))
+            finally:
+                os.close(clone_fd)
+        finally:
+            os.close(golden_fd)
+
+        scanned = sum(ret[0] for ret in rets)
+        deduped = sum(ret[1] for ret in rets)
+        reclaimed = deduped
+        if exclusive is not None:
+            reclaimed = max(0, exclusive - fiemap_usage(clone)[1])
+        return scanned, deduped, reclaimed
+
+
+def process_dedupe_args(args):
+    'share the identical blocks of the clones with the golden image'
+    config_logger(args)
+    logger = logging.getLogger()
+
+    ensure_cli_env_is_root()
+
+    deduper = Deduper(args.golden, args.block_size, args.index_memory, args.jobs)
+    total_scanned = total_reclaimed = 0
+    start = time.time()
+    for clone in args.clones:
+        clone_start = time.time()
+        try:
+            scanned, deduped, reclaimed = deduper.dedupe(clone)
+        except OSError as err:
+            logger.critical("failed to dedupe '%s': %s", clone, err)
+            sys.exit(-1)
+        elapsed = time.time() - clone_start
+        total_scanned += scanned
+        total_reclaimed += reclaimed
+        logger.info("'%s': %d MiB shared, %d MiB reclaimed, %.1f MiB/s", clone,
+                    deduped >> 20, reclaimed >> 20,
+                    scanned / 2**20 / max(elapsed, 1e-6))
+
+    elapsed = time.time() - start
+    logger.info("reclaimed %d MiB of %d clones in %.1fs, %.1f MiB/s scanned",
+                total_reclaimed >> 20, len(args.clones), elapsed,
+                total_scanned / 2**20 / max(elapsed, 1e-6))
+    sys.exit(0)
+
+
+SUBCOMMANDS = {
+    'pool': (cli_parser_pool, process_pool_args),
+    'take': (cli_parser_take, process_take_args),
+    'rm': (cli_parser_rm, process_rm_args),
+    'gc': (cli_parser_gc, process_gc_args),
+    'dedupe': (cli_parser_dedupe, process_dedupe_args),
+}
+
+
+def main(argv=None):
+    'dispatch the subcommands, or duplicate VMs by default'
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in SUBCOMMANDS:
+        parser, process = SUBCOMMANDS[argv[0]]
+        process(parser().parse_args(argv[1:]))
+    process_args(cli_parser().parse_args(argv))
 
 
-#  TODO to detect if a new hostname need be created in /etc/hosts, restart libvirtd if so
-#
-#
 if __name__ == '__main__':
-    process_args(cli_parser().parse_args())
+    main()